@@ -4,23 +4,28 @@
 
 import sqlite3
 import logging
-import json
+import orjson
+import threading
+import atexit
+import contextlib
+import time
 from datetime import datetime, timezone, timedelta
 import config
 
 logger = logging.getLogger(__name__)
 
 # --- State Machine Definitions ---
-VALID_DELIVERY_STATUSES = {'pending', 'assigned', 'en_route', 'arrived', 'completed', 'failed'}
+VALID_DELIVERY_STATUSES = {'geocoding', 'pending', 'assigned', 'en_route', 'arrived', 'completed', 'failed'}
 VALID_UNIT_STATUSES = {'idle', 'assigned', 'en_route', 'arrived_dest', 'returning', 'offline', 'error'}
 
 DELIVERY_TRANSITIONS = {
+    'geocoding': {'pending', 'failed'}, # Created before its coordinates are known; see geocoder_util
     'pending': {'assigned', 'failed'},
     'assigned': {'en_route', 'failed', 'pending'}, # Can revert if unassigned/ACK fails
     'en_route': {'arrived', 'failed', 'returning'}, # Can fail/be recalled?
     'arrived': {'completed', 'failed', 'returning'}, # Can fail/be completed/unit starts return
     'completed': {'pending'}, # Allow re-open
-    'failed': {'pending'} # Allow re-open
+    'failed': {'pending', 'geocoding'} # Allow re-open; geocoding when the address never resolved (no coordinates)
 }
 
 UNIT_TRANSITIONS = {
@@ -33,291 +38,683 @@ UNIT_TRANSITIONS = {
     'error': {'idle', 'offline'}
 }
 
+# Flattened (from, to) edge sets: the hot-path check is a single hash lookup.
+# _validate_state_transition is only used afterwards to build the rejection message.
+_DELIVERY_EDGES = frozenset((src, dst) for src, targets in DELIVERY_TRANSITIONS.items() for dst in targets)
+_UNIT_EDGES = frozenset((src, dst) for src, targets in UNIT_TRANSITIONS.items() for dst in targets)
+
+# Inverse of DELIVERY_TRANSITIONS: target status -> statuses it may be entered from (used in UPDATE ... WHERE status IN)
+DELIVERY_ALLOWED_PREV = {
+    status: tuple(sorted(prev for prev, targets in DELIVERY_TRANSITIONS.items() if status in targets))
+    for status in VALID_DELIVERY_STATUSES
+}
+
+# --- Connection Tuning ---
+# Applied once per connection, right after WAL. synchronous=NORMAL is safe under WAL
+# (fsync only at checkpoint), the rest keep hot pages/temp tables in memory.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=268435456;", # 256 MiB
+    "PRAGMA cache_size=-65536;",   # 64 MiB (negative = KiB)
+    "PRAGMA busy_timeout=5000;",   # ms
+)
+# sqlite3 caches prepared statements per connection keyed on the SQL text; with the
+# per-thread connections below, fixed statement text means each is parsed/planned once.
+STATEMENT_CACHE_SIZE = 128
+
+# --- SQL Statements ---
+_SQL_INSERT_DELIVERY = ''' INSERT INTO deliveries(address, latitude, longitude, status, creation_time, last_update_time)
+                          VALUES(?,?,?,?,?,?) RETURNING * '''
+_SQL_GET_DELIVERY = "SELECT * FROM deliveries WHERE id = ?"
+_SQL_GET_DELIVERY_STATUS = "SELECT status FROM deliveries WHERE id = ?"
+_SQL_GET_DELIVERY_ASSIGNABLE = "SELECT status, latitude IS NOT NULL AND longitude IS NOT NULL AS has_coords FROM deliveries WHERE id = ?"
+_SQL_LIST_DELIVERIES_FOR_MAP = "SELECT id, address, latitude, longitude, status, assigned_unit_id FROM deliveries ORDER BY creation_time DESC"
+_SQL_SET_GEOCODED_LOCATION = ("UPDATE deliveries SET latitude = ?, longitude = ?, status = 'pending', last_update_time = ? "
+                              "WHERE id = ? AND status = 'geocoding'")
+_SQL_GET_GEOCODING_DELIVERIES = "SELECT id, address FROM deliveries WHERE status = 'geocoding' ORDER BY id"
+_SQL_GET_ALL_DELIVERIES = "SELECT * FROM deliveries ORDER BY creation_time DESC"
+_SQL_ASSIGN_UNIT = ("UPDATE units SET assigned_delivery_id = ?, current_status = 'assigned', last_update_time = ? "
+                    "WHERE unit_id = ? AND current_status = 'idle'")
+_SQL_ASSIGN_DELIVERY = ("UPDATE deliveries SET assigned_unit_id = ?, status = 'assigned', assigned_time = ?, last_update_time = ? "
+                        "WHERE id = ? AND status = 'pending' AND latitude IS NOT NULL AND longitude IS NOT NULL "
+                        "RETURNING latitude, longitude, address") # Never hand a unit a destination without coordinates
+_SQL_GET_UNIT = "SELECT * FROM units WHERE unit_id = ?"
+_SQL_GET_UNIT_STATUS = "SELECT current_status FROM units WHERE unit_id = ?"
+_SQL_UPSERT_UNIT = ''' INSERT INTO units (unit_id, meshtastic_node_id, last_latitude, last_longitude, last_location_time, current_status, last_update_time)
+                      VALUES(:unit_id, :mnid, :lat, :lon, :loctime, COALESCE(:status, 'offline'), :lut)
+                      ON CONFLICT(unit_id) DO UPDATE SET
+                          meshtastic_node_id = COALESCE(excluded.meshtastic_node_id, units.meshtastic_node_id),
+                          last_latitude = COALESCE(excluded.last_latitude, units.last_latitude),
+                          last_longitude = COALESCE(excluded.last_longitude, units.last_longitude),
+                          last_location_time = COALESCE(excluded.last_location_time, units.last_location_time),
+                          current_status = COALESCE(:status, units.current_status),
+                          last_update_time = excluded.last_update_time '''
+_SQL_GET_UNIT_STATE = "SELECT current_status, assigned_delivery_id FROM units WHERE unit_id = ?"
+_SQL_GET_ALL_UNITS = "SELECT * FROM units ORDER BY unit_id"
+_SQL_UPDATE_UNIT_LOCATION = ''' UPDATE units
+                               SET last_latitude = ?, last_longitude = ?, last_location_time = ?, last_update_time = ?
+                               WHERE unit_id = ? '''
+_SQL_TOUCH_UNIT = "UPDATE units SET last_update_time = ? WHERE unit_id = ?"
+# Offline sweep - see check_and_update_offline_units for why deliveries go first
+_SQL_FAIL_OFFLINE_DELIVERIES = (
+    "UPDATE deliveries SET status = 'failed', failure_reason = 'Unit ' || assigned_unit_id || ' went offline', last_update_time = ? "
+    "WHERE status NOT IN ('completed', 'failed') AND id IN "
+    "(SELECT assigned_delivery_id FROM units WHERE current_status != 'offline' AND last_update_time < ?) "
+    "RETURNING id, assigned_unit_id")
+_SQL_MARK_UNITS_OFFLINE = (
+    "UPDATE units SET current_status = 'offline', assigned_delivery_id = NULL, last_update_time = ? "
+    "WHERE current_status != 'offline' AND last_update_time < ? "
+    "RETURNING unit_id")
+_SQL_ANY_UNIT_STALE = "SELECT 1 FROM units WHERE current_status != 'offline' AND last_update_time < ? LIMIT 1" # idx_units_offline
+# Status updates. The SQL text depends only on the target status, so it is built once here: no string
+# assembly per call, and every call with the same target hits the same statement-cache entry.
+_SQL_SET_UNIT_STATUS = "UPDATE units SET current_status = ?, last_update_time = ? WHERE unit_id = ?"
+_SQL_SET_UNIT_STATUS_CLEAR = "UPDATE units SET current_status = ?, last_update_time = ?, assigned_delivery_id = NULL WHERE unit_id = ?"
+_SQL_SET_UNIT_STATUS_ASSIGN = "UPDATE units SET current_status = ?, last_update_time = ?, assigned_delivery_id = ? WHERE unit_id = ?"
+# Extra column set with each delivery status (failed takes the failure reason, the rest a timestamp)
+_DELIVERY_STATUS_COLUMN = {'assigned': 'assigned_time', 'en_route': 'enroute_time', 'arrived': 'arrived_time',
+                           'completed': 'completion_time', 'failed': 'failure_reason'}
+def _delivery_status_sql(new_status, return_row):
+    """Transition-checked UPDATE for one target status. Parameters: status, now, [column value], id, *allowed_prev."""
+    sql_parts = ["status = ?", "last_update_time = ?"]
+    if new_status in _DELIVERY_STATUS_COLUMN: sql_parts.append(f"{_DELIVERY_STATUS_COLUMN[new_status]} = ?")
+    if new_status in ('pending', 'geocoding'): # Re-opened: clear the previous attempt
+        sql_parts.extend(["assigned_unit_id = NULL", "assigned_time = NULL", "enroute_time = NULL", "arrived_time = NULL", "completion_time = NULL", "failure_reason = NULL"])
+    allowed_prev = DELIVERY_ALLOWED_PREV[new_status]
+    return (f"UPDATE deliveries SET {', '.join(sql_parts)} WHERE id = ? AND status IN ({','.join('?' * len(allowed_prev))}) "
+            f"RETURNING {'*' if return_row else 'id'}")
+_SQL_UPDATE_DELIVERY_STATUS = {(status, return_row): _delivery_status_sql(status, return_row)
+                               for status, prev in DELIVERY_ALLOWED_PREV.items() if prev for return_row in (False, True)}
+# /api/state: both lists serialized by SQLite in one statement (JSON1, built in since 3.38)
+_STATE_DELIVERY_COLUMNS = ('id', 'address', 'latitude', 'longitude', 'status', 'assigned_unit_id', 'failure_reason', 'creation_time',
+                           'assigned_time', 'enroute_time', 'arrived_time', 'completion_time', 'last_update_time')
+_STATE_UNIT_COLUMNS = ('unit_id', 'meshtastic_node_id', 'last_latitude', 'last_longitude', 'last_location_time',
+                       'current_status', 'assigned_delivery_id', 'last_update_time')
+# Times are stored as epoch ms but the HTTP API returns ISO 8601 UTC strings (see api_row for the Python side)
+_API_TIME_SQL = "strftime('%Y-%m-%dT%H:%M:%f', {col} / 1000.0, 'unixepoch') || '+00:00'"
+def _json_object_sql(columns):
+    return "json_object(" + ", ".join(f"'{col}', {_API_TIME_SQL.format(col=col) if col.endswith('_time') else col}" for col in columns) + ")"
+_SQL_GET_STATE_SNAPSHOT_JSON = (
+    "WITH d AS (SELECT * FROM deliveries ORDER BY creation_time DESC), u AS (SELECT * FROM units ORDER BY unit_id) "
+    f"SELECT json_object('deliveries', (SELECT json_group_array({_json_object_sql(_STATE_DELIVERY_COLUMNS)}) FROM d), "
+    f"'units', (SELECT json_group_array({_json_object_sql(_STATE_UNIT_COLUMNS)}) FROM u))")
+_SQL_GET_GEOCODE = "SELECT lat, lon FROM geocode_cache WHERE address = ?"
+_SQL_PUT_GEOCODE = "INSERT OR REPLACE INTO geocode_cache (address, lat, lon, ts) VALUES (?,?,?,?)"
+_SQL_GET_ACTIVE_DELIVERY_FOR_UNIT = (
+    "SELECT d.* FROM deliveries d JOIN units u ON d.assigned_unit_id = u.unit_id "
+    "WHERE u.unit_id = ? AND d.status NOT IN ('completed', 'failed') ORDER BY d.creation_time DESC LIMIT 1")
+_SQL_ADD_PENDING_ACK = (
+    "INSERT INTO pending_assignment_acks (msg_id, delivery_id, unit_id, destination_node_id, payload_json, sent_time, retry_count, status, last_update_time) "
+    "VALUES (?, ?, ?, ?, ?, ?, 0, 'pending', ?)")
+_SQL_GET_PENDING_ACK = "SELECT * FROM pending_assignment_acks WHERE msg_id = ?"
+# Only 'pending' rows move: a late ACK can't resurrect a failed assignment, and a timeout can't undo an ACK
+_SQL_BUMP_PENDING_ACK_RETRY = ("UPDATE pending_assignment_acks SET retry_count = retry_count + 1, sent_time = ?, last_update_time = ? "
+                               "WHERE msg_id = ? AND status = 'pending'")
+_SQL_SET_PENDING_ACK_STATUS = "UPDATE pending_assignment_acks SET status = ?, last_update_time = ? WHERE msg_id = ? AND status = 'pending'"
+_SQL_GET_PENDING_ACKS_FOR_RESTART = "SELECT msg_id, sent_time, retry_count FROM pending_assignment_acks WHERE status = 'pending'"
+
+# Max ids bound into one "IN (...)" list; stays under SQLite's legacy 999-variable limit
+IN_CLAUSE_CHUNK = 500
+
 # --- Helper Functions ---
-def _now_utc_iso():
-    """Returns the current time in UTC ISO format string."""
-    return datetime.now(timezone.utc).isoformat()
+def _now_epoch_ms():
+    """Returns the current time as integer Unix epoch milliseconds (UTC)."""
+    return int(time.time() * 1000)
+
+def to_epoch_ms(value):
+    """Normalizes a timestamp (epoch ms int, datetime or ISO 8601 string, e.g. from a unit's GPS) to epoch ms."""
+    if value is None or isinstance(value, int): return value
+    if isinstance(value, float): return int(value)
+    try:
+        dt = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc) # Stored times are always UTC
+        return int(dt.timestamp() * 1000)
+    except ValueError:
+        logger.warning("Could not parse timestamp '%s'. Using current UTC.", value)
+        return _now_epoch_ms()
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def api_row(row):
+    """Copy of a delivery/unit row for the HTTP API: *_time columns (epoch ms) become ISO 8601 UTC strings,
+    e.g. 2025-01-31T12:34:56.123+00:00 - the same format the /api/state snapshot builds in SQL."""
+    return {key: (_EPOCH + timedelta(milliseconds=value)).isoformat(timespec='milliseconds')
+                 if key.endswith('_time') and isinstance(value, int) else value
+            for key, value in row.items()}
+
+def _dict_row_factory(cursor, row):
+    """Row factory building plain dicts directly, for list endpoints that serialize every row."""
+    return dict(zip([col[0] for col in cursor.description], row))
 
 def _validate_state_transition(current_state, new_state, valid_transitions):
     """Checks if a state transition is allowed."""
     allowed_next_states = valid_transitions.get(current_state)
     if allowed_next_states is None:
-        logger.error(f"State transition error: Current state '{current_state}' has no defined transitions.")
+        logger.error("State transition error: Current state '%s' has no defined transitions.", current_state)
         return False, f"Current state '{current_state}' invalid or undefined"
     if new_state not in allowed_next_states:
-        logger.warning(f"Invalid state transition: Cannot move from '{current_state}' to '{new_state}'. Allowed: {allowed_next_states}")
+        logger.warning("Invalid state transition: Cannot move from '%s' to '%s'. Allowed: %s", current_state, new_state, allowed_next_states)
         return False, f"Cannot transition from '{current_state}' to '{new_state}'"
     return True, "Transition valid"
 
 # --- Database Connection ---
-def get_db_connection():
-    """Establishes a connection to the SQLite database, enabling WAL mode."""
+def get_db_connection(read_only=False):
+    """Establishes a connection to the SQLite database, enabling WAL mode and tuning pragmas.
+    read_only=True opens the file with mode=ro: it never takes the write lock and keeps its own page cache."""
     try:
-        conn = sqlite3.connect(config.DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, timeout=10)
+        # check_same_thread=False only so close_connections() can close handles at exit;
+        # each cached handle is otherwise used exclusively by the thread that opened it.
+        database = f"file:{config.DATABASE_PATH}?mode=ro" if read_only else config.DATABASE_PATH
+        conn = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, timeout=10,
+                               check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE, uri=read_only)
         conn.row_factory = sqlite3.Row
-        try:
-             conn.execute("PRAGMA journal_mode=WAL;")
-             logger.debug("SQLite journal_mode set to WAL.")
-        except sqlite3.Error as wal_e:
-             logger.warning(f"Could not enable WAL mode for SQLite: {wal_e}")
+        if not read_only: # journal_mode is persistent in the file; a read-only handle can't (and needn't) set it
+            try:
+                 conn.execute("PRAGMA journal_mode=WAL;")
+                 logger.debug("SQLite journal_mode set to WAL.")
+            except sqlite3.Error as wal_e:
+                 logger.warning("Could not enable WAL mode for SQLite: %s", wal_e)
+        for pragma in CONNECTION_PRAGMAS:
+            try:
+                conn.execute(pragma)
+            except sqlite3.Error as pragma_e: # Older SQLite builds may reject some pragmas
+                logger.warning("Could not apply '%s': %s", pragma, pragma_e)
         conn.execute("PRAGMA foreign_keys = ON;")
         return conn
     except sqlite3.Error as e:
-        logger.error(f"Database connection error: {e}", exc_info=True)
+        logger.error("Database connection error: %s", e, exc_info=True)
         raise
 
+# --- Per-Thread Connection Cache ---
+# Each thread gets one read-write handle (all writes) and, lazily, one read-only handle
+# for the SELECT-only helpers, so readers never contend with the writer under WAL.
+_thread_local = threading.local()
+_open_connections = {} # { (thread, read_only): conn } - lets us close handles of exited threads / at exit
+_open_connections_lock = threading.Lock()
+
+def _get_thread_conn(attr, read_only):
+    conn = getattr(_thread_local, attr, None)
+    if conn is None:
+        conn = get_db_connection(read_only=read_only)
+        setattr(_thread_local, attr, conn)
+        current = threading.current_thread()
+        with _open_connections_lock:
+            # Short-lived threads (e.g. ACK timers) would otherwise leak their handles
+            for key in [k for k in _open_connections if not k[0].is_alive()]:
+                try: _open_connections.pop(key).close()
+                except sqlite3.Error: pass
+            _open_connections[(current, read_only)] = conn
+    return conn
+
+def get_conn():
+    """Returns this thread's long-lived connection, opening it (pragmas applied once) on first use.
+    Use as `with get_conn() as conn:` - the context manager commits/rolls back but does not close."""
+    return _get_thread_conn('conn', False)
+
+def _get_ro_conn():
+    """Returns this thread's long-lived read-only connection (SELECT-only helpers).
+    The database must already exist (initialize_database) - mode=ro will not create it."""
+    return _get_thread_conn('ro_conn', True)
+
+def close_connections():
+    """Closes all cached per-thread connections. Registered to run at interpreter exit."""
+    _cancel_periodic_optimize()
+    with _open_connections_lock:
+        for (thread, read_only), conn in _open_connections.items():
+            try:
+                if not read_only: conn.execute("PRAGMA optimize;") # Cheap; only re-analyzes tables whose stats drifted
+                conn.close()
+            except sqlite3.Error as e: logger.warning("Error closing cached DB connection: %s", e)
+        _open_connections.clear()
+    _thread_local.__dict__.pop('conn', None)
+    _thread_local.__dict__.pop('ro_conn', None)
+
+atexit.register(close_connections)
+
+@contextlib.contextmanager
+def _transaction(conn=None, immediate=False):
+    """Yields conn if the caller passed one (the caller owns the transaction and its commit), otherwise
+    this thread's connection in a transaction committed on exit. immediate=True takes the write lock up front."""
+    if conn is not None:
+        yield conn
+        return
+    with get_conn() as own_conn:
+        if immediate: own_conn.execute("BEGIN IMMEDIATE")
+        yield own_conn
+
+def transaction(immediate=True):
+    """Context manager yielding this thread's connection inside one transaction (BEGIN IMMEDIATE by default),
+    committed on exit. Pass the yielded conn to helpers taking conn= so several updates share one commit."""
+    return _transaction(immediate=immediate)
+
+# --- Query Planner Maintenance ---
+_optimize_timer = None
+_optimize_timer_lock = threading.Lock()
+
+def run_optimize():
+    """Runs PRAGMA optimize on a short-lived connection to refresh sqlite_stat1 as tables grow."""
+    try:
+        conn = get_db_connection()
+        try: conn.execute("PRAGMA optimize;")
+        finally: conn.close()
+        logger.debug("PRAGMA optimize completed.")
+    except sqlite3.Error as e:
+        logger.warning("PRAGMA optimize failed: %s", e)
+
+def _periodic_optimize():
+    run_optimize()
+    _schedule_periodic_optimize()
+
+def _schedule_periodic_optimize():
+    """(Re)arms the background optimize timer. Daemon, so it never blocks shutdown."""
+    global _optimize_timer
+    with _optimize_timer_lock:
+        if _optimize_timer is not None and _optimize_timer.is_alive() and _optimize_timer is not threading.current_thread(): return
+        _optimize_timer = threading.Timer(config.DB_OPTIMIZE_INTERVAL_SECONDS, _periodic_optimize)
+        _optimize_timer.daemon = True
+        _optimize_timer.start()
+
+def _cancel_periodic_optimize():
+    global _optimize_timer
+    with _optimize_timer_lock:
+        if _optimize_timer is not None: _optimize_timer.cancel()
+        _optimize_timer = None
+
 # --- Schema Initialization ---
-def initialize_database():
-    """Creates the database tables if they don't exist."""
-    logger.info(f"Initializing database at: {config.DATABASE_PATH}")
+# All *_time columns are INTEGER Unix epoch milliseconds (UTC). {table} lets the
+# migration below build a replacement table under a temporary name.
+_TABLE_SCHEMAS = (
+    ('units', '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            unit_id TEXT PRIMARY KEY,
+            meshtastic_node_id TEXT UNIQUE,
+            last_latitude REAL,
+            last_longitude REAL,
+            last_location_time INTEGER, -- Epoch ms UTC
+            current_status TEXT DEFAULT 'offline',
+            assigned_delivery_id INTEGER,
+            last_update_time INTEGER -- Epoch ms UTC
+        )
+    ''', ('last_location_time', 'last_update_time')),
+    ('deliveries', '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            address TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            assigned_unit_id TEXT,
+            failure_reason TEXT,
+            creation_time INTEGER NOT NULL, -- Epoch ms UTC
+            assigned_time INTEGER, -- Epoch ms UTC
+            enroute_time INTEGER, -- Epoch ms UTC
+            arrived_time INTEGER, -- Epoch ms UTC
+            completion_time INTEGER, -- Epoch ms UTC
+            last_update_time INTEGER, -- Epoch ms UTC
+            FOREIGN KEY (assigned_unit_id) REFERENCES units (unit_id) ON DELETE SET NULL
+        )
+    ''', ('creation_time', 'assigned_time', 'enroute_time', 'arrived_time', 'completion_time', 'last_update_time')),
+    ('pending_assignment_acks', '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            msg_id TEXT PRIMARY KEY,
+            delivery_id INTEGER NOT NULL,
+            unit_id TEXT NOT NULL,
+            destination_node_id TEXT NOT NULL,
+            payload_json TEXT NOT NULL, -- Store the sent payload
+            sent_time INTEGER NOT NULL,     -- Epoch ms UTC
+            retry_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending', -- pending, acked, failed
+            last_update_time INTEGER NOT NULL, -- Epoch ms UTC
+            FOREIGN KEY (delivery_id) REFERENCES deliveries (id) ON DELETE CASCADE,
+            FOREIGN KEY (unit_id) REFERENCES units (unit_id) ON DELETE CASCADE
+        )
+    ''', ('sent_time', 'last_update_time')),
+    ('geocode_cache', '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            address TEXT PRIMARY KEY,
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            ts INTEGER NOT NULL -- Epoch ms UTC, when the provider returned it
+        )
+    ''', ('ts',)),
+)
+
+def _migrate_iso_times_to_epoch_ms(conn):
+    """One-shot rebuild of tables still declaring TEXT (ISO 8601) time columns.
+    A column's declared affinity can't be changed in place (an int written to a TEXT column is
+    stored as text), so each table is copied into a new INTEGER-typed one, per SQLite's ALTER TABLE recipe."""
+    legacy = [(table, ddl, time_cols) for table, ddl, time_cols in _TABLE_SCHEMAS
+              if any(col['name'] == time_cols[-1] and col['type'].upper() == 'TEXT'
+                     for col in conn.execute(f"PRAGMA table_info({table})"))]
+    if not legacy: return
+    logger.info("Migrating ISO timestamp columns to epoch ms: %s", ', '.join(t for t, _, _ in legacy))
+    now_ms = _now_epoch_ms()
+    conn.commit()
+    conn.execute("PRAGMA foreign_keys = OFF;") # Must be outside the transaction; children are re-checked below
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            # Units Table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS units (
-                    unit_id TEXT PRIMARY KEY,
-                    meshtastic_node_id TEXT UNIQUE,
-                    last_latitude REAL,
-                    last_longitude REAL,
-                    last_location_time TEXT, -- ISO Format UTC
-                    current_status TEXT DEFAULT 'offline',
-                    assigned_delivery_id INTEGER,
-                    last_update_time TEXT -- ISO Format UTC
-                )
-            ''')
-            # Deliveries Table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS deliveries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    address TEXT NOT NULL,
-                    latitude REAL,
-                    longitude REAL,
-                    status TEXT NOT NULL DEFAULT 'pending',
-                    assigned_unit_id TEXT,
-                    failure_reason TEXT,
-                    creation_time TEXT NOT NULL, -- ISO Format UTC
-                    assigned_time TEXT, -- ISO Format UTC
-                    enroute_time TEXT, -- ISO Format UTC
-                    arrived_time TEXT, -- ISO Format UTC
-                    completion_time TEXT, -- ISO Format UTC
-                    last_update_time TEXT, -- ISO Format UTC
-                    FOREIGN KEY (assigned_unit_id) REFERENCES units (unit_id) ON DELETE SET NULL
-                )
-            ''')
-            # Pending ACKs Table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_assignment_acks (
-                    msg_id TEXT PRIMARY KEY,
-                    delivery_id INTEGER NOT NULL,
-                    unit_id TEXT NOT NULL,
-                    destination_node_id TEXT NOT NULL,
-                    payload_json TEXT NOT NULL, -- Store the sent payload
-                    sent_time TEXT NOT NULL,     -- ISO Format UTC
-                    retry_count INTEGER NOT NULL DEFAULT 0,
-                    status TEXT NOT NULL DEFAULT 'pending', -- pending, acked, failed
-                    last_update_time TEXT NOT NULL, -- ISO Format UTC
-                    FOREIGN KEY (delivery_id) REFERENCES deliveries (id) ON DELETE CASCADE,
-                    FOREIGN KEY (unit_id) REFERENCES units (unit_id) ON DELETE CASCADE
-                )
-            ''')
-            # Indexes
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_delivery_status ON deliveries (status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_unit_status ON units (current_status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_ack_status ON pending_assignment_acks (status)')
+        conn.execute("BEGIN IMMEDIATE")
+        for table, ddl, time_cols in legacy:
+            columns = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            select_list = []
+            for col in columns:
+                if col['name'] not in time_cols: select_list.append(col['name']); continue
+                # julianday() keeps sub-second precision and honours the +00:00 offset; NULL if unparseable
+                expr = f"CAST(ROUND((julianday({col['name']}) - 2440587.5) * 86400000) AS INTEGER)"
+                select_list.append(f"COALESCE({expr}, {now_ms})" if col['notnull'] else expr)
+            column_names = ", ".join(col['name'] for col in columns)
+            conn.execute(ddl.format(table=f"{table}_new"))
+            conn.execute(f"INSERT INTO {table}_new ({column_names}) SELECT {', '.join(select_list)} FROM {table}")
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+        if violations: raise sqlite3.IntegrityError(f"Foreign key violations after time column migration: {len(violations)}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON;")
+    logger.info("Timestamp migration complete.")
+
+# Indexes (re-run after a table rebuild, which drops them)
+_INDEX_SCRIPT = '''
+    CREATE INDEX IF NOT EXISTS idx_delivery_status ON deliveries (status);
+    CREATE INDEX IF NOT EXISTS idx_unit_status ON units (current_status);
+    CREATE INDEX IF NOT EXISTS idx_pending_ack_status ON pending_assignment_acks (status);
+    -- Partial index matching the offline sweep's WHERE exactly; only non-offline units are indexed
+    CREATE INDEX IF NOT EXISTS idx_units_offline ON units (last_update_time) WHERE current_status != 'offline';
+    -- Active-delivery lookup by unit (get_delivery_by_unit) without scanning deliveries
+    CREATE INDEX IF NOT EXISTS idx_deliv_assigned_unit ON deliveries (assigned_unit_id, status, creation_time DESC);
+    -- Delivery lists (/api/state, get_all_deliveries) walk this in order instead of sorting the whole table
+    CREATE INDEX IF NOT EXISTS idx_deliv_creation ON deliveries (creation_time DESC);
+'''
+_SCHEMA_SCRIPT = ";\n".join(ddl.format(table=table) for table, ddl, _ in _TABLE_SCHEMAS) + ";\n" + _INDEX_SCRIPT
+
+# Stored in PRAGMA user_version. Bump whenever _SCHEMA_SCRIPT changes (and add the upgrade step below).
+# 0 = new or pre-versioning database, 1 = epoch-ms time columns + geocode_cache + sweep/lookup indexes,
+# 2 = creation_time index for the ordered delivery lists.
+SCHEMA_VERSION = 2
 
-            conn.commit()
+def initialize_database():
+    """Creates/upgrades the schema unless PRAGMA user_version says it is current, then warms connections."""
+    logger.info("Initializing database at: %s", config.DATABASE_PATH)
+    try:
+        with get_conn() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == SCHEMA_VERSION:
+                logger.debug("Schema version %s is current; skipping DDL.", version)
+            else:
+                logger.info("Upgrading schema from version %s to %s", version, SCHEMA_VERSION)
+                conn.executescript(_SCHEMA_SCRIPT) # One C-level call; CREATE ... IF NOT EXISTS throughout
+                _migrate_iso_times_to_epoch_ms(conn)
+                conn.executescript(_INDEX_SCRIPT)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute('PRAGMA optimize;')
+        _get_ro_conn() # Pre-warm this thread's read handle (needs the file to exist)
+        _schedule_periodic_optimize()
         logger.info("Database initialized successfully.")
     except sqlite3.Error as e:
-        logger.error(f"Database initialization error: {e}", exc_info=True)
+        logger.error("Database initialization error: %s", e, exc_info=True)
         raise
 
 # --- Delivery Functions ---
-def add_delivery(address, latitude, longitude):
-    """Adds a new delivery to the database."""
-    logger.debug(f"Adding delivery: {address} at ({latitude}, {longitude})")
-    sql = ''' INSERT INTO deliveries(address, latitude, longitude, status, creation_time, last_update_time)
-              VALUES(?,?,?,?,?,?) '''
-    now = _now_utc_iso()
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(sql, (address, latitude, longitude, 'pending', now, now))
-            conn.commit()
-            logger.info(f"Delivery added with ID: {cursor.lastrowid}")
-            return cursor.lastrowid
+def add_delivery(address, latitude, longitude, status='pending'):
+    """Adds a new delivery to the database. Returns the new row as a dict (from RETURNING, no re-read), or None.
+    status='geocoding' creates it without coordinates; set_delivery_geocoded() releases it as 'pending'."""
+    logger.debug("Adding delivery: %s at (%s, %s)", address, latitude, longitude)
+    now = _now_epoch_ms()
+    try:
+        with get_conn() as conn:
+            delivery = dict(conn.execute(_SQL_INSERT_DELIVERY, (address, latitude, longitude, status, now, now)).fetchone())
+        logger.info("Delivery added with ID: %s", delivery['id'])
+        return delivery
     except sqlite3.Error as e:
-        logger.error(f"Failed to add delivery for {address}: {e}")
+        logger.error("Failed to add delivery for %s: %s", address, e)
         return None
 
+# Rows per multi-row INSERT statement; 6 params per row stays under SQLite's legacy 999-variable limit
+BULK_INSERT_CHUNK_ROWS = 150
+
+def add_deliveries_bulk(rows):
+    """Adds many deliveries in a single transaction (e.g. CSV import).
+    rows: iterable of (address, latitude, longitude). Returns the new IDs in input order, or None on failure."""
+    now = _now_epoch_ms()
+    params = [(address, latitude, longitude, 'pending', now, now) for address, latitude, longitude in rows]
+    if not params: return []
+    logger.debug("Bulk adding %s deliveries", len(params))
+    try:
+        new_ids = []
+        with get_conn() as conn:
+            for start in range(0, len(params), BULK_INSERT_CHUNK_ROWS):
+                chunk = params[start:start + BULK_INSERT_CHUNK_ROWS]
+                values_clause = ",".join(["(?,?,?,?,?,?)"] * len(chunk))
+                # Full chunks always produce the same text, so only the final partial chunk is a cache miss
+                # RETURNING yields every new ID from the same statement (sorted: RETURNING order is unspecified)
+                cursor = conn.execute(f"INSERT INTO deliveries(address, latitude, longitude, status, creation_time, last_update_time) VALUES {values_clause} RETURNING id",
+                                      [value for row in chunk for value in row])
+                new_ids.extend(sorted(row['id'] for row in cursor.fetchall()))
+        logger.info("Bulk added %s deliveries.", len(new_ids))
+        return new_ids
+    except sqlite3.Error as e:
+        logger.error("Failed to bulk add %s deliveries: %s", len(params), e)
+        return None
+
+def set_delivery_geocoded(delivery_id, latitude, longitude):
+    """Stores the coordinates of a 'geocoding' delivery and moves it to 'pending'. Returns True if a row was updated."""
+    try:
+        with get_conn() as conn:
+            updated = conn.execute(_SQL_SET_GEOCODED_LOCATION, (latitude, longitude, _now_epoch_ms(), delivery_id)).rowcount == 1
+        if updated: logger.info("Delivery %s geocoded to (%s, %s).", delivery_id, latitude, longitude)
+        return updated
+    except sqlite3.Error as e:
+        logger.error("Failed to store geocoded location for delivery %s: %s", delivery_id, e)
+        return False
+
+def get_geocoding_deliveries():
+    """Returns [{'id', 'address'}] for deliveries still waiting on geocoding (e.g. after a restart)."""
+    try:
+        with _get_ro_conn() as conn:
+            return [dict(row) for row in conn.execute(_SQL_GET_GEOCODING_DELIVERIES)]
+    except sqlite3.Error as e:
+        logger.error("Failed to get deliveries awaiting geocoding: %s", e)
+        return []
+
 def get_delivery(delivery_id):
     """Retrieves a specific delivery by its ID."""
-    logger.debug(f"Getting delivery ID: {delivery_id}")
+    logger.debug("Getting delivery ID: %s", delivery_id)
     try:
-        with get_db_connection() as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM deliveries WHERE id = ?", (delivery_id,))
+            cursor.execute(_SQL_GET_DELIVERY, (delivery_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
     except sqlite3.Error as e:
-        logger.error(f"Failed to get delivery {delivery_id}: {e}")
+        logger.error("Failed to get delivery %s: %s", delivery_id, e)
         return None
 
+def get_delivery_status(delivery_id):
+    """Returns just the status of a delivery (None if not found) - avoids pulling the full row."""
+    try:
+        with _get_ro_conn() as conn:
+            row = conn.execute(_SQL_GET_DELIVERY_STATUS, (delivery_id,)).fetchone()
+            return row['status'] if row else None
+    except sqlite3.Error as e:
+        logger.error("Failed to get status of delivery %s: %s", delivery_id, e)
+        return None
+
+def list_deliveries_for_map():
+    """Retrieves only the columns needed to plot deliveries (id, address, position, status, unit)."""
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _dict_row_factory
+            return cursor.execute(_SQL_LIST_DELIVERIES_FOR_MAP).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Failed to list deliveries for map: %s", e)
+        return []
+
 def get_all_deliveries():
-    """Retrieves all deliveries."""
+    """Retrieves all deliveries (full rows; see list_deliveries_for_map for the narrow variant)."""
     # No filter applied here by default, UI handles filtering display
-    logger.debug(f"Getting all deliveries")
-    sql = "SELECT * FROM deliveries ORDER BY creation_time DESC"
+    logger.debug("Getting all deliveries")
     try:
-        with get_db_connection() as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            cursor.row_factory = _dict_row_factory # Rows come out as dicts: one pass, no sqlite3.Row list
+            return cursor.execute(_SQL_GET_ALL_DELIVERIES).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Failed to get deliveries: {e}")
+        logger.error("Failed to get deliveries: %s", e)
         return []
 
-def update_delivery_status(delivery_id, new_status, failure_reason=None, timestamp=None):
-    """Updates the status and corresponding timestamp of a delivery, validating the transition."""
-    logger.info(f"Attempting delivery {delivery_id} status update to {new_status}")
+def update_delivery_status(delivery_id, new_status, failure_reason=None, timestamp=None, conn=None, return_row=False):
+    """Updates the status and corresponding timestamp of a delivery, validating the transition.
+    Pass conn to run inside the caller's transaction (no commit here).
+    return_row=True returns (success, message, row): the updated row comes back from the UPDATE itself."""
+    logger.info("Attempting delivery %s status update to %s", delivery_id, new_status)
     if new_status not in VALID_DELIVERY_STATUSES:
-        logger.error(f"Invalid target status '{new_status}' for delivery {delivery_id}")
-        return False, f"Invalid target status '{new_status}'"
-    now = timestamp if timestamp else _now_utc_iso()
+        logger.error("Invalid target status '%s' for delivery %s", new_status, delivery_id)
+        success, message, row = False, f"Invalid target status '{new_status}'", None
+    else:
+        success, message, row = _update_delivery_status(delivery_id, new_status, failure_reason, timestamp, conn, return_row)
+    return (success, message, row) if return_row else (success, message)
+
+def _update_delivery_status(delivery_id, new_status, failure_reason, timestamp, conn, return_row):
+    """update_delivery_status body; always returns (success, message, row-or-None)."""
+    now = to_epoch_ms(timestamp) if timestamp else _now_epoch_ms()
     try:
-        with get_db_connection() as conn:
+        with _transaction(conn) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT status FROM deliveries WHERE id = ?", (delivery_id,))
-            row = cursor.fetchone()
-            if not row: return False, "Delivery not found"
-            current_status = row['status']
-
-            is_valid, reason = _validate_state_transition(current_status, new_status, DELIVERY_TRANSITIONS)
-            if not is_valid:
-                if new_status == current_status: return True, "Already in target status"
-                else: return False, reason
-
-            sql_parts = ["status = ?", "last_update_time = ?"]
-            params = [new_status, now]
-            if new_status == 'assigned': sql_parts.append("assigned_time = ?"); params.append(now)
-            elif new_status == 'en_route': sql_parts.append("enroute_time = ?"); params.append(now)
-            elif new_status == 'arrived': sql_parts.append("arrived_time = ?"); params.append(now)
-            elif new_status == 'completed': sql_parts.append("completion_time = ?"); params.append(now)
-            elif new_status == 'failed': sql_parts.append("failure_reason = ?"); params.append(failure_reason if failure_reason else "Unknown")
-            if new_status == 'pending':
-                sql_parts.extend(["assigned_unit_id = NULL", "assigned_time = NULL", "enroute_time = NULL", "arrived_time = NULL", "completion_time = NULL", "failure_reason = NULL"])
-
-            sql = f"UPDATE deliveries SET {', '.join(sql_parts)} WHERE id = ?"
-            params.append(delivery_id)
-            cursor.execute(sql, tuple(params))
-            if cursor.rowcount == 0: return False, "Update failed unexpectedly"
-            conn.commit()
-            logger.info(f"Delivery {delivery_id} status updated successfully to {new_status}.")
-            return True, "Update successful"
+            # Transition rule is enforced by the WHERE clause, so the common success path is one statement
+            sql = _SQL_UPDATE_DELIVERY_STATUS.get((new_status, return_row))
+            updated = None
+            if sql:
+                params = [new_status, now]
+                if new_status == 'failed': params.append(failure_reason if failure_reason else "Unknown")
+                elif new_status in _DELIVERY_STATUS_COLUMN: params.append(now)
+                params.append(delivery_id); params.extend(DELIVERY_ALLOWED_PREV[new_status])
+                updated = next(iter(cursor.execute(sql, params).fetchall()), None) # id is the PK: 0 or 1 rows
+            if updated is None:
+                # Rejected: one extra read to tell "not found" from "bad transition"
+                row = cursor.execute(_SQL_GET_DELIVERY if return_row else _SQL_GET_DELIVERY_STATUS, (delivery_id,)).fetchone()
+                if not row: return False, "Delivery not found", None
+                current_status = row['status']
+                if new_status == current_status: return True, "Already in target status", dict(row) if return_row else None
+                if (current_status, new_status) in _DELIVERY_EDGES: return False, "Update failed unexpectedly", None
+                return False, _validate_state_transition(current_status, new_status, DELIVERY_TRANSITIONS)[1], None
+            logger.info("Delivery %s status updated successfully to %s.", delivery_id, new_status)
+            return True, "Update successful", dict(updated) if return_row else None
     except sqlite3.Error as e:
-        logger.error(f"DB error updating delivery {delivery_id} status: {e}", exc_info=True)
-        return False, "Database error"
+        logger.error("DB error updating delivery %s status: %s", delivery_id, e, exc_info=True)
+        return False, "Database error", None
     except Exception as e:
-        logger.error(f"Unexpected error updating delivery {delivery_id} status: {e}", exc_info=True)
-        return False, "Unexpected error"
-
-def assign_delivery_to_unit(delivery_id, unit_id):
-    """Assigns a delivery to a unit, validating transitions."""
-    logger.info(f"Attempting assignment: Delivery {delivery_id} to Unit {unit_id}")
-    now = _now_utc_iso()
+        logger.error("Unexpected error updating delivery %s status: %s", delivery_id, e, exc_info=True)
+        return False, "Unexpected error", None
+
+def _describe_assignment_failure(conn, delivery_id, unit_id):
+    """Explains why the guarded assignment UPDATEs matched no row (failure path only)."""
+    delivery_row = conn.execute(_SQL_GET_DELIVERY_ASSIGNABLE, (delivery_id,)).fetchone()
+    if not delivery_row: return "Delivery not found"
+    if (delivery_row['status'], 'assigned') not in _DELIVERY_EDGES:
+        return f"Cannot assign delivery: {_validate_state_transition(delivery_row['status'], 'assigned', DELIVERY_TRANSITIONS)[1]}"
+    if not delivery_row['has_coords']: return "Cannot assign delivery: it has no coordinates (address not geocoded)"
+    unit_row = conn.execute(_SQL_GET_UNIT_STATUS, (unit_id,)).fetchone()
+    if not unit_row: return "Unit not found"
+    if unit_row['current_status'] != 'idle': return f"Unit not idle (status: {unit_row['current_status']})"
+    return "Assignment failed: status changed concurrently"
+
+def assign_delivery_to_unit(delivery_id, unit_id, return_row=False):
+    """Assigns a delivery to a unit in one transaction; state preconditions are enforced by the UPDATE WHERE clauses.
+    return_row=True returns (success, message, {'latitude', 'longitude', 'address'}) straight from the UPDATE."""
+    success, message, row = _assign_delivery_to_unit(delivery_id, unit_id)
+    return (success, message, row) if return_row else (success, message)
+
+def _assign_delivery_to_unit(delivery_id, unit_id):
+    """assign_delivery_to_unit body; always returns (success, message, row-or-None)."""
+    logger.info("Attempting assignment: Delivery %s to Unit %s", delivery_id, unit_id)
+    now = _now_epoch_ms()
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            # Validate Delivery
-            cursor.execute("SELECT status FROM deliveries WHERE id = ?", (delivery_id,))
-            delivery_row = cursor.fetchone()
-            if not delivery_row: return False, "Delivery not found"
-            valid_del, reason_del = _validate_state_transition(delivery_row['status'], 'assigned', DELIVERY_TRANSITIONS)
-            if not valid_del: return False, f"Cannot assign delivery: {reason_del}"
-            # Validate Unit
-            cursor.execute("SELECT current_status FROM units WHERE unit_id = ?", (unit_id,))
-            unit_row = cursor.fetchone()
-            if not unit_row: return False, "Unit not found"
-            if unit_row['current_status'] != 'idle': return False, f"Unit not idle (status: {unit_row['current_status']})"
-            valid_unit, reason_unit = _validate_state_transition(unit_row['current_status'], 'assigned', UNIT_TRANSITIONS)
-            if not valid_unit: return False, f"Cannot assign unit: {reason_unit}" # Should pass if idle
-
-            # Perform Updates
-            cursor.execute("UPDATE deliveries SET assigned_unit_id = ?, status = ?, assigned_time = ?, last_update_time = ? WHERE id = ? AND status = ?",
-                           (unit_id, 'assigned', now, now, delivery_id, delivery_row['status']))
-            if cursor.rowcount == 0: conn.rollback(); return False, "Failed to update delivery (race condition?)"
-            cursor.execute("UPDATE units SET assigned_delivery_id = ?, current_status = ?, last_update_time = ? WHERE unit_id = ? AND current_status = ?",
-                           (delivery_id, 'assigned', now, now, unit_id, unit_row['current_status']))
-            if cursor.rowcount == 0: conn.rollback(); return False, "Failed to update unit (race condition?)"
-            conn.commit()
-            logger.info(f"Successfully assigned delivery {delivery_id} to unit {unit_id}")
-            return True, "Assignment successful"
+        # Take the write lock up front so the two UPDATEs can't hit a read->write upgrade deadlock
+        with _transaction(immediate=True) as conn:
+            # pending -> assigned (delivery), idle -> assigned (unit) are the only valid edges here
+            # Unit first: if it doesn't exist the delivery UPDATE would trip the assigned_unit_id foreign key
+            delivery_row = None
+            if conn.execute(_SQL_ASSIGN_UNIT, (delivery_id, now, unit_id)).rowcount == 1:
+                # RETURNING hands back what send_assignment needs: no get_delivery() afterwards
+                delivery_row = next(iter(conn.execute(_SQL_ASSIGN_DELIVERY, (unit_id, now, now, delivery_id)).fetchall()), None)
+            if delivery_row is None:
+                conn.rollback()
+                return False, _describe_assignment_failure(conn, delivery_id, unit_id), None
+        logger.info("Successfully assigned delivery %s to unit %s", delivery_id, unit_id)
+        return True, "Assignment successful", dict(delivery_row)
     except sqlite3.Error as e:
-        logger.error(f"DB error during assignment: {e}", exc_info=True)
-        return False, "Database error during assignment"
+        logger.error("DB error during assignment: %s", e, exc_info=True)
+        return False, "Database error during assignment", None
     except Exception as e:
-        logger.error(f"Unexpected error during assignment: {e}", exc_info=True)
-        return False, "Unexpected error during assignment"
+        logger.error("Unexpected error during assignment: %s", e, exc_info=True)
+        return False, "Unexpected error during assignment", None
 
 # --- Unit Functions ---
-def upsert_unit(unit_id, meshtastic_node_id=None, latitude=None, longitude=None, location_time=None, status=None, last_update_time=None):
-    """Adds/updates a unit. Ensures status is valid if provided."""
-    logger.debug(f"Upserting unit: {unit_id}")
-    now = last_update_time if last_update_time else _now_utc_iso()
+def _unit_upsert_params(unit_id, meshtastic_node_id=None, latitude=None, longitude=None, location_time=None, status=None, last_update_time=None):
+    """Builds the _SQL_UPSERT_UNIT parameters. Omitted fields bind NULL, so the UPSERT's COALESCEs keep the stored value."""
+    now = to_epoch_ms(last_update_time) if last_update_time else _now_epoch_ms()
     if status and status not in VALID_UNIT_STATUSES:
-         logger.error(f"Attempted upsert unit {unit_id} with invalid status '{status}'. Ignoring status.")
+         logger.error("Attempted upsert unit %s with invalid status '%s'. Ignoring status.", unit_id, status)
          status = None # Don't use invalid status
-    # Determine effective status (provided, current, or default 'offline')
-    current_db_status = None
-    if not status:
-         existing = get_unit(unit_id)
-         if existing: current_db_status = existing['current_status']
-    effective_status = status if status else current_db_status if current_db_status else 'offline'
-    # Prepare fields and params (similar logic as before, ensure effective_status used)
-    fields_to_update = {"last_update_time": now}
-    if status and status != current_db_status: fields_to_update["current_status"] = status
-    if meshtastic_node_id: fields_to_update["meshtastic_node_id"] = meshtastic_node_id
-    if latitude is not None: fields_to_update["last_latitude"] = latitude
-    if longitude is not None: fields_to_update["last_longitude"] = longitude
-    if location_time: fields_to_update["last_location_time"] = location_time
-    set_clause = ", ".join([f"{key} = :{key}" for key in fields_to_update])
-    params = fields_to_update; params["unit_id"] = unit_id
-    sql = f''' INSERT INTO units (unit_id, meshtastic_node_id, last_latitude, last_longitude, last_location_time, current_status, last_update_time)
-               VALUES(:unit_id, :mnid, :lat, :lon, :loctime, :defstat, :lut)
-               ON CONFLICT(unit_id) DO UPDATE SET {set_clause} '''
-    insert_params = {"unit_id": unit_id, "mnid": fields_to_update.get("meshtastic_node_id"), "lat": fields_to_update.get("last_latitude"),
-                     "lon": fields_to_update.get("last_longitude"), "loctime": fields_to_update.get("last_location_time"),
-                     "defstat": effective_status, "lut": now}
-    params.update(insert_params)
-    try:
-        with get_db_connection() as conn:
-            conn.execute(sql, params)
+    return {"unit_id": unit_id, "mnid": meshtastic_node_id or None, "lat": latitude, "lon": longitude,
+            "loctime": to_epoch_ms(location_time) if location_time else None, "status": status or None, "lut": now}
+
+def upsert_unit(unit_id, meshtastic_node_id=None, latitude=None, longitude=None, location_time=None, status=None, last_update_time=None):
+    """Adds/updates a unit. Ensures status is valid if provided."""
+    logger.debug("Upserting unit: %s", unit_id)
+    # New rows default to 'offline' when no status is given
+    params = _unit_upsert_params(unit_id, meshtastic_node_id, latitude, longitude, location_time, status, last_update_time)
+    try:
+        with get_conn() as conn:
+            conn.execute(_SQL_UPSERT_UNIT, params)
             conn.commit()
-            logger.debug(f"Unit {unit_id} upserted successfully.")
+            logger.debug("Unit %s upserted successfully.", unit_id)
             return True
     except sqlite3.IntegrityError as e:
-         logger.error(f"Integrity error upserting unit {unit_id} (duplicate node ID?): {e}")
+         logger.error("Integrity error upserting unit %s (duplicate node ID?): %s", unit_id, e)
          return False
     except sqlite3.Error as e:
-        logger.error(f"DB error upserting unit {unit_id}: {e}", exc_info=True)
+        logger.error("DB error upserting unit %s: %s", unit_id, e, exc_info=True)
         return False
     except Exception as e:
-        logger.error(f"Unexpected error upserting unit {unit_id}: {e}", exc_info=True)
+        logger.error("Unexpected error upserting unit %s: %s", unit_id, e, exc_info=True)
+        return False
+
+def upsert_units_bulk(updates):
+    """Upserts many units in one transaction (write-behind flushes).
+    updates: iterable of dicts with upsert_unit's keyword arguments. Returns True if every row was written."""
+    params = [_unit_upsert_params(**update) for update in updates]
+    if not params: return True
+    try:
+        with get_conn() as conn:
+            conn.executemany(_SQL_UPSERT_UNIT, params)
+        logger.debug("Bulk upserted %s units.", len(params))
+        return True
+    except sqlite3.IntegrityError as e:
+        # One bad row (e.g. duplicate node ID) rolls back the batch; fall back to per-row so the rest still land
+        logger.warning("Integrity error in bulk unit upsert (%s); retrying %s rows individually.", e, len(params))
+        return all([upsert_unit(**update) for update in updates])
+    except sqlite3.Error as e:
+        logger.error("DB error bulk upserting %s units: %s", len(params), e, exc_info=True)
         return False
 
 def get_unit(unit_id):
     """Retrieves a specific unit by its ID."""
     # ... (logic remains same) ...
-    logger.debug(f"Getting unit ID: {unit_id}")
+    logger.debug("Getting unit ID: %s", unit_id)
     try:
-        with get_db_connection() as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM units WHERE unit_id = ?", (unit_id,))
+            cursor.execute(_SQL_GET_UNIT, (unit_id,))
             row = cursor.fetchone()
             return dict(row) if row else None
     except sqlite3.Error as e:
-        logger.error(f"Failed to get unit {unit_id}: {e}")
+        logger.error("Failed to get unit %s: %s", unit_id, e)
         return None
 
 
@@ -326,131 +723,256 @@ def get_all_units():
     # ... (logic remains same) ...
     logger.debug("Getting all units")
     try:
-        with get_db_connection() as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM units ORDER BY unit_id")
-            rows = cursor.fetchall()
-            return [dict(row) for row in rows]
+            cursor.row_factory = _dict_row_factory # Rows come out as dicts: one pass, no sqlite3.Row list
+            return cursor.execute(_SQL_GET_ALL_UNITS).fetchall()
     except sqlite3.Error as e:
-        logger.error(f"Failed to get units: {e}")
+        logger.error("Failed to get units: %s", e)
         return []
 
 
+def get_state_snapshot_json():
+    """Returns {"deliveries": [...], "units": [...]} as a JSON string built by SQLite in one read,
+    ready to send as-is. Returns None on error."""
+    try:
+        with _get_ro_conn() as conn:
+            return conn.execute(_SQL_GET_STATE_SNAPSHOT_JSON).fetchone()[0]
+    except sqlite3.OperationalError as e: # SQLite built without JSON1: same payload from the two list queries
+        logger.warning("JSON state snapshot unavailable (%s); falling back to separate queries.", e)
+        return orjson.dumps({"deliveries": [api_row(row) for row in get_all_deliveries()],
+                             "units": [api_row(row) for row in get_all_units()]}).decode('utf-8')
+    except sqlite3.Error as e:
+        logger.error("Failed to get state snapshot: %s", e)
+        return None
+
+
 def update_unit_location(unit_id, latitude, longitude, location_time):
     """Updates the location and timestamp for a specific unit."""
     # ... (logic remains same, ensure logger usage) ...
-    logger.debug(f"Updating location for unit {unit_id}: ({latitude}, {longitude})")
-    now = _now_utc_iso()
-    sql = ''' UPDATE units
-              SET last_latitude = ?, last_longitude = ?, last_location_time = ?, last_update_time = ?
-              WHERE unit_id = ? '''
+    logger.debug("Updating location for unit %s: (%s, %s)", unit_id, latitude, longitude)
+    now = _now_epoch_ms()
     try:
-        with get_db_connection() as conn:
+        with get_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(sql, (latitude, longitude, location_time, now, unit_id))
+            cursor.execute(_SQL_UPDATE_UNIT_LOCATION, (latitude, longitude, to_epoch_ms(location_time), now, unit_id))
             conn.commit()
             if cursor.rowcount == 0:
-                logger.warning(f"No unit {unit_id} found to update location. Consider upserting.")
+                logger.warning("No unit %s found to update location. Consider upserting.", unit_id)
             return True
     except sqlite3.Error as e:
-        logger.error(f"Failed to update location for unit {unit_id}: {e}")
+        logger.error("Failed to update location for unit %s: %s", unit_id, e)
         return False
 
 
-def update_unit_status(unit_id, new_status, assigned_delivery_id=None, timestamp=None, reason=None): # Added reason for error state
-    """Updates the status of a unit, validating the transition."""
+def update_unit_status(unit_id, new_status, assigned_delivery_id=None, timestamp=None, reason=None, conn=None): # Added reason for error state
+    """Updates the status of a unit, validating the transition.
+    Pass conn to run inside the caller's transaction (no commit here)."""
     # Reason parameter might be useful if new_status is 'error'
-    logger.info(f"Attempting unit {unit_id} status update to {new_status}")
+    logger.info("Attempting unit %s status update to %s", unit_id, new_status)
     if new_status not in VALID_UNIT_STATUSES:
-        logger.error(f"Invalid target status '{new_status}' for unit {unit_id}")
+        logger.error("Invalid target status '%s' for unit %s", new_status, unit_id)
         return False, f"Invalid target status '{new_status}'"
-    now = timestamp if timestamp else _now_utc_iso()
+    now = to_epoch_ms(timestamp) if timestamp else _now_epoch_ms()
     try:
-        with get_db_connection() as conn:
+        with _transaction(conn) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT current_status, assigned_delivery_id FROM units WHERE unit_id = ?", (unit_id,))
+            cursor.execute(_SQL_GET_UNIT_STATE, (unit_id,))
             row = cursor.fetchone()
             if not row: return False, "Unit not found"
             current_status = row['current_status']
 
-            is_valid, validation_reason = _validate_state_transition(current_status, new_status, UNIT_TRANSITIONS)
-            if not is_valid:
+            if (current_status, new_status) not in _UNIT_EDGES:
                  if new_status == current_status: # Allow idempotent update
                       # Just update timestamp
-                      conn.execute("UPDATE units SET last_update_time = ? WHERE unit_id = ?", (now, unit_id))
-                      conn.commit()
+                      conn.execute(_SQL_TOUCH_UNIT, (now, unit_id))
                       return True, "Already in target status"
-                 else: return False, validation_reason
+                 else: return False, _validate_state_transition(current_status, new_status, UNIT_TRANSITIONS)[1]
 
-            sql_parts = ["current_status = ?", "last_update_time = ?"]
-            params = [new_status, now]
-            if new_status in ['idle', 'offline', 'error']:
-                sql_parts.append("assigned_delivery_id = NULL") # Clear assignment
+            if new_status in ('idle', 'offline', 'error'): # Clear assignment
+                cursor.execute(_SQL_SET_UNIT_STATUS_CLEAR, (new_status, now, unit_id))
             elif new_status == 'assigned' and assigned_delivery_id is not None:
-                sql_parts.append("assigned_delivery_id = ?"); params.append(assigned_delivery_id)
-            # Keep assignment for en_route, arrived_dest, returning
-
-            sql = f"UPDATE units SET {', '.join(sql_parts)} WHERE unit_id = ?"
-            params.append(unit_id)
-            cursor.execute(sql, tuple(params))
+                cursor.execute(_SQL_SET_UNIT_STATUS_ASSIGN, (new_status, now, assigned_delivery_id, unit_id))
+            else: # Keep assignment for en_route, arrived_dest, returning
+                cursor.execute(_SQL_SET_UNIT_STATUS, (new_status, now, unit_id))
             if cursor.rowcount == 0: return False, "Update failed unexpectedly"
-            conn.commit()
-            logger.info(f"Unit {unit_id} status updated successfully to {new_status}.")
+            logger.info("Unit %s status updated successfully to %s.", unit_id, new_status)
             return True, "Update successful"
     except sqlite3.Error as e:
-        logger.error(f"DB error updating unit {unit_id} status: {e}", exc_info=True)
+        logger.error("DB error updating unit %s status: %s", unit_id, e, exc_info=True)
         return False, "Database error"
     except Exception as e:
-        logger.error(f"Unexpected error updating unit {unit_id} status: {e}", exc_info=True)
+        logger.error("Unexpected error updating unit %s status: %s", unit_id, e, exc_info=True)
         return False, "Unexpected error"
 
 
-# --- Pending ACK Functions (add_pending_ack, get_pending_ack, update_pending_ack_retry, update_pending_ack_status, get_all_pending_acks_for_restart) ---
-# ... (Implementations from previous step are correct) ...
+# --- Pending ACK Functions ---
+def _pending_ack_from_row(row):
+    """Row -> dict, with the stored payload decoded back to the dict that was sent."""
+    pending = dict(row)
+    pending['payload'] = orjson.loads(pending.pop('payload_json')) # Parses the stored str without the json module's pure-Python overhead
+    return pending
+
+def add_pending_ack(msg_id, delivery_id, unit_id, destination_node_id, payload):
+    """Records an assignment awaiting ACK (before it is sent). Returns False if it couldn't be stored."""
+    now = _now_epoch_ms()
+    try:
+        with get_conn() as conn:
+            conn.execute(_SQL_ADD_PENDING_ACK, (msg_id, delivery_id, unit_id, destination_node_id, orjson.dumps(payload).decode('utf-8'), now, now)) # TEXT column
+        logger.debug("Stored pending ACK %s (delivery %s -> unit %s).", msg_id, delivery_id, unit_id)
+        return True
+    except sqlite3.IntegrityError as e:
+        logger.warning("Could not store pending ACK %s (duplicate msg_id or missing delivery/unit): %s", msg_id, e)
+        return False
+    except sqlite3.Error as e:
+        logger.error("DB error storing pending ACK %s: %s", msg_id, e, exc_info=True)
+        return False
+
+def get_pending_ack(msg_id):
+    """Returns the pending-ACK record (payload decoded) for msg_id, or None."""
+    try:
+        with _get_ro_conn() as conn:
+            row = conn.execute(_SQL_GET_PENDING_ACK, (msg_id,)).fetchone()
+            return _pending_ack_from_row(row) if row else None
+    except (sqlite3.Error, ValueError) as e:
+        logger.error("Failed to get pending ACK %s: %s", msg_id, e)
+        return None
+
+def get_pending_acks_in(msg_ids):
+    """Fetches many pending-ACK records in one query per IN_CLAUSE_CHUNK ids. Returns {msg_id: record}."""
+    msg_ids = list(msg_ids)
+    found = {}
+    try:
+        with _get_ro_conn() as conn:
+            for start in range(0, len(msg_ids), IN_CLAUSE_CHUNK):
+                chunk = msg_ids[start:start + IN_CLAUSE_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                for row in conn.execute(f"SELECT * FROM pending_assignment_acks WHERE msg_id IN ({placeholders})", chunk):
+                    found[row['msg_id']] = _pending_ack_from_row(row)
+        return found
+    except (sqlite3.Error, ValueError) as e:
+        logger.error("Failed to get %s pending ACKs: %s", len(msg_ids), e)
+        return {}
+
+def update_pending_ack_retry(msg_id):
+    """Counts a resend of a still-pending assignment and restarts its sent_time. Returns True if updated."""
+    now = _now_epoch_ms()
+    try:
+        with get_conn() as conn:
+            return conn.execute(_SQL_BUMP_PENDING_ACK_RETRY, (now, now, msg_id)).rowcount > 0
+    except sqlite3.Error as e:
+        logger.error("Failed to update retry count for pending ACK %s: %s", msg_id, e)
+        return False
+
+def update_pending_acks_retry_bulk(msg_ids):
+    """update_pending_ack_retry for many ids in one transaction. Returns the set of msg_ids actually updated."""
+    msg_ids = list(msg_ids)
+    if not msg_ids: return set()
+    now = _now_epoch_ms()
+    updated = set()
+    try:
+        with get_conn() as conn:
+            for start in range(0, len(msg_ids), IN_CLAUSE_CHUNK):
+                chunk = msg_ids[start:start + IN_CLAUSE_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = conn.execute("UPDATE pending_assignment_acks SET retry_count = retry_count + 1, sent_time = ?, last_update_time = ? "
+                                      f"WHERE status = 'pending' AND msg_id IN ({placeholders}) RETURNING msg_id", [now, now, *chunk])
+                updated.update(row['msg_id'] for row in cursor.fetchall())
+        return updated
+    except sqlite3.Error as e:
+        logger.error("Failed to bulk update retry count for %s pending ACKs: %s", len(msg_ids), e)
+        return set()
+
+def update_pending_ack_status(msg_id, new_status, conn=None):
+    """Resolves a pending assignment ('acked' or 'failed'). Returns True only if it was still pending.
+    Pass conn to run inside the caller's transaction (no commit here)."""
+    if new_status not in ('acked', 'failed'):
+        logger.error("Invalid pending ACK status '%s' for %s", new_status, msg_id)
+        return False
+    try:
+        with _transaction(conn) as conn:
+            updated = conn.execute(_SQL_SET_PENDING_ACK_STATUS, (new_status, _now_epoch_ms(), msg_id)).rowcount > 0
+        if not updated: logger.debug("Pending ACK %s not updated to %s (unknown or already resolved).", msg_id, new_status)
+        return updated
+    except sqlite3.Error as e:
+        logger.error("Failed to set pending ACK %s to %s: %s", msg_id, new_status, e)
+        return False
+
+def get_all_pending_acks_for_restart():
+    """Returns msg_id/sent_time/retry_count for every unresolved assignment (startup timer restore)."""
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _dict_row_factory
+            return cursor.execute(_SQL_GET_PENDING_ACKS_FOR_RESTART).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Failed to load pending ACKs for restart: %s", e)
+        return []
 
 # --- Offline Check ---
-def check_and_update_offline_units():
-    """Finds units that haven't updated recently and marks them as offline."""
-    offline_threshold = datetime.now(timezone.utc) - timedelta(seconds=config.UNIT_OFFLINE_TIMEOUT_SECONDS)
-    offline_threshold_str = offline_threshold.isoformat()
+def check_and_update_offline_units(conn=None):
+    """Marks units that haven't updated recently as offline and fails their active deliveries.
+    Set-based: one UPDATE per table in a single BEGIN IMMEDIATE transaction (one commit per sweep;
+    UPDATE ... RETURNING needs SQLite 3.35+). Sweeps with no stale unit stop after one indexed read.
+    Pass conn to join the caller's transaction instead."""
+    now = _now_epoch_ms()
+    offline_threshold = now - config.UNIT_OFFLINE_TIMEOUT_SECONDS * 1000
     updated_count = 0
     failed_delivery_count = 0
-    logger.debug(f"Checking for units offline since {offline_threshold_str}")
+    logger.debug("Checking for units silent for over %ss", config.UNIT_OFFLINE_TIMEOUT_SECONDS)
     try:
-        with get_db_connection() as conn: # Use separate connection? Maybe not needed with WAL.
-            cursor = conn.cursor()
-            cursor.execute("SELECT unit_id, current_status, last_update_time, assigned_delivery_id FROM units WHERE current_status != 'offline' AND last_update_time < ?", (offline_threshold_str,))
-            units_to_mark_offline = cursor.fetchall()
-            if not units_to_mark_offline: return
-
-            for unit_row in units_to_mark_offline:
-                 unit_id = unit_row['unit_id']; current_status = unit_row['current_status']; assigned_del_id = unit_row['assigned_delivery_id']
-                 logger.warning(f"Unit {unit_id} (Status: {current_status}, Last: {unit_row['last_update_time']}) offline. Marking offline.")
-                 success, _ = update_unit_status(unit_id, 'offline', timestamp=offline_threshold_str)
-                 if success:
-                      updated_count += 1
-                      # Fail the active delivery associated with this unit
-                      if assigned_del_id:
-                           delivery = get_delivery(assigned_del_id) # Fetch the specific delivery
-                           if delivery and delivery['status'] not in ['completed', 'failed']:
-                                logger.warning(f"Unit {unit_id} went offline. Failing active delivery #{assigned_del_id}.")
-                                fail_success, _ = update_delivery_status(assigned_del_id, 'failed', failure_reason=f"Unit {unit_id} went offline")
-                                if fail_success: failed_delivery_count += 1
-    except sqlite3.Error as e: logger.error(f"DB error during offline unit check: {e}", exc_info=True)
-    except Exception as e: logger.error(f"Unexpected error during offline unit check: {e}", exc_info=True)
-    if updated_count > 0: logger.info(f"Marked {updated_count} units as offline. Failed {failed_delivery_count} associated active deliveries.")
+        if conn is None: # Usual sweep finds nothing: answer that from the partial index without taking the write lock
+            with _get_ro_conn() as ro_conn:
+                if ro_conn.execute(_SQL_ANY_UNIT_STALE, (offline_threshold,)).fetchone() is None: return
+        with _transaction(conn, immediate=True) as conn:
+            # Fail the active deliveries held by stale units first - once the units are marked
+            # offline their assigned_delivery_id is cleared (RETURNING only sees new values).
+            # Any non-final delivery state may go to 'failed' (see DELIVERY_TRANSITIONS).
+            failed_rows = conn.execute(_SQL_FAIL_OFFLINE_DELIVERIES, (now, offline_threshold)).fetchall()
+            # Every unit state may transition to 'offline' (see UNIT_TRANSITIONS), so no per-row validation needed
+            offline_units = conn.execute(_SQL_MARK_UNITS_OFFLINE, (offline_threshold, offline_threshold)).fetchall()
+        updated_count = len(offline_units)
+        failed_delivery_count = len(failed_rows)
+        for unit_row in offline_units:
+             logger.warning("Unit %s has not reported in over %ss. Marked offline.", unit_row['unit_id'], config.UNIT_OFFLINE_TIMEOUT_SECONDS)
+        for row in failed_rows:
+             logger.warning("Unit %s went offline. Failed active delivery #%s.", row['assigned_unit_id'], row['id'])
+    except sqlite3.Error as e: logger.error("DB error during offline unit check: %s", e, exc_info=True)
+    except Exception as e: logger.error("Unexpected error during offline unit check: %s", e, exc_info=True)
+    if updated_count > 0: logger.info("Marked %s units as offline. Failed %s associated active deliveries.", updated_count, failed_delivery_count)
 
 # --- Helper to find active delivery ---
 def get_delivery_by_unit(unit_id):
      """Finds the currently active (non-completed/failed) delivery for a unit."""
      # ... (Implementation is correct) ...
-     logger.debug(f"Getting active delivery for unit {unit_id}")
+     logger.debug("Getting active delivery for unit %s", unit_id)
      try:
-         with get_db_connection() as conn:
+         with _get_ro_conn() as conn:
              cursor = conn.cursor()
-             cursor.execute("SELECT d.* FROM deliveries d JOIN units u ON d.assigned_unit_id = u.unit_id WHERE u.unit_id = ? AND d.status NOT IN ('completed', 'failed') ORDER BY d.creation_time DESC LIMIT 1", (unit_id,))
+             cursor.execute(_SQL_GET_ACTIVE_DELIVERY_FOR_UNIT, (unit_id,))
              row = cursor.fetchone()
              return dict(row) if row else None
      except sqlite3.Error as e:
-         logger.error(f"Failed to get active delivery for unit {unit_id}: {e}")
+         logger.error("Failed to get active delivery for unit %s: %s", unit_id, e)
          return None
+
+# --- Geocode Cache ---
+def get_cached_geocode(address):
+    """Returns the cached (latitude, longitude) for an address, or None if it was never geocoded."""
+    try:
+        with _get_ro_conn() as conn:
+            row = conn.execute(_SQL_GET_GEOCODE, (address,)).fetchone()
+            return (row['lat'], row['lon']) if row else None
+    except sqlite3.Error as e:
+        logger.error("Failed to read geocode cache for '%s': %s", address, e)
+        return None
+
+def cache_geocode(address, latitude, longitude):
+    """Stores a successful provider result so later lookups of the same address skip the network."""
+    try:
+        with get_conn() as conn:
+            conn.execute(_SQL_PUT_GEOCODE, (address, latitude, longitude, _now_epoch_ms()))
+        return True
+    except sqlite3.Error as e:
+        logger.error("Failed to cache geocode for '%s': %s", address, e)
+        return False
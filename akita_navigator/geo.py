@@ -0,0 +1,77 @@
+# akita_navigator/geo.py - Distance helpers for the delivery unit
+# Copyright (C) 2025 Akita Engineering <http://www.akitaengineering.com>
+# Licensed under GPLv3. See LICENSE file for details.
+
+import math
+
+EARTH_RADIUS_M = 6371000 # Mean Earth radius in meters
+
+def point_terms(lat, lon):
+    """Precomputes (phi, lambda, cos_phi) for a fixed target point. Pass the tuple to the functions below."""
+    phi = math.radians(lat)
+    return phi, math.radians(lon), math.cos(phi)
+
+def bbox_terms(lat, lon, meters):
+    """Precomputes a lat/lon box around a target that contains every point within `meters` of it.
+    A 1% margin covers the ellipsoid-vs-sphere difference of the ECEF check."""
+    angle = min(meters * 1.01 / EARTH_RADIUS_M, math.pi / 2)
+    ratio = math.sin(angle) / max(math.cos(math.radians(lat)), 1e-12)
+    lon_eps = math.degrees(math.asin(ratio)) if ratio < 1 else 180.0 # Box spans all longitudes near the poles
+    return lat, lon, math.degrees(angle), lon_eps
+
+def outside_bbox(lat, lon, box):
+    """True if the point is certainly outside the radius used for bbox_terms(): two subtractions, no trig."""
+    lat0, lon0, lat_eps, lon_eps = box
+    if abs(lat - lat0) > lat_eps: return True
+    return abs((lon - lon0 + 180.0) % 360.0 - 180.0) > lon_eps # Wrap across the antimeridian
+
+def radius_threshold(meters):
+    """Converts a radius in meters to the haversine 'a' term at that distance, for within_radius()."""
+    return math.sin(meters / (2 * EARTH_RADIUS_M)) ** 2
+
+def _haversine_a(lat, lon, target):
+    """The 'a' term of the Haversine formula: sin^2 of half the central angle to the target."""
+    phi2, lam2, cos_phi2 = target
+    phi1 = math.radians(lat)
+    delta_phi = phi2 - phi1
+    delta_lambda = lam2 - math.radians(lon)
+    return math.sin(delta_phi / 2)**2 + math.cos(phi1) * cos_phi2 * math.sin(delta_lambda / 2)**2
+
+def haversine(lat, lon, target):
+    """Calculate distance in meters from a point to a precomputed target using Haversine formula."""
+    a = _haversine_a(lat, lon, target)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return EARTH_RADIUS_M * c
+
+def within_radius(lat, lon, target, threshold):
+    """True if the point is within the radius (see radius_threshold) of a precomputed target.
+    'a' grows monotonically with distance, so comparing it skips atan2 and both square roots."""
+    return _haversine_a(lat, lon, target) <= threshold
+
+# --- WGS84 ECEF ---
+# gpsd reports ecefx/ecefy/ecefz with most receivers; comparing in that space needs no trig per fix.
+_WGS84_A = 6378137.0 # Semi-major axis (m)
+_WGS84_E2 = 6.69437999014e-3 # First eccentricity squared
+_MAX_VERTICAL_OFFSET_M = 10000 # Terrain + geoid height; rejects points on the far side of the Earth
+
+def latlon_to_ecef(lat, lon, h=0):
+    """Converts WGS84 latitude/longitude/ellipsoid height to ECEF (x, y, z) in meters."""
+    phi = math.radians(lat); lam = math.radians(lon)
+    sin_phi, cos_phi = math.sin(phi), math.cos(phi)
+    n = _WGS84_A / math.sqrt(1 - _WGS84_E2 * sin_phi * sin_phi)
+    return ((n + h) * cos_phi * math.cos(lam), (n + h) * cos_phi * math.sin(lam), (n * (1 - _WGS84_E2) + h) * sin_phi)
+
+def ecef_terms(lat, lon):
+    """Precomputes a target's ECEF position on the ellipsoid and its local 'up' unit vector."""
+    phi = math.radians(lat); lam = math.radians(lon)
+    up = (math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi))
+    return latlon_to_ecef(lat, lon), up
+
+def within_radius_ecef(ecef, target, radius_sq):
+    """True if an ECEF fix is within sqrt(radius_sq) meters of a target from ecef_terms(), measured
+    horizontally: the fix's height above the target (altitude, geoid separation) is projected out."""
+    (tx, ty, tz), (ux, uy, uz) = target
+    dx = ecef[0] - tx; dy = ecef[1] - ty; dz = ecef[2] - tz
+    vertical = dx * ux + dy * uy + dz * uz
+    if abs(vertical) > _MAX_VERTICAL_OFFSET_M: return False
+    return dx * dx + dy * dy + dz * dz - vertical * vertical <= radius_sq
@@ -2,48 +2,94 @@
 # Copyright (C) 2025 Akita Engineering <http://www.akitaengineering.com>
 # Licensed under GPLv3. See LICENSE file for details.
 
-import geocoder
+import requests
 import logging
 import config
 import time
-# from requests.exceptions import RequestException, Timeout, ConnectionError # Optional specific imports
+import threading
+import functools
+import queue
+from requests.exceptions import RequestException
+from . import database
 
 logger = logging.getLogger(__name__)
 
+# --- HTTP Session ---
+# One keep-alive session for all lookups: repeat requests reuse the TCP/TLS connection to Nominatim.
+_session = requests.Session()
+_session.headers.update({"User-Agent": config.GEOCODER_USER_AGENT}) # Required by the Nominatim usage policy
+
+# Nominatim allows at most 1 request/second per client; serialize across threads (web requests, bulk imports)
+_rate_lock = threading.Lock()
+_last_request_time = 0.0
+
+class _CacheMiss(Exception):
+    """Raised inside the LRU layer so misses are never memoized."""
+
+def _normalize_address(address):
+    """Cache key for an address: case and runs of whitespace don't change where it is."""
+    return " ".join(address.split()).lower()
+
+@functools.lru_cache(maxsize=config.GEOCODER_CACHE_SIZE)
+def _cached_geocode(address_key):
+    """Process-local LRU over the persistent geocode_cache table (keyed by _normalize_address)."""
+    cached = database.get_cached_geocode(address_key)
+    if cached is None: raise _CacheMiss(address_key)
+    return cached
+
+def _nominatim_search(address):
+    """Single rate-limited search request. Returns the parsed JSON result list."""
+    global _last_request_time
+    with _rate_lock:
+        wait = config.GEOCODER_MIN_INTERVAL_SECONDS - (time.monotonic() - _last_request_time)
+        if wait > 0: time.sleep(wait)
+        try:
+            response = _session.get(config.GEOCODER_URL, params={"q": address, "format": "json", "limit": 1},
+                                    timeout=config.GEOCODER_TIMEOUT_SECONDS)
+        finally:
+            _last_request_time = time.monotonic()
+    response.raise_for_status()
+    return response.json()
+
 def geocode_address(address):
-    """Geocodes an address string with retry logic."""
-    logger.info(f"Geocoding address: '{address}' using provider: {config.GEOCODER_PROVIDER}")
-    if not address:
+    """Geocodes an address string, serving repeats from cache, with retry logic."""
+    if not address or not address.strip():
         logger.error("Geocode attempt failed: Address is empty.")
         return None, None
+    address = address.strip()
+    address_key = _normalize_address(address)
+    try:
+        latitude, longitude = _cached_geocode(address_key)
+        logger.info(f"Geocode cache hit for '{address}': ({latitude}, {longitude})")
+        return latitude, longitude
+    except _CacheMiss:
+        pass
+    logger.info(f"Geocoding address: '{address}' using provider: {config.GEOCODER_PROVIDER}")
 
     for attempt in range(config.GEOCODER_RETRIES):
         try:
-            # Delay before request (especially for OSM)
-            # Apply delay even on first attempt to respect global rate limits
-            delay = config.GEOCODER_RETRY_BASE_DELAY_SECONDS * (2 ** attempt) # Exponential backoff (starts at base delay)
-            time.sleep(delay)
-
-            g = geocoder.osm(address) # Assuming OSM based on config default
-            # TODO: Add dynamic provider selection based on config.GEOCODER_PROVIDER if needed
+            # Back off between retries only: the first request goes out immediately and
+            # nothing sleeps after the last failure. Retry n waits BASE * 2**(n-1): 1s, 2s, 4s...
+            if attempt > 0:
+                delay = config.GEOCODER_RETRY_BASE_DELAY_SECONDS * (2 ** (attempt - 1))
+                logger.debug(f"Waiting {delay}s before geocoding retry {attempt + 1}")
+                time.sleep(delay)
 
-            if g.ok:
-                latitude = g.latlng[0]
-                longitude = g.latlng[1]
+            results = _nominatim_search(address)
+            if results:
+                latitude = float(results[0]['lat'])
+                longitude = float(results[0]['lon'])
                 logger.info(f"Geocoding successful (Attempt {attempt + 1}/{config.GEOCODER_RETRIES}): ({latitude}, {longitude})")
+                database.cache_geocode(address_key, latitude, longitude)
                 return latitude, longitude
             else:
-                logger.warning(f"Geocoding attempt {attempt + 1} failed for '{address}'. Status: {g.status}")
-                if g.status == "ZERO_RESULTS":
-                     logger.error(f"Zero results found for '{address}'. No retries needed.")
-                     return None, None
-                # Continue to retry for other errors (like OVER_QUERY_LIMIT, network issues)
-
-        except ImportError:
-             logger.error("Geocoder library not found. Install 'geocoder'.")
-             return None, None # Cannot retry
-        # except (RequestException, Timeout, ConnectionError) as e: # Catch specific network errors if requests is direct dependency
-        #      logger.warning(f"Network error during geocoding attempt {attempt + 1}: {e}")
+                logger.error(f"Zero results found for '{address}'. No retries needed.")
+                return None, None
+
+        except RequestException as e: # Network errors, timeouts, HTTP 429/5xx - worth retrying
+            logger.warning(f"Geocoding attempt {attempt + 1} failed for '{address}': {e}")
+        except (ValueError, KeyError, IndexError) as e:
+            logger.warning(f"Unexpected response during geocoding attempt {attempt + 1} for '{address}': {e}")
         except Exception as e:
             logger.warning(f"Unexpected error during geocoding attempt {attempt + 1} for '{address}': {e}")
 
@@ -51,3 +97,56 @@ def geocode_address(address):
 
     logger.error(f"Geocoding failed for address '{address}' after {config.GEOCODER_RETRIES} attempts.")
     return None, None
+
+def get_cached_coordinates(address):
+    """Returns (latitude, longitude) if the address is already cached (memory or DB), else (None, None). Never hits the network."""
+    if not address or not address.strip(): return None, None
+    try: return _cached_geocode(_normalize_address(address))
+    except _CacheMiss: return None, None
+
+def geocode_many(addresses):
+    """Geocodes a batch of addresses (e.g. bulk import) over the shared keep-alive session.
+    Returns {address: (latitude, longitude)}; failures map to (None, None). Cached addresses cost no request."""
+    results = {}; by_key = {}
+    for address in addresses:
+        if address in results: continue
+        key = _normalize_address(address) if address else address
+        if key not in by_key: by_key[key] = geocode_address(address) # Spelling variants share one lookup
+        results[address] = by_key[key]
+    return results
+
+# --- Background Geocoding ---
+# New deliveries whose address isn't cached are stored as 'geocoding' and resolved here, so the
+# HTTP request never waits on Nominatim. One worker is enough: requests are rate-limited to 1/s anyway.
+_geocode_jobs = queue.SimpleQueue()
+_geocode_worker = None
+_geocode_worker_lock = threading.Lock()
+
+def _geocode_worker_loop():
+    while True:
+        delivery_id, address = _geocode_jobs.get()
+        try:
+            latitude, longitude = geocode_address(address)
+            if latitude is None or longitude is None:
+                database.update_delivery_status(delivery_id, 'failed', failure_reason=f"Geocoding failed for: {address}")
+            elif not database.set_delivery_geocoded(delivery_id, latitude, longitude):
+                logger.warning(f"Delivery {delivery_id} left 'geocoding' before its coordinates arrived; not updated.")
+        except Exception as e:
+            logger.error(f"Background geocoding failed for delivery {delivery_id}: {e}", exc_info=True)
+
+def geocode_delivery_async(delivery_id, address):
+    """Queues geocoding for a delivery created in 'geocoding' state. The worker stores the
+    coordinates (delivery -> 'pending') or marks the delivery 'failed'."""
+    global _geocode_worker
+    with _geocode_worker_lock:
+        if _geocode_worker is None or not _geocode_worker.is_alive():
+            _geocode_worker = threading.Thread(target=_geocode_worker_loop, name="GeocodeWorker", daemon=True)
+            _geocode_worker.start()
+    _geocode_jobs.put((delivery_id, address))
+
+def resume_pending_geocodes():
+    """Re-queues deliveries left in 'geocoding' state by a previous run. Returns how many were queued."""
+    pending = database.get_geocoding_deliveries()
+    for row in pending: geocode_delivery_async(row['id'], row['address'])
+    if pending: logger.info(f"Resumed geocoding for {len(pending)} deliveries.")
+    return len(pending)
@@ -2,97 +2,153 @@
 # Copyright (C) 2025 Akita Engineering <http://www.akitaengineering.com>
 # Licensed under GPLv3. See LICENSE file for details.
 
-import gpsd
 import logging
 import time
+import re
+import socket
+import threading
+import orjson
 from datetime import datetime, timezone
 
+import config
+
 logger = logging.getLogger(__name__)
-_gpsd_connected = False
+
+# Canonical gpsd TPV time, e.g. 2025-01-31T12:34:56.000Z
+_GPSD_TS_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?Z$')
+_UTC = timezone.utc
+_WATCH_COMMAND = b'?WATCH={"enable":true,"json":true}\n'
+_RECONNECT_DELAY_SECONDS = 5
+
+def _parse_gpsd_ts(ts):
+    """Converts a gpsd time string to an ISO UTC string, or None if it can't be parsed."""
+    match = _GPSD_TS_RE.match(ts)
+    if match:
+        year, month, day, hour, minute, second, frac = match.groups()
+        micro = int(frac.ljust(6, '0')) if frac else 0
+        try: return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), micro, _UTC).isoformat()
+        except ValueError: return None
+    try: # Non-canonical format (offset instead of Z, etc.)
+        return datetime.fromisoformat(ts.replace('Z', '+00:00')).astimezone(_UTC).isoformat()
+    except ValueError:
+        return None
+
+# --- Streaming Reader ---
+class _GpsReader(threading.Thread):
+    """Subscribes to gpsd's JSON stream and keeps the latest TPV fix; reconnects on errors."""
+    def __init__(self, host, port):
+        super().__init__(name="GpsdReader", daemon=True)
+        self.host = host
+        self.port = port
+        self.connected = threading.Event()
+        self.latest = None # (location_dict, received_monotonic) - rebound whole, never mutated
+        self.last_mode = 0
+        self._stop_event = threading.Event()
+        self._sock = None
+
+    def run(self):
+        logger.info(f"Starting gpsd reader ({self.host}:{self.port})...")
+        while not self._stop_event.is_set():
+            try:
+                self._stream()
+            except (OSError, ValueError) as e:
+                if self._stop_event.is_set(): break
+                logger.error(f"gpsd stream error: {e}. Reconnecting in {_RECONNECT_DELAY_SECONDS}s.")
+                logger.error("Ensure gpsd is running and configured.")
+            finally:
+                self.connected.clear()
+                self.latest = None
+                self._close_socket()
+            self._stop_event.wait(_RECONNECT_DELAY_SECONDS)
+        logger.info("gpsd reader stopped.")
+
+    def _stream(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=10)
+        self._sock.sendall(_WATCH_COMMAND)
+        self._sock.settimeout(None) # Block between reports; stop() shuts the socket down to wake us
+        self.connected.set()
+        logger.info("GPSD connected, streaming reports.")
+        with self._sock.makefile('rb') as stream:
+            for line in stream:
+                if self._stop_event.is_set(): return
+                try: report = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    logger.debug(f"Ignoring malformed gpsd line: {line[:80]!r}")
+                    continue
+                if report.get('class') == 'TPV': self._handle_tpv(report)
+        if not self._stop_event.is_set(): raise ConnectionError("gpsd closed the connection")
+
+    def _handle_tpv(self, tpv):
+        # Mode values: 0=unknown, 1=NO_FIX, 2=FIX_2D, 3=FIX_3D
+        mode = tpv.get('mode', 0)
+        self.last_mode = mode
+        if mode < 2 or tpv.get('lat') is None or tpv.get('lon') is None:
+            self.latest = None
+            return
+        ts = tpv.get('time') # gpsd provides a UTC string
+        timestamp_iso = _parse_gpsd_ts(ts) if isinstance(ts, str) and len(ts) > 10 else None
+        if not timestamp_iso:
+            if ts: logger.debug("Could not parse GPS time string '%s'. Using current UTC.", ts)
+            timestamp_iso = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()) # No datetime allocation
+        ecef = (tpv.get('ecefx'), tpv.get('ecefy'), tpv.get('ecefz'))
+        location_data = {
+            'latitude': tpv['lat'], 'longitude': tpv['lon'],
+            'altitude': tpv.get('altMSL', tpv.get('alt')) if mode >= 3 else None, # Need 3D fix for altitude
+            'speed': tpv.get('speed'),
+            'timestamp': timestamp_iso,
+            'ecef': ecef if None not in ecef else None # WGS84 XYZ (m); lets arrival checks skip trig
+        }
+        self.latest = (location_data, time.monotonic())
+
+    def _close_socket(self):
+        sock, self._sock = self._sock, None
+        if not sock: return
+        try: sock.shutdown(socket.SHUT_RDWR) # Unblocks a pending read in run()
+        except OSError: pass
+        try: sock.close()
+        except OSError: pass
+
+    def stop(self):
+        self._stop_event.set()
+        self._close_socket()
+
+_reader = None
 
 def initialize_gps():
-    """Connects to the local gpsd service."""
-    global _gpsd_connected
-    if _gpsd_connected: return True
-    try:
-        logger.info("Connecting to gpsd...")
-        gpsd.connect()
-        # Verify connection with a quick read?
-        try:
-             packet = gpsd.get_current()
-             logger.info(f"GPSD connected. Initial mode: {packet.mode}")
-             _gpsd_connected = True
-             return True
-        except Exception as read_e:
-             logger.error(f"Connected to gpsd, but failed initial read: {read_e}. Check gpsd status.")
-             try: gpsd.close() # Try to close if initial read failed
-             except: pass
-             _gpsd_connected = False
-             return False
-    except Exception as e:
-        logger.error(f"Failed to connect to gpsd: {e}")
-        logger.error("Ensure gpsd is running and configured.")
-        _gpsd_connected = False
-        return False
+    """Starts the background gpsd reader. Returns True once it is connected (waits briefly)."""
+    global _reader
+    if _reader and _reader.is_alive(): return _reader.connected.is_set()
+    logger.info("Connecting to gpsd...")
+    _reader = _GpsReader(config.GPSD_HOST, config.GPSD_PORT)
+    _reader.start()
+    return _reader.connected.wait(timeout=2) # Keeps retrying in the background either way
 
 def get_gps_location():
-    """Gets current GPS location from gpsd."""
-    global _gpsd_connected
-    if not _gpsd_connected:
-        logger.warning("GPSD not connected. Attempting reconnect...")
+    """Returns the latest GPS fix streamed by gpsd, or None if there is no fresh fix."""
+    if not _reader or not _reader.is_alive():
+        logger.warning("GPSD reader not running. Attempting reconnect...")
         if not initialize_gps(): return None
-    try:
-        packet = gpsd.get_current()
-        # Mode values: 0=NO_FIX, 1=NO_FIX, 2=FIX_2D, 3=FIX_3D
-        if packet.mode >= 2:
-            ts = packet.time # gpsd typically provides UTC string
-            # Ensure timestamp is valid ISO UTC string
-            timestamp_iso = None
-            if isinstance(ts, str) and len(ts) > 10: # Basic check
-                 try:
-                      # Parse and ensure UTC timezone awareness
-                      dt_obj = datetime.fromisoformat(ts.replace('Z', '+00:00')).astimezone(timezone.utc)
-                      timestamp_iso = dt_obj.isoformat()
-                 except ValueError:
-                      logger.warning(f"Could not parse GPS time string '{ts}'. Using current UTC.")
-            if not timestamp_iso:
-                 timestamp_iso = datetime.now(timezone.utc).isoformat()
-
-            location_data = {
-                'latitude': packet.lat, 'longitude': packet.lon,
-                'altitude': packet.alt if hasattr(packet, 'alt') and packet.mode >= 3 else None, # Need 3D fix for altitude
-                'speed': packet.hspeed if hasattr(packet, 'hspeed') else None,
-                'timestamp': timestamp_iso
-            }
-            logger.debug(f"GPS fix: {location_data}")
-            return location_data
-        else:
-            logger.debug(f"Waiting for GPS fix (Mode: {packet.mode})")
-            return None
-    except gpsd.NoFixError:
-         logger.debug("No GPS fix available.")
-         return None
-    except StopIteration:
-         logger.warning("GPSD stream ended unexpectedly. Attempting reconnect.")
-         _gpsd_connected = False
-         try: gpsd.close()
-         except: pass
-         return None
-    except Exception as e:
-        logger.error(f"Error reading from gpsd: {e}", exc_info=True)
-        _gpsd_connected = False
-        try: gpsd.close()
-        except: pass
+    latest = _reader.latest
+    if latest is None:
+        logger.debug("Waiting for GPS fix (Mode: %s)", _reader.last_mode)
+        return None
+    location_data, received = latest
+    age = time.monotonic() - received
+    if age > config.GPS_FIX_STALE_SECONDS:
+        logger.debug("Latest GPS fix is stale (%.0fs old).", age)
         return None
+    logger.debug("GPS fix: %s", location_data) # Lazy: no dict repr per call unless DEBUG is on
+    return location_data
 
 def close_gps():
-    """Closes the connection to gpsd."""
-    global _gpsd_connected
-    if _gpsd_connected:
+    """Stops the gpsd reader and closes its socket."""
+    global _reader
+    if _reader:
         try:
-             gpsd.close()
+             _reader.stop()
+             _reader.join(timeout=5)
              logger.info("Closed connection to gpsd.")
         except Exception as e:
              logger.error(f"Error closing gpsd connection: {e}")
         finally:
-            _gpsd_connected = False
+            _reader = None
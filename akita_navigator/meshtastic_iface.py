@@ -8,17 +8,27 @@ import meshtastic.tcp_interface
 from meshtastic.node import Node
 from pubsub import pub
 import logging
-import json
+import orjson
 import time
+import re
 import threading
-from datetime import datetime, timezone
-import uuid
+import queue
+import heapq
+import itertools
+import collections
+import functools
+import os
+import string
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import config # Use project config
 from . import database # Use project database module
 
 logger = logging.getLogger(__name__)
 
+# No pubsub notification bookkeeping: the dispatcher publishes every packet for days on end
+pub.setNotificationFlags(all=False)
+
 # --- Message Type Constants ---
 MSG_TYPE_LOCATION = "loc"
 MSG_TYPE_ASSIGNMENT = "assign"
@@ -26,6 +36,199 @@ MSG_TYPE_STATUS_UPDATE = "status"
 MSG_TYPE_ACK = "ack"
 MSG_TYPE_TASK_COMPLETE = "task_complete"
 
+# Configured unit node IDs, built once at import (immutable; shared by every interface instance)
+_TARGET_NODE_IDS = frozenset(config.MESHTASTIC_TARGET_NODE_IDS)
+
+# Unit -> dispatch status reports that also advance the unit's delivery
+_UNIT_TO_DELIVERY_STATUS = {'en_route': 'en_route', 'arrived_dest': 'arrived'}
+
+# --- Unit Write-Behind Settings ---
+WRITE_BEHIND_FLUSH_SECONDS = 0.25 # Max delay before a coalesced unit update reaches the DB
+WRITE_BEHIND_BATCH = 64           # Flush early once this many units have pending updates
+# Parked units keep reporting the same fix; those reports only refresh last-seen at this interval
+LOCATION_UNCHANGED_DEGREES = 1e-5 # ~1 m
+LOCATION_HEARTBEAT_SECONDS = config.UNIT_OFFLINE_TIMEOUT_SECONDS / 4 # Well inside the offline sweep's window
+
+# --- Inbound Payload Decoding ---
+# Location reports are most of the inbound traffic and are flat objects, e.g.
+# {"type":"loc","unit_id":"u1","lat":42.88,"lon":-79.24,"ts":1700000000000}
+# Those are read with one regex pass; everything else gets a full orjson parse.
+_TAG_LOC = b'"type":"loc"'
+_TAG_STATUS = b'"status":' # Location report carrying a status change: full parse
+_LOC_FIELD_RE = re.compile(rb'"(unit_id|lat|lon|ts)":(?:"([^"\\]*)"|(-?[0-9][0-9.eE+-]*))')
+
+def decode_payload(payload_bytes):
+    """Decodes a JSON message payload (bytes) into a dict.
+    Raises orjson.JSONDecodeError for anything that isn't valid JSON."""
+    if (_TAG_LOC in payload_bytes[:24] and payload_bytes.count(b'{') == 1 and payload_bytes.rstrip().endswith(b'}')
+            and b'\\' not in payload_bytes and _TAG_STATUS not in payload_bytes):
+        message_data = {'type': MSG_TYPE_LOCATION}
+        for key, text, number in _LOC_FIELD_RE.findall(payload_bytes):
+            message_data[key.decode()] = orjson.loads(number) if number else text.decode('utf-8')
+        if 'unit_id' in message_data and 'lat' in message_data and 'lon' in message_data: return message_data
+    return orjson.loads(payload_bytes)
+
+
+TX_QUEUE_SIZE = 256             # Max messages waiting for the writer thread
+TX_BATCH_MAX = 16               # Max messages written per lock acquisition
+SEND_RESULT_TIMEOUT_SECONDS = 60 # Upper bound a synchronous send_message() waits for its result
+_NODE_ID_TTL = 30.0             # Seconds a validated unit -> node ID lookup is served from memory
+
+class _TxItem:
+    """One queued outbound message plus its retry state and result future."""
+    __slots__ = ('payload_bytes', 'destination', 'is_direct', 'is_bcast', 'max_retries', 'retry_delay', 'attempt', 'future')
+    def __init__(self, payload_bytes, destination, max_retries, retry_delay):
+        self.payload_bytes = payload_bytes
+        self.destination = destination
+        # Routing is decided once here, not on every attempt
+        self.is_direct = destination.startswith('!') if destination else False
+        self.is_bcast = destination == "^all"
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.attempt = 0
+        self.future = Future()
+
+# --- Thread Hand-off Queue ---
+class BoundedSimpleQueue:
+    """queue.SimpleQueue (C-implemented, no task_done bookkeeping) with a Semaphore providing the
+    maxsize bound. put_nowait raises queue.Full; get raises queue.Empty, like queue.Queue."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._queue = queue.SimpleQueue()
+        self._slots = threading.Semaphore(maxsize)
+
+    def put_nowait(self, item):
+        if not self._slots.acquire(blocking=False): raise queue.Full
+        self._queue.put(item)
+
+    def get(self, block=True, timeout=None):
+        item = self._queue.get(block, timeout)
+        self._slots.release()
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+class SheddingQueue:
+    """Two-lane FIFO for inbound messages. Sheddable items (plain location fixes) share a bounded
+    lane that drops its oldest item when full; everything else (ACKs, status reports) goes in an
+    unbounded lane and is never dropped. get() returns items in arrival order across both lanes
+    and raises queue.Empty like queue.Queue. No task_done/join."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keep = collections.deque() # [(seq, item)]
+        self._shed = collections.deque()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._items = threading.Semaphore(0) # One permit per queued item
+
+    def put(self, item, sheddable=False):
+        """Enqueues without blocking. Returns the number of sheddable items dropped (0 or 1)."""
+        with self._lock:
+            entry = (next(self._seq), item)
+            if not sheddable: self._keep.append(entry)
+            elif len(self._shed) < self.maxsize: self._shed.append(entry)
+            else:
+                self._shed.popleft(); self._shed.append(entry) # Item count unchanged: no new permit
+                return 1
+        self._items.release()
+        return 0
+
+    def get(self, block=True, timeout=None):
+        if not self._items.acquire(block, timeout): raise queue.Empty
+        with self._lock:
+            if self._keep and (not self._shed or self._keep[0][0] < self._shed[0][0]): return self._keep.popleft()[1]
+            return self._shed.popleft()[1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+# --- Message IDs ---
+_B62_ALPHABET = string.digits + string.ascii_letters
+_msg_id_counter = itertools.count(int.from_bytes(os.urandom(4), 'big')) # Random start so IDs don't repeat across restarts
+
+def _b62(n, width):
+    """Fixed-width base62 of n (high digits beyond width are dropped)."""
+    out = []
+    for _ in range(width):
+        n, r = divmod(n, 62); out.append(_B62_ALPHABET[r])
+    return ''.join(reversed(out))
+
+def _resolved_future(result):
+    future = Future(); future.set_result(result)
+    return future
+
+# --- Shared Scheduler ---
+class _TimerWheel:
+    """One thread running callbacks at their deadlines, kept in a heap (send retries, ACK timeouts).
+    Scheduling with a key supersedes that key's earlier entry; cancel() is lazy - stale heap
+    entries are skipped when they surface. Callbacks run outside the lock and must not block."""
+    def __init__(self, name):
+        self._name = name
+        self._cv = threading.Condition()
+        self._heap = [] # [(deadline_monotonic, seq, key, callback)]
+        self._live = {} # { key: seq } - keyed entries still armed
+        self._seq = itertools.count()
+        self._thread = None
+        self._stop = False
+
+    def start(self):
+        with self._cv:
+            if self._thread and self._thread.is_alive(): return
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def schedule(self, delay, callback, key=None):
+        with self._cv:
+            seq = next(self._seq)
+            if key is not None: self._live[key] = seq
+            heapq.heappush(self._heap, (time.monotonic() + delay, seq, key, callback))
+            self._cv.notify()
+        if not self._thread: self.start()
+
+    def cancel(self, key):
+        """Disarms a keyed entry. Returns True if it was still pending."""
+        with self._cv:
+            cancelled = self._live.pop(key, None) is not None
+            # Compact if cancelled entries pile up
+            if len(self._heap) > 2 * len(self._live) + 64:
+                self._heap = [entry for entry in self._heap if entry[2] is None or self._live.get(entry[2]) == entry[1]]
+                heapq.heapify(self._heap)
+            return cancelled
+
+    def pending_keys(self):
+        with self._cv: return len(self._live)
+
+    def stop(self):
+        with self._cv:
+            self._stop = True
+            self._heap = []; self._live.clear()
+            self._cv.notify_all()
+        if self._thread and self._thread is not threading.current_thread(): self._thread.join(timeout=5)
+        self._thread = None
+
+    def _run(self):
+        logger.debug(f"{self._name} started.")
+        while True:
+            due = []
+            with self._cv:
+                while not self._stop:
+                    now = time.monotonic()
+                    while self._heap and self._heap[0][0] <= now:
+                        _, seq, key, callback = heapq.heappop(self._heap)
+                        if key is not None:
+                            if self._live.get(key) != seq: continue # Cancelled/superseded
+                            del self._live[key]
+                        due.append(callback)
+                    if due: break
+                    self._cv.wait(timeout=self._heap[0][0] - now if self._heap else None)
+                if self._stop: break
+            for callback in due:
+                try: callback()
+                except Exception as e: logger.error(f"Error in scheduled callback: {e}", exc_info=True)
+        logger.debug(f"{self._name} stopped.")
+
 class MeshtasticInterface:
     """Base class for Meshtastic communication."""
     def __init__(self, connection_type, device_path=None, tcp_host=None, tcp_port=None):
@@ -36,7 +239,20 @@ class MeshtasticInterface:
         self.interface = None
         self._is_connected = False
         self._node_info = None
+        self.my_node_id = None # Our own '!xxxxxxxx' ID, cached from _node_info for per-packet checks
         self._lock = threading.Lock() # Protect access to interface object
+        # Outbound path: callers enqueue, a single writer thread drains in batches (see _writer_loop)
+        self._tx_queue = BoundedSimpleQueue(TX_QUEUE_SIZE)
+        self._tx_retrying = set() # _TxItems waiting on the scheduler for their next attempt
+        self._writer_thread = None
+        self._writer_stop = threading.Event()
+        # Single timer thread shared by send retries and (Dispatch) ACK timeouts
+        self._scheduler = _TimerWheel("MeshScheduler")
+
+        # Set by the library's connection.established event; connect() waits on it instead of sleeping.
+        # Subscribed once here (outside any lock). pubsub holds listeners weakly, so it must be a bound method.
+        self._ready_evt = threading.Event()
+        pub.subscribe(self._on_connection_ready, "meshtastic.connection.established")
 
         # Subscribe to Meshtastic PubSub messages (can be done here or on connect)
         # pub.subscribe(self.on_connection_change, "meshtastic.connection.established")
@@ -45,12 +261,14 @@ class MeshtasticInterface:
 
     def connect(self):
         """Establishes connection to the Meshtastic device."""
+        newly_connected = False
         with self._lock:
             if self._is_connected and self.interface:
                 logger.debug("Already connected to Meshtastic.")
                 return True
             try:
                 logger.info(f"Connecting to Meshtastic via {self.connection_type}...")
+                self._ready_evt.clear()
                 # Unsubscribe listeners before creating new interface? Might cause issues if called rapidly.
                 # Best practice might be to subscribe *after* connection.
 
@@ -62,13 +280,15 @@ class MeshtasticInterface:
                     logger.error(f"Unsupported Meshtastic connection type: {self.connection_type}")
                     return False
 
-                # Wait briefly for node info
-                time.sleep(2) # Allow time for interface setup
+                # Wait for the library to report the connection ready (usually already done by the time the constructor returns)
+                if not self._ready_evt.wait(timeout=5.0): logger.warning("No connection.established event within 5s; checking node info anyway.")
                 self._node_info = self.interface.getMyNodeInfo()
                 if not self._node_info or 'myNodeNum' not in self._node_info:
                      logger.warning("Could not get valid node info after connection. Retrying...")
-                     time.sleep(3)
-                     self._node_info = self.interface.getMyNodeInfo()
+                     retry_deadline = time.monotonic() + 3.0
+                     while (not self._node_info or 'myNodeNum' not in self._node_info) and time.monotonic() < retry_deadline:
+                          time.sleep(0.25) # Short polls: return as soon as node info lands
+                          self._node_info = self.interface.getMyNodeInfo()
 
                 if not self._node_info or 'myNodeNum' not in self._node_info:
                      logger.error("Failed to get node info after connection and retry.")
@@ -77,15 +297,12 @@ class MeshtasticInterface:
                      self.interface = None
                      return False
 
-                logger.info(f"Meshtastic connected. Node ID: {self._node_info.get('user', {}).get('id', 'N/A')}, Num: {self._node_info.get('myNodeNum', 'N/A')}")
+                self.my_node_id = self._node_info.get('user', {}).get('id')
+                logger.info(f"Meshtastic connected. Node ID: {self.my_node_id or 'N/A'}, Num: {self._node_info.get('myNodeNum', 'N/A')}")
                 self._is_connected = True
-
-                # Subscribe AFTER connection seems more robust
-                pub.subscribe(self.on_connection_change, "meshtastic.connection.established")
-                pub.subscribe(self.on_connection_change, "meshtastic.connection.lost")
-                # Receive handler is specific to Dispatch/Unit
-
-                return True
+                self._scheduler.start()
+                self._start_writer()
+                newly_connected = True
             except meshtastic.MeshInterfaceError as e:
                  logger.error(f"Meshtastic connection error: {e}")
                  if "Cannot configure port" in str(e) or "Permission denied" in str(e):
@@ -99,6 +316,18 @@ class MeshtasticInterface:
                 self._is_connected = False
                 return False
 
+        # Subscribe AFTER connection seems more robust. Done outside self._lock: pubsub takes its own
+        # lock, and a callback re-entering connect()/close() must not deadlock on ours.
+        if newly_connected:
+            pub.subscribe(self.on_connection_change, "meshtastic.connection.established")
+            pub.subscribe(self.on_connection_change, "meshtastic.connection.lost")
+            # Receive handler is specific to Dispatch/Unit
+        return newly_connected
+
+    def _on_connection_ready(self, **kwargs):
+        """pubsub: connection.established - only signals connect(), never takes self._lock."""
+        self._ready_evt.set()
+
     def on_connection_change(self, **kwargs):
         """Callback when connection status changes (from pubsub)."""
         # This might be called with different interface instances if reconnecting rapidly
@@ -110,8 +339,9 @@ class MeshtasticInterface:
              with self._lock:
                   if self.interface: # Ensure interface object still exists
                        self._node_info = self.interface.getMyNodeInfo()
+                       self.my_node_id = (self._node_info or {}).get('user', {}).get('id')
                        self._is_connected = True
-                       logger.info(f"Meshtastic connection established event. Node: {self._node_info.get('user', {}).get('id')}")
+                       logger.info(f"Meshtastic connection established event. Node: {self.my_node_id}")
                   else: logger.warning("Connection established event but interface is None.")
         elif "lost" in topic_name:
             with self._lock:
@@ -120,68 +350,150 @@ class MeshtasticInterface:
             logger.warning("Meshtastic connection lost event.")
 
 
-    def send_message(self, payload_dict, destinationId="^all", max_retries=config.MESHTASTIC_SEND_RETRIES, retry_delay=config.MESHTASTIC_RETRY_DELAY_SECONDS):
-        """Sends a JSON message with basic retry logic."""
+    def queue_message(self, payload_dict, destinationId="^all", max_retries=config.MESHTASTIC_SEND_RETRIES, retry_delay=config.MESHTASTIC_RETRY_DELAY_SECONDS):
+        """Encodes and enqueues a JSON message for the writer thread without blocking.
+        Returns a Future resolving to True once the library accepted the message, False on final failure."""
         # Ensure connection exists before attempting send
         if not self._is_connected or not self.interface:
              logger.warning("Send attempt while disconnected. Message not sent.")
              # Let higher level logic handle reconnect attempts (e.g., manager thread)
-             return False
+             return _resolved_future(False)
 
         try:
-            payload_str = json.dumps(payload_dict)
-            payload_bytes = payload_str.encode('utf-8')
-        except (TypeError, ValueError) as json_e:
+            payload_bytes = orjson.dumps(payload_dict) # UTF-8 bytes in one native pass; decoded only for sendText
+        except (TypeError, orjson.JSONEncodeError) as json_e:
              logger.error(f"Failed to encode payload to JSON: {json_e}. Payload: {payload_dict}")
-             return False
+             return _resolved_future(False)
+        return self._queue_encoded(payload_bytes, destinationId, max_retries, retry_delay)
+
+    def _queue_encoded(self, payload_bytes, destinationId, max_retries, retry_delay):
+        """queue_message() for a payload that is already JSON bytes."""
+        item = _TxItem(payload_bytes, destinationId, max_retries, retry_delay)
+        try:
+            self._tx_queue.put_nowait(item)
+        except queue.Full:
+            logger.error(f"Outbound queue FULL ({TX_QUEUE_SIZE}). Message to {destinationId} dropped.")
+            return _resolved_future(False)
+        if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Queued send to {destinationId} (Max Retries: {max_retries})")
+        return item.future
 
-        logger.debug(f"Attempting send to {destinationId} (Max Retries: {max_retries})")
+    def send_message(self, payload_dict, destinationId="^all", max_retries=config.MESHTASTIC_SEND_RETRIES, retry_delay=config.MESHTASTIC_RETRY_DELAY_SECONDS):
+        """Sends a JSON message with retry logic, blocking until the writer thread reports the outcome.
+        Use queue_message() directly when the caller doesn't need to wait."""
+        future = self.queue_message(payload_dict, destinationId, max_retries, retry_delay)
+        try:
+            return future.result(timeout=SEND_RESULT_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            logger.error(f"Timed out waiting for send result to {destinationId}.")
+            return False
+
+    def _next_msg_id(self):
+        """Compact 8-char message ID: 2 base62 chars from our node number + a 6-char base62 counter."""
+        node_num = self._node_info.get('myNodeNum', 0) if self._node_info else 0
+        return _b62(node_num, 2) + _b62(next(_msg_id_counter), 6)
+
+    # --- Outbound Writer Thread ---
+    def _start_writer(self):
+        """Starts the writer thread if it isn't already running (called on connect)."""
+        if self._writer_thread and self._writer_thread.is_alive(): return
+        self._writer_stop.clear()
+        self._writer_thread = threading.Thread(target=self._writer_loop, name="MeshTxWriter", daemon=True)
+        self._writer_thread.start()
+
+    def _stop_writer(self):
+        """Stops the writer thread and fails anything still queued."""
+        self._writer_stop.set()
+        if self._writer_thread and self._writer_thread is not threading.current_thread():
+            self._writer_thread.join(timeout=5)
+        self._writer_thread = None
+        pending = list(self._tx_retrying); self._tx_retrying.clear()
+        while True:
+            try: pending.append(self._tx_queue.get_nowait())
+            except queue.Empty: break
+        for item in pending:
+            if not item.future.done(): item.future.set_result(False)
+        if pending: logger.warning(f"Discarded {len(pending)} unsent outbound messages on close.")
+
+    def _writer_loop(self):
+        """Drains the TX queue: up to TX_BATCH_MAX messages per wake-up, all written under one
+        lock acquisition. Retries go back on the queue via the scheduler, never slept on."""
+        logger.debug("Meshtastic TX writer started.")
+        while not self._writer_stop.is_set():
+            try:
+                try: batch = [self._tx_queue.get(timeout=1.0)] # Bounded so the stop flag is noticed
+                except queue.Empty: continue
+                while len(batch) < TX_BATCH_MAX:
+                    try: batch.append(self._tx_queue.get_nowait())
+                    except queue.Empty: break
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Error in Meshtastic TX writer loop: {e}", exc_info=True)
+        logger.debug("Meshtastic TX writer stopped.")
+
+    def _write_batch(self, batch):
+        """Writes a batch to the radio under a single lock hold; schedules retryable failures.
+        Futures are resolved after the lock is released, so their callbacks never run under it."""
+        retry = []; resolved = [] # [(future, result)]
+        debug = logger.isEnabledFor(logging.DEBUG) # Skip building debug f-strings when nobody reads them
+        with self._lock:
+            interface = self.interface
+            if interface: send_data = interface.sendData; send_text = interface.sendText # Bound once per batch
+            # Checked once per batch: connection state only changes under self._lock (held here) or below
+            connected = interface is not None and self._is_connected
+            for item in batch:
+                if item.attempt == 0 and not item.future.set_running_or_notify_cancel(): continue # Caller cancelled
+                if not connected:
+                     logger.warning(f"Send attempt {item.attempt + 1} failed: Interface became disconnected.")
+                     resolved.append((item.future, False)) # Fail fast if disconnected
+                     continue
+                item.attempt += 1
+                try:
+                    # Use sendData for direct, sendText for broadcast
+                    if item.is_direct:
+                        if debug: logger.debug(f"Sending direct (Attempt {item.attempt}/{item.max_retries})...")
+                        send_data(item.payload_bytes, destinationId=item.destination, wantAck=False, channelIndex=0) # Specify primary channel usually
+                    elif item.is_bcast:
+                        if debug: logger.debug(f"Sending broadcast via sendText (Attempt {item.attempt}/{item.max_retries})...")
+                        send_text(item.payload_bytes.decode('utf-8'), channelIndex=0)
+                    else: # Invalid format, default to broadcast
+                        logger.warning(f"Invalid destination format '{item.destination}'. Broadcasting.")
+                        send_text(item.payload_bytes.decode('utf-8'), channelIndex=0)
+                    # Note: Success here means queued by library, not necessarily sent over air yet.
+                    if debug: logger.debug(f"Message queued for send by radio on attempt {item.attempt}.")
+                    resolved.append((item.future, True))
+
+                except meshtastic.MeshInterfaceError as e:
+                    logger.warning(f"Meshtastic send error (Attempt {item.attempt}/{item.max_retries}): {e}")
+                    if "Not connected" in str(e) or "ERROR_TIMEOUT" in str(e) or "No response from radio" in str(e):
+                         logger.error("Detected disconnection or timeout during send.")
+                         self._is_connected = connected = False # Mark as disconnected; rest of the batch fails fast
+                         # Don't close interface here, let manager handle reconnect
+                         resolved.append((item.future, False)) # Fail fast
+                    else: retry.append(item) # Other errors might be retryable
 
-        for attempt in range(max_retries):
-            # Acquire lock *inside* loop to allow other threads access between retries
-            with self._lock:
-                 # Check connection again inside lock
-                 if not self.interface or not self._is_connected:
-                      logger.warning(f"Send attempt {attempt + 1} failed: Interface became disconnected.")
-                      return False # Fail fast if disconnected
-
-                 try:
-                     # Use sendData for direct, sendText for broadcast
-                     if destinationId and destinationId.startswith('!'):
-                         logger.debug(f"Sending direct (Attempt {attempt + 1}/{max_retries})...")
-                         self.interface.sendData(payload_bytes, destinationId=destinationId, wantAck=False, channelIndex=0) # Specify primary channel usually
-                     elif destinationId == "^all":
-                         logger.debug(f"Sending broadcast via sendText (Attempt {attempt + 1}/{max_retries})...")
-                         self.interface.sendText(payload_str, channelIndex=0)
-                     else: # Invalid format, default to broadcast
-                         logger.warning(f"Invalid destination format '{destinationId}'. Broadcasting.")
-                         self.interface.sendText(payload_str, channelIndex=0)
-
-                     logger.debug(f"Message queued for send by radio on attempt {attempt + 1}.")
-                     # Note: Success here means queued by library, not necessarily sent over air yet.
-                     return True # Success!
-
-                 except meshtastic.MeshInterfaceError as e:
-                     logger.warning(f"Meshtastic send error (Attempt {attempt + 1}/{max_retries}): {e}")
-                     if "Not connected" in str(e) or "ERROR_TIMEOUT" in str(e) or "No response from radio" in str(e):
-                          logger.error("Detected disconnection or timeout during send.")
-                          self._is_connected = False # Mark as disconnected
-                          # Don't close interface here, let manager handle reconnect
-                          return False # Fail fast
-                     # Other errors might be retryable
-
-                 except Exception as e:
-                     logger.error(f"Unexpected error sending message (Attempt {attempt + 1}/{max_retries}): {e}", exc_info=True)
-                     # Assume potentially retryable
-
-            # Wait before next retry if failure occurred and retries remain
-            if attempt < max_retries - 1:
-                wait_time = retry_delay * (attempt + 1) # Linear backoff
-                logger.info(f"Waiting {wait_time}s before next send attempt...")
-                time.sleep(wait_time)
-
-        logger.error(f"Failed to send message to {destinationId} after {max_retries} attempts.")
-        return False
+                except Exception as e:
+                    logger.error(f"Unexpected error sending message (Attempt {item.attempt}/{item.max_retries}): {e}", exc_info=True)
+                    retry.append(item) # Assume potentially retryable
+
+        for future, result in resolved: future.set_result(result)
+        for item in retry:
+            if item.attempt >= item.max_retries:
+                logger.error(f"Failed to send message to {item.destination} after {item.max_retries} attempts.")
+                item.future.set_result(False)
+                continue
+            wait_time = item.retry_delay * (2 ** (item.attempt - 1)) # Exponential backoff, same schedule as the geocoder
+            logger.info(f"Retrying send to {item.destination} in {wait_time}s...")
+            self._tx_retrying.add(item)
+            self._scheduler.schedule(wait_time, functools.partial(self._requeue_retry, item))
+
+    def _requeue_retry(self, item):
+        """Scheduler callback: puts a message due for retry back on the TX queue."""
+        if item not in self._tx_retrying: return # Discarded by close()
+        try:
+            self._tx_queue.put_nowait(item)
+            self._tx_retrying.discard(item)
+        except queue.Full: # Radio is backed up; try again after another delay rather than block the scheduler
+            self._scheduler.schedule(item.retry_delay, functools.partial(self._requeue_retry, item))
 
     def close(self):
         """Closes the Meshtastic connection."""
@@ -190,7 +502,11 @@ class MeshtasticInterface:
         except: pass
         try: pub.unsubscribe(self.on_connection_change, "meshtastic.connection.lost")
         except: pass
+        try: pub.unsubscribe(self._on_connection_ready, "meshtastic.connection.established")
+        except: pass
         # Derived classes should unsubscribe their specific receive handlers here too
+        self._scheduler.stop()
+        self._stop_writer()
 
         with self._lock:
             if self.interface:
@@ -203,6 +519,56 @@ class MeshtasticInterface:
                      self.interface = None
                      self._is_connected = False
             self._node_info = None
+            self.my_node_id = None
+
+
+# --- Unit Write-Behind ---
+class _UnitWriteBehind:
+    """Coalesces inbound unit upserts (latest value wins per field) and writes them in one
+    transaction every WRITE_BEHIND_FLUSH_SECONDS, or sooner once WRITE_BEHIND_BATCH units are pending."""
+    def __init__(self):
+        self._pending = {} # { unit_id: merged upsert_unit keyword arguments }
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # Keeps flushes in order (flusher thread vs. explicit flush())
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="UnitWriteBehind", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, unit_id, **fields):
+        with self._lock:
+            merged = self._pending.setdefault(unit_id, {'unit_id': unit_id})
+            merged.update((key, value) for key, value in fields.items() if value is not None)
+            full = len(self._pending) >= WRITE_BEHIND_BATCH
+        if full: self._wake.set()
+
+    def flush(self):
+        """Writes everything pending now. Returns False if any update failed (failed updates are dropped)."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending: return True
+                batch, self._pending = self._pending, {}
+            if database.upsert_units_bulk(list(batch.values())): return True
+            logger.error(f"Write-behind flush of {len(batch)} unit updates did not fully succeed.")
+            return False
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(WRITE_BEHIND_FLUSH_SECONDS)
+            self._wake.clear()
+            try: self.flush()
+            except Exception as e: logger.error(f"Error in unit write-behind flush: {e}", exc_info=True)
+
+    def stop(self):
+        self._stop.set(); self._wake.set()
+        if self._thread and self._thread is not threading.current_thread(): self._thread.join(timeout=5)
+        self._thread = None
+        self.flush() # Don't lose the tail on shutdown
 
 
 # --- Dispatch Server Specific Interface ---
@@ -210,10 +576,12 @@ class DispatchMeshtasticInterface(MeshtasticInterface):
     """Handles Meshtastic communication for Dispatch, using DB for ACK tracking."""
     def __init__(self):
         super().__init__(config.MESHTASTIC_CONNECTION_TYPE, config.MESHTASTIC_DEVICE_PATH, config.MESHTASTIC_TCP_HOST, config.MESHTASTIC_TCP_PORT)
-        self.target_node_ids = set(config.MESHTASTIC_TARGET_NODE_IDS)
-        self._active_ack_timers = {} # { msg_id: threading.Timer }
-        self._timer_lock = threading.Lock()
+        self.target_node_ids = _TARGET_NODE_IDS
+        # ACK timeouts are keyed by msg_id on the shared scheduler (no thread per pending ACK)
         self._queued_receive_handler = None # Store ref to allow unsubscribe
+        self._node_id_cache = {} # { unit_id: (validated meshtastic_node_id, cached_at_monotonic) }
+        self._write_behind = _UnitWriteBehind() # Inbound last-seen/location upserts, batched
+        self._last_location = {} # { unit_id: (lat, lon, node_id, written_at_monotonic) } - processor thread only
         logger.info(f"Dispatch server targeting units: {self.target_node_ids}")
 
     def subscribe_receive_handler(self, callback):
@@ -225,46 +593,66 @@ class DispatchMeshtasticInterface(MeshtasticInterface):
          except Exception as e:
               logger.error(f"Error subscribing receive handler: {e}")
 
+    def _get_validated_node_id(self, unit_id):
+        """Returns the unit's '!'-prefixed Meshtastic node ID, or None if missing/invalid.
+        Hits the DB at most once per _NODE_ID_TTL per unit; invalid IDs are not cached."""
+        cached = self._node_id_cache.get(unit_id)
+        if cached and time.monotonic() - cached[1] < _NODE_ID_TTL: return cached[0]
+        unit_info = database.get_unit(unit_id) # Fetch fresh unit info
+        node_id = unit_info.get('meshtastic_node_id') if unit_info else None
+        if not node_id or not node_id.startswith('!'):
+            self._node_id_cache.pop(unit_id, None)
+            logger.error(f"Unit {unit_id} has no valid Meshtastic node ID ({node_id!r}).")
+            return None
+        self._node_id_cache[unit_id] = (node_id, time.monotonic())
+        return node_id
+
+    def connect(self):
+        """Connects, then makes sure the unit write-behind is running."""
+        connected = super().connect()
+        if connected: self._write_behind.start()
+        return connected
+
+    # --- ACK Timers ---
     def _start_ack_timer(self, msg_id, timeout_seconds):
-        # ... (Implementation from previous step is correct) ...
-        with self._timer_lock:
-            self._cancel_ack_timer(msg_id, acquire_lock=False)
-            timer = threading.Timer(timeout_seconds, self._handle_assignment_timeout, args=[msg_id])
-            timer.daemon = True; self._active_ack_timers[msg_id] = timer; timer.start()
-            logger.debug(f"Started ACK timer ({timeout_seconds}s) for {msg_id}.")
+        # Supersedes any earlier timer for this msg_id
+        self._scheduler.schedule(timeout_seconds, functools.partial(self._handle_assignment_timeout, msg_id), key=msg_id)
+        logger.debug(f"Started ACK timer ({timeout_seconds}s) for {msg_id}.")
 
-    def _cancel_ack_timer(self, msg_id, acquire_lock=True):
-        # ... (Implementation from previous step is correct) ...
-        if acquire_lock: self._timer_lock.acquire()
-        try:
-            timer = self._active_ack_timers.pop(msg_id, None)
-            if timer: timer.cancel(); logger.debug(f"Cancelled ACK timer for {msg_id}.")
-        finally:
-            if acquire_lock: self._timer_lock.release()
+    def _cancel_ack_timer(self, msg_id):
+        if self._scheduler.cancel(msg_id): logger.debug(f"Cancelled ACK timer for {msg_id}.")
 
-    def _handle_assignment_timeout(self, msg_id):
-        # ... (Implementation from previous step is correct - uses DB for state) ...
-         logger.warning(f"ACK timeout for assignment msg_id {msg_id}.")
-         with self._timer_lock: self._active_ack_timers.pop(msg_id, None) # Remove timer ref
-         pending_info = database.get_pending_ack(msg_id)
-         if not pending_info: return # Already handled
-         # ... (increment retry count, check max retries, resend or fail using DB updates) ...
-         current_retry_count = pending_info['retry_count']
-         # ... (get delivery_id, unit_id etc from pending_info) ...
-         if current_retry_count < config.MAX_ASSIGNMENT_RETRIES:
-              if database.update_pending_ack_retry(msg_id):
-                   send_success = self.send_message(pending_info['payload'], destinationId=pending_info['destination_node_id'])
-                   if send_success: self._start_ack_timer(msg_id, config.ASSIGNMENT_ACK_TIMEOUT_SECONDS * (current_retry_count + 2))
-                   else: # Failed resend
-                        database.update_pending_ack_status(msg_id, 'failed')
-                        database.update_delivery_status(delivery_id, 'failed', ...)
-                        database.update_unit_status(unit_id, 'error', ...)
-              else: logger.error(f"Failed to update retry count for {msg_id}. Aborting.")
-         else: # Max retries exceeded
-              database.update_pending_ack_status(msg_id, 'failed')
-              database.update_delivery_status(delivery_id, 'failed', ...)
-              database.update_unit_status(unit_id, 'error', ...)
+    def _fail_assignment(self, msg_id, delivery_id, unit_id, reason):
+        """Marks an assignment that will never be ACKed as failed: ACK record, delivery and unit."""
+        logger.error(f"Assignment {msg_id} (delivery {delivery_id} -> unit {unit_id}) failed: {reason}")
+        with database.transaction() as conn: # One commit for all three rows
+            database.update_pending_ack_status(msg_id, 'failed', conn=conn)
+            database.update_delivery_status(delivery_id, 'failed', failure_reason=reason, conn=conn)
+            database.update_unit_status(unit_id, 'error', reason=reason, conn=conn)
 
+    def _handle_assignment_timeout(self, msg_id):
+        """Scheduler callback: resends an unACKed assignment or gives up. Never blocks on the send."""
+        logger.warning(f"ACK timeout for assignment msg_id {msg_id}.")
+        pending_info = database.get_pending_ack(msg_id)
+        if not pending_info or pending_info['status'] != 'pending': return # Already handled
+        current_retry_count = pending_info['retry_count']
+        delivery_id = pending_info['delivery_id']; unit_id = pending_info['unit_id']
+        if current_retry_count >= config.MAX_ASSIGNMENT_RETRIES:
+            self._fail_assignment(msg_id, delivery_id, unit_id, f"No ACK after {current_retry_count + 1} attempts")
+            return
+        if not database.update_pending_ack_retry(msg_id):
+            logger.error(f"Failed to update retry count for {msg_id}. Aborting.")
+            return
+        self._resend_assignment(pending_info)
+
+    def _resend_assignment(self, pending_info):
+        """Queues a resend (retry count already bumped in the DB); on result, re-arms the ACK timer or fails it."""
+        msg_id = pending_info['msg_id']; next_timeout = config.ASSIGNMENT_ACK_TIMEOUT_SECONDS * (pending_info['retry_count'] + 2)
+        def on_resend_done(future):
+            if future.result(): self._start_ack_timer(msg_id, next_timeout)
+            else: # Failed resend. DB write goes to the scheduler thread, not the radio writer
+                 self._scheduler.schedule(0, functools.partial(self._fail_assignment, msg_id, pending_info['delivery_id'], pending_info['unit_id'], "Assignment resend failed"))
+        self.queue_message(pending_info['payload'], destinationId=pending_info['destination_node_id']).add_done_callback(on_resend_done)
 
     def _handle_incoming_ack(self, message_data):
         # ... (Implementation from previous step is correct - updates DB, cancels timer) ...
@@ -276,28 +664,68 @@ class DispatchMeshtasticInterface(MeshtasticInterface):
 
     def _handle_incoming_message(self, message_data, packet):
         """Processes a message received from the incoming queue."""
-        # ... (Implementation from previous step is correct - handles types, updates DB, ensures unit exists) ...
         # Remember this is now called by the message_processor_worker thread
-        sender_node_id = packet.get('fromId', 'Unknown Node')
+        from_id = packet.get('fromId')
+        sender_node_id = from_id or 'Unknown Node'
         unit_id = message_data.get('unit_id')
         try:
             msg_type = message_data.get('type')
             if msg_type == MSG_TYPE_ACK: self._handle_incoming_ack(message_data); return
-            if not unit_id: logger.warning(...); return
-            # Ensure unit exists / update last seen etc.
-            if not database.get_unit(unit_id): database.upsert_unit(unit_id=unit_id, ...)
-            else: database.upsert_unit(unit_id=unit_id, meshtastic_node_id=sender_node_id, last_update_time=_now_utc_iso())
-            # Process LOC, STATUS etc. update DB, reset offline/error status if needed
-            # ... (rest of the logic) ...
-        except Exception as e: logger.error(...)
+            if not unit_id: logger.warning(f"Message type '{msg_type}' from {sender_node_id} has no unit_id. Ignored."); return
+            now_ms = _now_epoch_ms()
+
+            if msg_type == MSG_TYPE_LOCATION:
+                lat = message_data.get('lat'); lon = message_data.get('lon')
+                # Fast-path decoding skips JSON validation, so check the values before they reach the DB
+                if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)) or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                     logger.warning(f"Invalid location from unit {unit_id}: lat={lat!r}, lon={lon!r}. Ignored.")
+                     return
+                last = self._last_location.get(unit_id)
+                now_mono = time.monotonic()
+                if (last and last[2] == from_id and now_mono - last[3] < LOCATION_HEARTBEAT_SECONDS
+                        and abs(lat - last[0]) < LOCATION_UNCHANGED_DEGREES and abs(lon - last[1]) < LOCATION_UNCHANGED_DEGREES):
+                     if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Unit {unit_id} has not moved; location write skipped.")
+                else:
+                     # Location reports only touch location/last-seen columns, so they can lag by a flush interval
+                     self._write_behind.enqueue(unit_id, meshtastic_node_id=from_id, latitude=lat, longitude=lon,
+                                                location_time=message_data.get('ts') or now_ms, last_update_time=now_ms)
+                     self._last_location[unit_id] = (lat, lon, from_id, now_mono)
+                if message_data.get('status'): # Unit changed state this tick and sent both in one packet
+                     self._write_behind.flush()
+                     self._apply_status_report(unit_id, message_data['status'], message_data.get('delivery_id'))
+            else:
+                # Ensure unit exists / update last seen
+                self._write_behind.enqueue(unit_id, meshtastic_node_id=from_id, last_update_time=now_ms)
+                if msg_type == MSG_TYPE_STATUS_UPDATE:
+                     self._write_behind.flush() # State transitions read the unit row; make it current first
+                     self._apply_status_report(unit_id, message_data.get('status'), message_data.get('delivery_id'))
+                else: logger.debug(f"Unhandled message type '{msg_type}' from unit {unit_id}.")
+            # Node ID may have changed; seed the cache with what the DB will hold after the flush
+            if from_id and from_id.startswith('!'): self._node_id_cache[unit_id] = (from_id, time.monotonic())
+            else: self._node_id_cache.pop(unit_id, None)
+        except Exception as e: logger.error(f"Error processing message from {sender_node_id}: {e}", exc_info=True)
+
+    def _apply_status_report(self, unit_id, status, delivery_id):
+        """Applies a unit's self-reported status, advancing its delivery where the status implies it."""
+        if not status: logger.warning(f"Status report from unit {unit_id} has no status. Ignored."); return
+        with database.transaction() as conn: # Unit and delivery rows change together, with one commit
+            success, message = database.update_unit_status(unit_id, status, assigned_delivery_id=delivery_id, conn=conn)
+            if not success: logger.warning(f"Status report '{status}' from unit {unit_id} not applied: {message}"); return
+            delivery_status = _UNIT_TO_DELIVERY_STATUS.get(status)
+            if delivery_status and delivery_id is not None:
+                 delivery_ok, delivery_message = database.update_delivery_status(delivery_id, delivery_status, conn=conn)
+                 if not delivery_ok: logger.warning(f"Delivery {delivery_id} not moved to '{delivery_status}': {delivery_message}")
 
     def send_assignment(self, unit_id, delivery_id, latitude, longitude, address):
-        """Sends assignment and initiates ACK tracking via DB."""
+        """Queues the assignment and initiates ACK tracking via DB; does not wait for the radio.
+        Returns (False, reason) only if it could not be queued - the caller then reverts the assignment.
+        A send that fails later puts the delivery back to pending and the unit to idle itself."""
         # ... (Implementation from previous step is correct - adds to DB, calls send_message, starts timer) ...
-        unit_info = database.get_unit(unit_id) # Fetch fresh unit info
-        if not unit_info or not unit_info.get('meshtastic_node_id'): return False, "Unit has no Node ID"
-        # ... (check node ID format) ...
-        msg_id = uuid.uuid4().hex[:8]; payload = { ... }
+        destination_node_id = self._get_validated_node_id(unit_id)
+        if not destination_node_id: return False, "Unit has no valid Node ID"
+        msg_id = self._next_msg_id()
+        payload = {"type": MSG_TYPE_ASSIGNMENT, "msg_id": msg_id, "delivery_id": delivery_id,
+                   "lat": latitude, "lon": longitude, "address": address}
         # Add to DB *before* sending
         if not database.add_pending_ack(msg_id, delivery_id, unit_id, destination_node_id, payload):
              # Handle case where it might already exist but failed send previously? Maybe delete and re-add? Or just try send.
@@ -306,48 +734,86 @@ class DispatchMeshtasticInterface(MeshtasticInterface):
                   return False, "DB error storing ACK state"
              else: logger.warning(f"Pending ACK {msg_id} already in DB. Retrying send.")
 
-        initial_send_success = self.send_message(payload, destinationId=destination_node_id)
-        if initial_send_success: self._start_ack_timer(msg_id, config.ASSIGNMENT_ACK_TIMEOUT_SECONDS); return True, "Assignment sent, awaiting ACK"
-        else: # Initial send failed
+        future = self.queue_message(payload, destinationId=destination_node_id)
+        if future.done() and not future.result(): # Disconnected / TX queue full: nothing went out
              database.update_pending_ack_status(msg_id, 'failed')
-             database.update_delivery_status(delivery_id, 'failed', ...)
-             database.update_unit_status(unit_id, 'error', ...)
              return False, "Failed initial send attempt"
+        claim = threading.Lock() # A failed send is handled once: by this call if it can still answer, else by revert()
+        def revert():
+            if not claim.acquire(blocking=False): return
+            # Never reached the unit: same outcome as the old synchronous revert in the API
+            logger.error(f"Initial send of assignment {msg_id} failed. Reverting delivery {delivery_id} to pending, unit {unit_id} to idle.")
+            with database.transaction() as conn:
+                database.update_pending_ack_status(msg_id, 'failed', conn=conn)
+                database.update_delivery_status(delivery_id, 'pending', conn=conn)
+                database.update_unit_status(unit_id, 'idle', conn=conn)
+        def on_sent(future):
+            if future.result(): self._start_ack_timer(msg_id, config.ASSIGNMENT_ACK_TIMEOUT_SECONDS); return
+            self._scheduler.schedule(0, revert) # BEGIN IMMEDIATE can wait on the busy timeout; keep it off the radio writer
+        future.add_done_callback(on_sent)
+        if future.done() and not future.result() and claim.acquire(blocking=False): # Failed before we returned
+             database.update_pending_ack_status(msg_id, 'failed')
+             return False, "Failed initial send attempt"
+        return True, "Assignment queued, awaiting ACK"
 
     def send_task_complete(self, unit_id, delivery_id):
-        """Sends task complete command."""
-        # ... (Implementation from previous step is correct - uses send_message) ...
-        unit_info = database.get_unit(unit_id); # Fetch fresh info
-        if not unit_info or ...: return False
-        destination_node_id = unit_info['meshtastic_node_id']; # ... check format ...
-        msg_id = uuid.uuid4().hex[:8]; payload = { ... } # Include msg_id
-        success = self.send_message(payload, destinationId=destination_node_id)
+        """Queues task complete command. Returns False only if it could not be queued; later failures are logged."""
+        destination_node_id = self._get_validated_node_id(unit_id)
+        if not destination_node_id: return False
+        msg_id = self._next_msg_id()
+        payload = {"type": MSG_TYPE_TASK_COMPLETE, "msg_id": msg_id, "delivery_id": delivery_id}
+        future = self.queue_message(payload, destinationId=destination_node_id)
+        if future.done(): return future.result()
+        def on_sent(future):
+            if not future.result(): logger.error(f"Task Complete for delivery {delivery_id} to unit {unit_id} failed after retries.")
+        future.add_done_callback(on_sent)
         # Optional: Add ACK tracking for this too if needed, similar to assignments
-        return success
+        return True
+
 
+    def schedule_pending_ack_restart(self, delay):
+        """Runs restart_pending_ack_timers() once, `delay` seconds from now, on the shared scheduler."""
+        def restart():
+            logger.info("Attempting to restart pending ACK timers...")
+            self.restart_pending_ack_timers()
+        self._scheduler.schedule(delay, restart)
 
     def restart_pending_ack_timers(self):
         """Queries DB for pending ACKs on startup and restarts timers."""
         # ... (Implementation from previous step is correct) ...
         logger.info("Restarting timers for pending assignment ACKs from database...")
         pending_acks = database.get_all_pending_acks_for_restart()
-        now_dt = datetime.now(timezone.utc); restarted_count = 0; immediate_retry_count = 0
-        with self._timer_lock: self._active_ack_timers.clear()
+        now_ms = _now_epoch_ms(); restarted_count = 0; overdue_ids = []
+        # Loop-invariant lookups bound once (can be thousands of rows after an outage)
+        ack_timeout = config.ASSIGNMENT_ACK_TIMEOUT_SECONDS; start_ack_timer = self._start_ack_timer
         for ack_info in pending_acks:
-             msg_id = ack_info['msg_id']; sent_time_str = ack_info['sent_time']; retry_count = ack_info['retry_count']
+             msg_id = ack_info['msg_id']; sent_time_ms = ack_info['sent_time']; retry_count = ack_info['retry_count']
              try:
-                  sent_dt = datetime.fromisoformat(sent_time_str.replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
-                  base_timeout = config.ASSIGNMENT_ACK_TIMEOUT_SECONDS * (retry_count + 1)
-                  elapsed_seconds = (now_dt - sent_dt).total_seconds()
+                  base_timeout = ack_timeout * (retry_count + 1)
+                  elapsed_seconds = (now_ms - sent_time_ms) / 1000.0 # sent_time is stored as epoch ms
                   remaining_timeout = base_timeout - elapsed_seconds
                   if remaining_timeout > 1:
-                       self._start_ack_timer(msg_id, remaining_timeout) # Uses internal _start without lock
+                       start_ack_timer(msg_id, remaining_timeout)
                        restarted_count += 1
-                  else: # Overdue
-                       threading.Thread(target=self._handle_assignment_timeout, args=[msg_id], daemon=True).start()
-                       immediate_retry_count += 1
+                  else: overdue_ids.append(msg_id) # Handled below in one batch
              except Exception as e: logger.error(f"Error processing pending ACK {msg_id} during restart: {e}")
-        logger.info(f"Finished ACK restart: {restarted_count} timers restarted, {immediate_retry_count} immediate checks.")
+        if overdue_ids: self._handle_overdue_acks(overdue_ids)
+        logger.info(f"Finished ACK restart: {restarted_count} timers restarted, {len(overdue_ids)} immediate checks.")
+
+    def _handle_overdue_acks(self, msg_ids):
+        """Batched _handle_assignment_timeout for ACKs that expired while we were down:
+        one fetch and one retry-count update for all of them, resends queued without extra threads."""
+        pending = database.get_pending_acks_in(msg_ids)
+        retryable = []
+        for msg_id, info in pending.items():
+             if info['status'] != 'pending': continue
+             if info['retry_count'] >= config.MAX_ASSIGNMENT_RETRIES:
+                  self._fail_assignment(msg_id, info['delivery_id'], info['unit_id'], f"No ACK after {info['retry_count'] + 1} attempts")
+             else: retryable.append(msg_id)
+        bumped = database.update_pending_acks_retry_bulk(retryable)
+        for msg_id in retryable:
+             if msg_id in bumped: self._resend_assignment(pending[msg_id])
+             else: logger.error(f"Failed to update retry count for {msg_id}. Aborting.")
 
 
     def close(self):
@@ -356,18 +822,54 @@ class DispatchMeshtasticInterface(MeshtasticInterface):
          if self._queued_receive_handler:
               try: pub.unsubscribe(self._queued_receive_handler, "meshtastic.receive")
               except: pass
-         # Cancel timers
-         with self._timer_lock:
-              logger.info(f"Cancelling {len(self._active_ack_timers)} active ACK timers.")
-              for timer in self._active_ack_timers.values(): timer.cancel()
-              self._active_ack_timers.clear()
+         # ACK timers live on the shared scheduler, which the base close() stops
+         logger.info(f"Cancelling {self._scheduler.pending_keys()} active ACK timers.")
+         self._write_behind.stop() # Flushes any pending unit updates
          super().close() # Call base class close
 
 
 # --- Delivery Unit Specific Interface ---
 class UnitMeshtasticInterface(MeshtasticInterface):
-    # ... (Init, set callbacks, send_ack, send_location_update, send_status_update remain same) ...
-    # Ensure it uses the base send_message with retries internally.
+    """Handles Meshtastic communication for a delivery unit. Reports go out as broadcasts."""
+    def __init__(self, unit_id, connection_type, device_path=None, tcp_host=None, tcp_port=None):
+        super().__init__(connection_type, device_path, tcp_host, tcp_port)
+        self.unit_id = unit_id
+        self.assignment_callback = None
+        self.task_complete_callback = None
+        # Location reports go out every GPS tick: the constant head is encoded once, only the numbers per send
+        self._loc_prefix = b'{"type":"' + MSG_TYPE_LOCATION.encode() + b'","unit_id":' + orjson.dumps(unit_id) + b',"lat":'
+
+    def set_assignment_callback(self, callback): self.assignment_callback = callback
+
+    def set_task_complete_callback(self, callback): self.task_complete_callback = callback
+
+    def send_ack(self, msg_id, destination_node_id):
+        """Queues an ACK for an assignment/command back to its sender. Does not wait for the radio."""
+        payload = {"type": MSG_TYPE_ACK, "ack_id": msg_id, "unit_id": self.unit_id}
+        future = self.queue_message(payload, destinationId=destination_node_id or "^all")
+        return not (future.done() and not future.result())
+
+    def send_location_update(self, latitude, longitude, timestamp=None, status=None, delivery_id=None):
+        """Queues a location report without waiting for the radio. Not retried: the next GPS tick supersedes it.
+        A status change can ride along (status/delivery_id); such reports are retried like send_status_update.
+        timestamp may be epoch ms or an ISO string (as produced by gps_handler); dispatch stores epoch ms."""
+        ts = database.to_epoch_ms(timestamp) if timestamp else _now_epoch_ms() # Naive ISO strings are UTC, as on dispatch
+        parts = [self._loc_prefix, None, b',"lon":', None, b',"ts":', None]
+        try:
+            parts[1] = orjson.dumps(latitude); parts[3] = orjson.dumps(longitude); parts[5] = orjson.dumps(ts)
+            if status: parts += (b',"status":', orjson.dumps(status), b',"delivery_id":', orjson.dumps(delivery_id))
+        except (TypeError, orjson.JSONEncodeError) as json_e:
+            logger.error(f"Failed to encode location ({latitude!r}, {longitude!r}): {json_e}")
+            return False
+        parts.append(b'}')
+        max_retries = config.MESHTASTIC_SEND_RETRIES if status else 1
+        future = self._queue_encoded(b''.join(parts), "^all", max_retries, config.MESHTASTIC_RETRY_DELAY_SECONDS)
+        return not (future.done() and not future.result())
+
+    def send_status_update(self, status, delivery_id=None):
+        """Sends a status report, with retries. Blocks until the radio accepts it or retries run out."""
+        payload = {"type": MSG_TYPE_STATUS_UPDATE, "unit_id": self.unit_id, "status": status, "delivery_id": delivery_id}
+        return self.send_message(payload)
 
     def _handle_parsed_message(self, message_data, packet):
          """Processes messages, including sending ACKs for assignments/commands."""
@@ -403,6 +905,7 @@ class UnitMeshtasticInterface(MeshtasticInterface):
 
 
 # --- Helper ---
-def _now_utc_iso():
-    # ... (remains same) ...
-    return datetime.now(timezone.utc).isoformat()
+def _now_epoch_ms():
+    """Current UTC time as integer epoch ms - the database's native time format, so no string round-trip."""
+    return int(time.time() * 1000)
+
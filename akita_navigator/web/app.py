@@ -3,26 +3,66 @@
 # Licensed under GPLv3. See LICENSE file for details.
 
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_login import LoginManager, UserMixin
 import logging
+import orjson
 import config # Project configuration
 
 logger = logging.getLogger(__name__)
 meshtastic_interface_instance = None
 
+# --- Import-time Configuration (shared by every create_app() call / worker) ---
+if not config.FLASK_SECRET_KEY or config.FLASK_SECRET_KEY == 'generate_a_real_secret_key_here_and_store_safely':
+     logger.critical("FATAL: FLASK_SECRET_KEY is not set or is set to the default placeholder! Application will not run securely.")
+     raise ValueError("FLASK_SECRET_KEY is not configured securely in config.py")
+
+# Pass relevant config to templates (use selectively)
+_TEMPLATE_CONFIG = {
+    'map_default_lat': config.MAP_DEFAULT_CENTER_LAT,
+    'map_default_lon': config.MAP_DEFAULT_CENTER_LON,
+    'map_default_zoom': config.MAP_DEFAULT_ZOOM,
+    'base_lat': config.RETURN_BASE_COORDS[0],
+    'base_lon': config.RETURN_BASE_COORDS[1],
+    'gps_update_interval_seconds': config.GPS_UPDATE_INTERVAL_SECONDS,
+    'unit_offline_timeout_seconds': config.UNIT_OFFLINE_TIMEOUT_SECONDS,
+}
+
+# --- JSON Provider ---
+class OrjsonProvider(DefaultJSONProvider):
+    """Serializes jsonify() responses with orjson: bytes straight into the response, no str round-trip.
+    Anything orjson rejects goes through Flask's default encoder instead. request.get_json() parses with orjson."""
+    option = orjson.OPT_NAIVE_UTC
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s) # Takes the raw body bytes; JSONDecodeError is a ValueError, so Flask's 400 handling still applies
+
+    def dumps(self, obj, **kwargs):
+        try: return orjson.dumps(obj, option=self.option).decode('utf-8')
+        except TypeError: return super().dumps(obj, **kwargs) # orjson.JSONEncodeError is a TypeError
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        try: body = orjson.dumps(obj, option=self.option)
+        except TypeError: body = super().dumps(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 # --- User Model & Authentication Setup ---
 # Uses user definition from config.py for simplicity
 # In production, replace with a proper database user store
 class User(UserMixin):
     """Simple User class for Flask-Login."""
-    def __init__(self, id):
+    def __init__(self, id, password_hash=None):
         self.id = id
+        self.password_hash = password_hash
         # In a real app, add roles, names, etc.
 
     # In a real app, get password hash from DB based on self.id
     def get_password_hash(self):
-        user_record = config.ADMIN_USERS.get(self.id)
-        return user_record.get('password_hash') if user_record else None
+        return self.password_hash
+
+# Users are static config entries, so build each User (with its hash) once instead of per request
+_USER_CACHE = {user_id: User(user_id, record.get('password_hash')) for user_id, record in config.ADMIN_USERS.items()}
 
 login_manager = LoginManager()
 login_manager.login_view = 'login' # Function name of the login route
@@ -32,10 +72,7 @@ login_manager.login_message = "Please log in to access this page."
 @login_manager.user_loader
 def load_user(user_id):
     """Flask-Login hook to load a user by ID."""
-    # Check if user exists in our config store
-    if user_id in config.ADMIN_USERS:
-        return User(user_id)
-    return None
+    return _USER_CACHE.get(user_id) # None if not in our config store
 # --- End User Model ---
 
 def create_app(mesh_interface=None):
@@ -50,21 +87,10 @@ def create_app(mesh_interface=None):
                 instance_relative_config=False)
 
     # --- Configuration ---
-    app.config['SECRET_KEY'] = config.FLASK_SECRET_KEY
-    if not app.config['SECRET_KEY'] or app.config['SECRET_KEY'] == 'generate_a_real_secret_key_here_and_store_safely':
-         logger.critical("FATAL: FLASK_SECRET_KEY is not set or is set to the default placeholder! Application will not run securely.")
-         raise ValueError("FLASK_SECRET_KEY is not configured securely in config.py")
-
-    # Pass relevant config to templates (use selectively)
-    app.config['TEMPLATE_CONFIG'] = {
-        'map_default_lat': config.MAP_DEFAULT_CENTER_LAT,
-        'map_default_lon': config.MAP_DEFAULT_CENTER_LON,
-        'map_default_zoom': config.MAP_DEFAULT_ZOOM,
-        'base_lat': config.RETURN_BASE_COORDS[0],
-        'base_lon': config.RETURN_BASE_COORDS[1],
-        'gps_update_interval_seconds': config.GPS_UPDATE_INTERVAL_SECONDS,
-        'unit_offline_timeout_seconds': config.UNIT_OFFLINE_TIMEOUT_SECONDS,
-    }
+    app.config['SECRET_KEY'] = config.FLASK_SECRET_KEY # Validated once at import
+    app.config['TEMPLATE_CONFIG'] = _TEMPLATE_CONFIG
+    app.config['USERS_BY_NAME'] = _USER_CACHE # login: one dict lookup for user + hash
+    app.json = OrjsonProvider(app) # Every jsonify() in routes goes through orjson
 
     # Initialize Flask-Login
     login_manager.init_app(app)
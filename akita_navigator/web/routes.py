@@ -3,14 +3,18 @@
 # Licensed under GPLv3. See LICENSE file for details.
 
 from flask import (Flask, render_template, request, jsonify, current_app, abort,
-                   redirect, url_for, flash, session)
+                   redirect, url_for, flash, session, Response)
+import orjson
 from flask_login import login_required, login_user, logout_user, current_user
 from werkzeug.security import check_password_hash
 from urllib.parse import urlparse, urljoin
 import logging
+import threading
+import time
+import hashlib
 from datetime import datetime # For year in footer
 
-from .app import get_meshtastic_interface, User # Import User model from app
+from .app import get_meshtastic_interface
 from .. import database as db # Use shorter alias
 from .. import geocoder_util as geocoder
 import config
@@ -18,19 +22,128 @@ import config
 logger = logging.getLogger(__name__)
 app = current_app # Use Flask's current_app proxy
 
+# Statuses an operator may set by hand via /api/delivery/<id>/status
+_MANUAL_DELIVERY_STATUSES = frozenset({'completed', 'failed', 'pending'})
+
 # --- Helper Functions ---
 def is_safe_url(target):
     """Checks if a redirect target URL is safe (within the same host)."""
+    # Common case (Flask-Login's ?next=/path): a plain absolute path can't leave this host - no URL parsing.
+    # '//' and '\\' can be read as scheme-relative, and browsers drop tabs/newlines, so those take the full check.
+    if target.startswith('/') and not target.startswith('//') and '\\' not in target and target.isprintable(): return True
     ref_url = urlparse(request.host_url)
     test_url = urlparse(urljoin(request.host_url, target))
     return test_url.scheme in ('http', 'https') and ref_url.netloc == test_url.netloc
 
+# --- Password Verification Cache ---
+# Verifying a password hash (scrypt, or a legacy PBKDF2 hash) costs hundreds of ms on a Pi. A correct
+# (hash, password) pair is remembered briefly so re-logins skip the KDF; only a SHA-256 digest of the
+# password is kept, in memory. Wrong passwords are never cached and pay the full cost every time.
+_LOGIN_VERIFY_TTL_SECONDS = 300
+_LOGIN_VERIFY_MAX_ENTRIES = 128
+_verified_logins = {} # { (password_hash, sha256(password)): expires_at monotonic }
+_verified_logins_lock = threading.Lock()
+
+def _check_password(password_hash, password):
+    if not password_hash or password is None: return False
+    key = (password_hash, hashlib.sha256(password.encode('utf-8')).digest())
+    now = time.monotonic()
+    expires_at = _verified_logins.get(key)
+    if expires_at is not None and now < expires_at: return True
+    if not check_password_hash(password_hash, password): return False
+    with _verified_logins_lock:
+        if len(_verified_logins) >= _LOGIN_VERIFY_MAX_ENTRIES:
+            for stale in [k for k, exp in _verified_logins.items() if exp <= now]: del _verified_logins[stale]
+            if len(_verified_logins) >= _LOGIN_VERIFY_MAX_ENTRIES: _verified_logins.clear()
+        _verified_logins[key] = now + _LOGIN_VERIFY_TTL_SECONDS
+    return True
+
+# --- /api/state Cache ---
+# The UI polls /api/state; serve repeats within the TTL from memory. Mutating endpoints call
+# _invalidate_state_cache() so their changes show up on the next poll; mesh-driven updates
+# (unit locations/status) become visible within STATE_CACHE_TTL_SECONDS.
+_state_changed = threading.Condition() # Guards the cache; notified on invalidation to wake /api/state/stream
+_state_cache = (None, 0.0) # (snapshot JSON, expires_at monotonic)
+_state_cache_generation = 0 # Bumped on invalidation so a refresh racing a write can't store a stale snapshot
+
+def _get_cached_state_snapshot():
+    global _state_cache
+    snapshot, expires_at = _state_cache
+    if snapshot is not None and time.monotonic() < expires_at: return snapshot
+    generation = _state_cache_generation
+    snapshot = db.get_state_snapshot_json()
+    if snapshot is not None:
+        with _state_changed:
+            if generation == _state_cache_generation:
+                _state_cache = (snapshot, time.monotonic() + config.STATE_CACHE_TTL_SECONDS)
+    return snapshot
+
+def _invalidate_state_cache():
+    global _state_cache, _state_cache_generation
+    with _state_changed:
+        _state_cache_generation += 1
+        _state_cache = (None, 0.0)
+        _state_changed.notify_all()
+
+# --- /api/state/stream (Server-Sent Events) ---
+# Each stream re-reads the shared cached snapshot when an API mutation notifies it, or once per
+# TTL for mesh-driven changes, and sends only the rows that differ from what that client last got.
+# N clients still cost one DB query per TTL.
+_STREAM_KEEPALIVE_SECONDS = 15
+_stream_slots = threading.BoundedSemaphore(config.STATE_STREAM_MAX_CLIENTS)
+
+def _state_delta(snapshot, sent):
+    """Diffs a snapshot against sent ({(kind, id): row bytes}, updated in place). Returns the delta dict or None."""
+    state = orjson.loads(snapshot)
+    delta = {}; seen = set()
+    for kind, key_field in (('deliveries', 'id'), ('units', 'unit_id')):
+        changed = []
+        for row in state[kind]:
+            key = (kind, row[key_field]); seen.add(key)
+            encoded = orjson.dumps(row)
+            if sent.get(key) != encoded: sent[key] = encoded; changed.append(row)
+        if changed: delta[kind] = changed
+    removed = [key for key in sent if key not in seen]
+    for kind, row_id in removed:
+        del sent[(kind, row_id)]
+        delta.setdefault(f"removed_{kind}", []).append(row_id)
+    return delta or None
+
+def _state_event_stream():
+    sent = {}; first = True
+    ttl = config.STATE_CACHE_TTL_SECONDS # Bound once for the life of the stream
+    now = time.monotonic(); deadline = now + config.STATE_STREAM_MAX_SECONDS; last_write = now
+    while now < deadline:
+        generation = _state_cache_generation
+        snapshot = _get_cached_state_snapshot()
+        delta = _state_delta(snapshot, sent) if snapshot is not None else None
+        if first and snapshot is not None: delta = dict(delta or {}, full=True); first = False # Client replaces its lists
+        if delta is not None:
+            yield b"event: state\ndata: " + orjson.dumps(delta) + b"\n\n"; last_write = now
+        elif now - last_write >= _STREAM_KEEPALIVE_SECONDS:
+            yield b": keepalive\n\n"; last_write = now # Also how a dead client is noticed
+        with _state_changed:
+            if generation == _state_cache_generation: _state_changed.wait(timeout=ttl)
+        now = time.monotonic()
+
 # --- Context Processor ---
+_YEAR_RECHECK_SECONDS = 3600
+_footer_year = (datetime.now().year, time.monotonic() + _YEAR_RECHECK_SECONDS) # (year, recheck_at monotonic)
+
+def _current_year():
+    """Footer year without a clock read per render; re-read hourly so New Year still rolls over."""
+    global _footer_year
+    year, recheck_at = _footer_year
+    if time.monotonic() >= recheck_at:
+        year = datetime.now().year
+        _footer_year = (year, time.monotonic() + _YEAR_RECHECK_SECONDS)
+    return year
+
 @app.context_processor
 def inject_template_config():
     """Injects configuration into templates."""
     return dict(config=current_app.config.get('TEMPLATE_CONFIG', {}),
-                current_year=datetime.now().year)
+                current_year=_current_year())
 
 # --- Authentication Routes ---
 @app.route('/login', methods=['GET', 'POST'])
@@ -40,12 +153,11 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         remember = True if request.form.get('remember') else False
-        # Load user and hashed password (example using config)
-        user_record = config.ADMIN_USERS.get(username)
-        hashed_password = user_record.get('password_hash') if user_record else None
+        # Prebuilt User objects carry their password hash (see app.py)
+        user_obj = current_app.config['USERS_BY_NAME'].get(username)
+        hashed_password = user_obj.password_hash if user_obj else None
 
-        if hashed_password and check_password_hash(hashed_password, password):
-            user_obj = User(username)
+        if _check_password(hashed_password, password):
             login_user(user_obj, remember=remember)
             logger.info(f"User '{username}' logged in.")
             next_page = request.args.get('next')
@@ -79,13 +191,25 @@ def get_state():
     """Returns the current state of all deliveries and units."""
     logger.debug(f"API Request: /api/state by user '{current_user.id}'")
     try:
-        deliveries = db.get_all_deliveries()
-        units = db.get_all_units()
-        return jsonify({"deliveries": deliveries, "units": units})
+        snapshot = _get_cached_state_snapshot() # One query per TTL; SQLite serializes the rows
+        if snapshot is None: return jsonify({"error": "Server error fetching state"}), 500
+        return Response(snapshot, mimetype='application/json')
     except Exception as e:
         logger.error(f"API Error getting state: {e}", exc_info=True)
         return jsonify({"error": "Server error fetching state"}), 500
 
+@app.route('/api/state/stream', methods=['GET'])
+@login_required
+def stream_state():
+    """Streams /api/state changes as Server-Sent Events ('state' events carrying changed rows)."""
+    if not _stream_slots.acquire(blocking=False):
+        return jsonify({"error": "Too many live streams", "details": "Use /api/state polling."}), 503
+    logger.debug(f"API Request: /api/state/stream by user '{current_user.id}'")
+    response = Response(_state_event_stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(_stream_slots.release)
+    return response
+
 @app.route('/api/deliveries', methods=['POST'])
 @login_required
 def create_delivery():
@@ -94,20 +218,24 @@ def create_delivery():
     if not request.is_json: return jsonify({"error": "Request must be JSON"}), 400
     data = request.get_json()
     address = data.get('address')
+    if isinstance(address, str): address = address.strip()
     if not address: return jsonify({"error": "Missing 'address' field"}), 400
 
     try:
-        latitude, longitude = geocoder.geocode_address(address)
-        if latitude is None or longitude is None:
-            logger.warning(f"Geocoding failed for address: {address}")
-            return jsonify({"error": "Geocoding failed", "details": f"Could not find coordinates for: {address}"}), 400
-
-        delivery_id = db.add_delivery(address, latitude, longitude)
-        if delivery_id:
-            new_delivery = db.get_delivery(delivery_id) # Fetch newly created delivery
-            return jsonify({"message": "Delivery created", "delivery": new_delivery}), 201
+        latitude, longitude = geocoder.get_cached_coordinates(address) # Known address: no network round-trip
+        if latitude is not None and longitude is not None:
+            new_delivery = db.add_delivery(address, latitude, longitude) # Full row from INSERT ... RETURNING
+        else:
+            # Unknown address: save now, geocode in the background ('geocoding' -> 'pending' or 'failed')
+            new_delivery = db.add_delivery(address, None, None, status='geocoding')
+            if new_delivery: geocoder.geocode_delivery_async(new_delivery['id'], address)
+        if new_delivery:
+            _invalidate_state_cache()
+            if new_delivery['status'] == 'geocoding':
+                return jsonify({"message": "Delivery created, geocoding in progress", "delivery": db.api_row(new_delivery)}), 202
+            return jsonify({"message": "Delivery created", "delivery": db.api_row(new_delivery)}), 201
         else:
-            logger.error("Database failed to add delivery after geocoding.")
+            logger.error("Database failed to add delivery.")
             return jsonify({"error": "Database error", "details": "Failed to save delivery."}), 500
     except Exception as e:
          logger.error(f"API Error creating delivery: {e}", exc_info=True)
@@ -126,15 +254,13 @@ def assign_unit():
 
     try:
         # 1. Update DB State
-        db_success, db_message = db.assign_delivery_to_unit(delivery_id, unit_id)
+        db_success, db_message, delivery = db.assign_delivery_to_unit(delivery_id, unit_id, return_row=True) # Coords come back from the UPDATE
         if not db_success:
-            status_code = 400 if "not found" in db_message or "not idle" in db_message or "status changed" in db_message else 500
+            status_code = 400 if "not found" in db_message or "not idle" in db_message or "status changed" in db_message or "no coordinates" in db_message else 500
             return jsonify({"error": "Assignment failed (DB)", "details": db_message}), status_code
+        _invalidate_state_cache()
 
         # 2. Trigger Meshtastic Send (ACK tracking handled by interface)
-        delivery = db.get_delivery(delivery_id)
-        if not delivery: return jsonify({"error": "Server error", "details": "Delivery missing after DB assignment."}), 500
-
         mesh_interface = get_meshtastic_interface()
         if not mesh_interface:
              # Critical: Assignment in DB, but cannot notify unit. Requires manual intervention.
@@ -146,13 +272,15 @@ def assign_unit():
             longitude=delivery['longitude'], address=delivery['address'])
 
         if initial_send_success:
-            # Status 202 Accepted: processing initiated (waiting for ACK)
+            # Status 202 Accepted: queued for the radio (send + ACK tracking continue in the background)
             return jsonify({"message": "Assignment initiated", "details": send_status_msg}), 202
         else:
-            # Initial send failed after retries. Revert DB changes.
+            # Could not even queue the send. Revert DB changes.
             logger.error(f"Reverting assignment due to initial send failure for delivery {delivery_id}.")
-            db.update_delivery_status(delivery_id, 'pending', failure_reason="Failed to send assignment")
-            db.update_unit_status(unit_id, 'idle') # Set unit back to idle
+            with db.transaction() as conn: # Both reverts in one commit
+                db.update_delivery_status(delivery_id, 'pending', failure_reason="Failed to send assignment", conn=conn)
+                db.update_unit_status(unit_id, 'idle', conn=conn) # Set unit back to idle
+            _invalidate_state_cache()
             return jsonify({"error": "Assignment Failed", "details": f"Could not send command via Meshtastic: {send_status_msg}"}), 500
 
     except Exception as e:
@@ -168,23 +296,41 @@ def manual_update_delivery_status(delivery_id):
     data = request.get_json()
     new_status = data.get('status')
     reason = data.get('reason') # Optional reason for failure
-    if not new_status or new_status not in ['completed', 'failed', 'pending']:
+    if not isinstance(new_status, str) or new_status not in _MANUAL_DELIVERY_STATUSES: # str check: JSON lists/dicts aren't hashable
         return jsonify({"error": "Invalid or missing 'status'. Must be 'completed', 'failed', or 'pending'."}), 400
 
     try:
         delivery = db.get_delivery(delivery_id)
         if not delivery: abort(404, description=f"Delivery {delivery_id} not found")
         assigned_unit_id = delivery.get('assigned_unit_id')
+        # Re-opening a delivery whose address never resolved sends it back through geocoding, not to 'pending'
+        target_status = new_status
+        if new_status == 'pending' and (delivery.get('latitude') is None or delivery.get('longitude') is None): target_status = 'geocoding'
 
-        # Update delivery status in DB
-        db_success, db_message = db.update_delivery_status(delivery_id, new_status, failure_reason=reason)
+        # Update delivery status and the unit follow-up in one transaction (single commit)
+        with db.transaction() as conn:
+            db_success, db_message, updated_delivery = db.update_delivery_status(delivery_id, target_status, failure_reason=reason, conn=conn, return_row=True)
+            if db_success and assigned_unit_id:
+                if new_status == 'failed':
+                    # If failed manually, set unit back to returning/idle
+                    logger.info(f"Delivery {delivery_id} marked failed. Setting unit {assigned_unit_id} to returning/idle.")
+                    # Try returning first, fallback to idle
+                    unit_ok, _ = db.update_unit_status(assigned_unit_id, 'returning', conn=conn)
+                    if not unit_ok: db.update_unit_status(assigned_unit_id, 'idle', conn=conn)
+                elif new_status == 'pending':
+                    # If re-opened, ensure assigned unit goes back to idle
+                    logger.info(f"Delivery {delivery_id} re-opened. Setting unit {assigned_unit_id} to idle.")
+                    db.update_unit_status(assigned_unit_id, 'idle', conn=conn)
 
         if not db_success:
             status_code = 400 if "Invalid transition" in db_message else 500
             return jsonify({"error": "Update failed (DB)", "details": db_message}), status_code
 
         # Post-update actions
-        response_message = f"Delivery status updated to {new_status}"
+        response_message = f"Delivery status updated to {target_status}"
+        if target_status == 'geocoding' and delivery['status'] != 'geocoding': # Already queued if it was still geocoding
+            geocoder.geocode_delivery_async(delivery_id, delivery['address'])
+            response_message += " (no coordinates yet; geocoding again)"
         mesh_interface = get_meshtastic_interface()
 
         if new_status == 'completed' and assigned_unit_id:
@@ -198,20 +344,9 @@ def manual_update_delivery_status(delivery_id):
                  response_message += " (Error: Mesh interface unavailable)"
                  logger.error("Cannot send Task Complete: Mesh interface missing.")
 
-        elif new_status == 'failed' and assigned_unit_id:
-            # If failed manually, set unit back to returning/idle
-            logger.info(f"Delivery {delivery_id} marked failed. Setting unit {assigned_unit_id} to returning/idle.")
-            # Try returning first, fallback to idle
-            unit_ok, _ = db.update_unit_status(assigned_unit_id, 'returning')
-            if not unit_ok: db.update_unit_status(assigned_unit_id, 'idle')
-
-        elif new_status == 'pending' and assigned_unit_id:
-             # If re-opened, ensure assigned unit goes back to idle
-             logger.info(f"Delivery {delivery_id} re-opened. Setting unit {assigned_unit_id} to idle.")
-             db.update_unit_status(assigned_unit_id, 'idle')
-
-        updated_delivery = db.get_delivery(delivery_id)
-        return jsonify({"message": response_message, "delivery": updated_delivery}), 200
+        # Unit updates don't touch the delivery row, so the UPDATE's RETURNING row is still current
+        _invalidate_state_cache()
+        return jsonify({"message": response_message, "delivery": db.api_row(updated_delivery) if updated_delivery else None}), 200
 
     except Exception as e:
          logger.error(f"API Error updating delivery status: {e}", exc_info=True)
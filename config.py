@@ -18,11 +18,12 @@ ARRIVAL_PROXIMITY_METERS = 50
 FLASK_SECRET_KEY = 'generate_a_real_secret_key_here_and_store_safely'
 
 # Example storing hashed passwords (better in DB or secrets manager)
-# Generate hash using: python -c "from werkzeug.security import generate_password_hash; print(generate_password_hash('your_chosen_password'))"
+# Generate hash using: python -c "from werkzeug.security import generate_password_hash; print(generate_password_hash('your_chosen_password', method='scrypt:32768:8:1'))"
+# scrypt verifies much faster than 600k-iteration PBKDF2 on a Raspberry Pi at comparable strength; existing pbkdf2 hashes still work.
 ADMIN_USERS = {
     'admin': {
         # Replace with the actual generated hash for your chosen password
-        'password_hash': 'pbkdf2:sha256:600000$exampleSalt$exampleHashValue...', # Example Hash - REPLACE THIS
+        'password_hash': 'scrypt:32768:8:1$exampleSalt$exampleHashValue...', # Example Hash - REPLACE THIS
         'roles': ['admin']
     }
 }
@@ -51,13 +52,25 @@ WEB_SERVER_PORT = 5000
 DATABASE_PATH = 'akita_delivery.db' # Path to the SQLite database file
 LOG_LEVEL = logging.INFO     # DEBUG, INFO, WARNING, ERROR
 LOG_FILE = 'dispatch_server.log' # Set to None to log only to console
+STATE_CACHE_TTL_SECONDS = 2 # /api/state responses are reused this long (API mutations invalidate immediately)
+STATE_STREAM_MAX_CLIENTS = 4 # /api/state/stream connections each hold a web server thread; extra clients keep polling
+STATE_STREAM_MAX_SECONDS = 300 # Streams end after this long; browsers reconnect automatically
 
 # --- Delivery Unit Settings ---
 GPS_UPDATE_INTERVAL_SECONDS = 30
+GPSD_HOST = '127.0.0.1'  # gpsd streams TPV reports over this socket
+GPSD_PORT = 2947
+GPS_FIX_STALE_SECONDS = 10 # Ignore the latest streamed fix if gpsd hasn't refreshed it within this window
 
 # --- Geocoding Settings ---
 GEOCODER_PROVIDER = 'osm' # OpenStreetMap/Nominatim
+GEOCODER_URL = 'https://nominatim.openstreetmap.org/search'
+# Nominatim requires an identifying User-Agent; include a contact address for your deployment
+GEOCODER_USER_AGENT = 'AkitaDeliveryNavigator/1.0 (+http://www.akitaengineering.com)'
+GEOCODER_TIMEOUT_SECONDS = 10
+GEOCODER_MIN_INTERVAL_SECONDS = 1.0 # Nominatim usage policy: max 1 request/second
 # GEOCODER_API_KEY = "YOUR_API_KEY_IF_NEEDED"
+GEOCODER_CACHE_SIZE = 10000 # In-process LRU entries in front of the persistent geocode_cache table
 
 # --- Error Handling & Retries ---
 MESHTASTIC_SEND_RETRIES = 3         # Basic send attempts
@@ -71,6 +84,9 @@ MAX_ASSIGNMENT_RETRIES = 3        # How many times to resend assignment if no AC
 UNIT_OFFLINE_TIMEOUT_SECONDS = 300 # (5 minutes) Mark unit offline if no update
 UNIT_MAX_GPS_FAILURES = 10       # Consecutive GPS fails before marking unit 'error'
 
+# --- Database Maintenance ---
+DB_OPTIMIZE_INTERVAL_SECONDS = 900 # (15 minutes) Background PRAGMA optimize to keep planner stats current
+
 # --- Map Settings (for Web UI) ---
 MAP_DEFAULT_CENTER_LAT = RETURN_BASE_COORDS[0]
 MAP_DEFAULT_CENTER_LON = RETURN_BASE_COORDS[1]
@@ -6,225 +6,326 @@ import time
 import threading
 import logging
 import logging.handlers
-import math
 from datetime import datetime, timezone
 import sys
+import signal
+import os
+from dataclasses import dataclass
+from collections import namedtuple
+from typing import Optional
+import random
+import queue
 
 import config # Use shared config (primarily for GPS interval, base coords etc)
 from akita_navigator.meshtastic_iface import UnitMeshtasticInterface
-from akita_navigator import gps_handler
+from akita_navigator import gps_handler, geo
 
 # --- Unit Specific Config ---
 # !!! CRITICAL: SET THIS FOR EACH UNIT !!!
 DELIVERY_UNIT_ID = "Unit-Alpha"
 # !!! CRITICAL: SET THIS FOR EACH UNIT !!!
+MESH_RECONNECT_BACKOFF_INITIAL = 5 # Seconds before the first reconnect retry; doubles per failure
+MESH_RECONNECT_BACKOFF_MAX = 60
+STATUS_RESEND_AFTER_SECONDS = config.UNIT_OFFLINE_TIMEOUT_SECONDS / 2 # Resend an unchanged status after this much quiet
+GPS_THREAD_NICE_INCREMENT = -5 # Raises the GPS thread's priority; needs root/CAP_SYS_NICE, skipped otherwise
 
 # --- Logging Setup ---
+# Threads only push records onto a queue; a listener thread does the console/SD-card writes,
+# so a slow card never stalls the GPS tick or a Meshtastic callback.
 log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 unit_logger = logging.getLogger() # Root logger for unit
 unit_logger.setLevel(config.LOG_LEVEL) # Use level from main config
+unit_log_handlers = []
 
 # Console Handler
 unit_console_handler = logging.StreamHandler(sys.stdout)
 unit_console_handler.setFormatter(log_formatter)
-unit_logger.addHandler(unit_console_handler)
+unit_log_handlers.append(unit_console_handler)
 
 # File Handler (Optional) - Use unit-specific log file
 unit_log_file = f'{DELIVERY_UNIT_ID.lower()}.log'
+unit_file_error = None
 try:
     unit_file_handler = logging.handlers.RotatingFileHandler(
         unit_log_file, maxBytes=2*1024*1024, backupCount=3, encoding='utf-8' # Smaller log for unit
     )
     unit_file_handler.setFormatter(log_formatter)
-    unit_logger.addHandler(unit_file_handler)
+    unit_log_handlers.append(unit_file_handler)
 except Exception as e:
-     unit_logger.error(f"Could not configure file logging to {unit_log_file}: {e}")
+     unit_file_error = e
+
+unit_log_queue = queue.SimpleQueue()
+unit_logger.addHandler(logging.handlers.QueueHandler(unit_log_queue))
+unit_log_listener = logging.handlers.QueueListener(unit_log_queue, *unit_log_handlers, respect_handler_level=True)
+unit_log_listener.start()
+if unit_file_error: unit_logger.error(f"Could not configure file logging to {unit_log_file}: {unit_file_error}")
 
 logger = logging.getLogger(__name__) # Logger for this module
 logger.info(f"--- Starting Delivery Unit: {DELIVERY_UNIT_ID} ---")
 logger.info(f"Log Level set to: {logging.getLevelName(config.LOG_LEVEL)}")
 
 # --- Global State ---
-current_assignment = { "delivery_id": None, "latitude": None, "longitude": None, "address": None }
-unit_status = "offline" # Start as offline, will change on connect/GPS fix
+_VALID_STATUSES = frozenset(('idle', 'assigned', 'en_route', 'arrived_dest', 'returning', 'error', 'offline'))
+_NO_TASK_STATUSES = frozenset(('idle', 'returning', 'error', 'offline')) # Statuses that are fine without an assignment
+Assignment = namedtuple("Assignment", "delivery_id latitude longitude address")
+EMPTY_ASSIGNMENT = Assignment(None, None, None, None) # Shared "no task" value; assignments are replaced, never mutated
+
+@dataclass
+class UnitState:
+    """State shared by the GPS, mesh manager and Meshtastic callback threads.
+    Read and change it only while holding state_lock."""
+    status: str = "offline" # Start as offline, will change on connect/GPS fix
+    assignment: Assignment = EMPTY_ASSIGNMENT # Current task
+    last_location: Optional[dict] = None
+    gps_failures: int = 0 # Consecutive ticks without a fix
+    reported_status: Optional[str] = None # Last status the radio accepted for sending
+    last_report_time: float = 0.0 # time.monotonic() of the last report (status or location) the radio accepted
+
+state = UnitState()
+state_lock = threading.RLock() # Held for reads/transitions only, never across a radio send
 stop_event = threading.Event()
-last_location = None
-consecutive_gps_failures = 0
+mesh_iface_ready = threading.Event() # Set once the manager's first connect attempt returns
 # Make mesh_interface global for easier access in callbacks
 mesh_interface = None
 
 # --- Helper Functions ---
-def haversine(lat1, lon1, lat2, lon2):
-    """Calculate distance between two points in meters using Haversine formula."""
-    R = 6371000 # Earth radius in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    a = math.sin(delta_phi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(delta_lambda / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return R * c
-
-def set_unit_status(new_status, delivery_id=None, force_send=False):
-    """Updates local unit status and sends update via Meshtastic."""
-    global unit_status, mesh_interface # Access global interface
-    if new_status not in {'idle', 'assigned', 'en_route', 'arrived_dest', 'returning', 'error', 'offline'}:
+_ARRIVAL_A_THRESHOLD = geo.radius_threshold(config.ARRIVAL_PROXIMITY_METERS)
+_ARRIVAL_RADIUS_SQ = config.ARRIVAL_PROXIMITY_METERS ** 2
+
+# Trig terms of the point the unit is heading to (assignment destination or return base), computed
+# once per target instead of every GPS tick. Rebound whole, so the GPS thread never sees a partial entry.
+_dest_cache = {"key": None, "terms": None, "ecef": None, "bbox": None}
+
+def set_destination(lat, lon):
+    """Caches trig terms for the current target. No-op if the target hasn't changed."""
+    global _dest_cache
+    if _dest_cache["key"] == (lat, lon): return
+    _dest_cache = {"key": (lat, lon), "terms": geo.point_terms(lat, lon), "ecef": geo.ecef_terms(lat, lon),
+                   "bbox": geo.bbox_terms(lat, lon, config.ARRIVAL_PROXIMITY_METERS)}
+
+def haversine(lat1, lon1):
+    """Distance in meters from a point to the cached destination."""
+    return geo.haversine(lat1, lon1, _dest_cache["terms"])
+
+def within_arrival_proximity(location):
+    """True if a GPS fix is within ARRIVAL_PROXIMITY_METERS of the cached destination.
+    Uses the receiver's ECEF position when gpsd reports one (no trig), else the haversine threshold."""
+    # Most ticks are far from the target: a lat/lon box rules them out before either distance check
+    if geo.outside_bbox(location['latitude'], location['longitude'], _dest_cache["bbox"]): return False
+    ecef = location.get('ecef')
+    if ecef: return geo.within_radius_ecef(ecef, _dest_cache["ecef"], _ARRIVAL_RADIUS_SQ)
+    return geo.within_radius(location['latitude'], location['longitude'], _dest_cache["terms"], _ARRIVAL_A_THRESHOLD)
+
+def set_unit_status(new_status, delivery_id=None, force_send=False, report=True):
+    """Updates local unit status and sends update via Meshtastic.
+    report=False only updates local state; the caller reports the change itself (GPS loop piggybacks it on the location report)."""
+    if new_status not in _VALID_STATUSES:
          logger.error(f"Attempted to set invalid local status: {new_status}")
          return False
 
-    status_changed = (new_status != unit_status)
-    current_delivery = delivery_id if delivery_id else current_assignment.get("delivery_id")
+    with state_lock:
+        old_status = state.status
+        status_changed = (new_status != old_status)
+        current_delivery = delivery_id if delivery_id else state.assignment.delivery_id
+        if status_changed: state.status = new_status # Update local state
 
     if status_changed:
-        logger.info(f"Local unit status changing from '{unit_status}' to '{new_status}' (Delivery: {current_delivery})")
-        unit_status = new_status # Update local state
-
-        # Report status change via Meshtastic
-        if mesh_interface and mesh_interface._is_connected:
-            logger.info(f"Reporting status update '{unit_status}'...")
-            send_success = mesh_interface.send_status_update(
-                status=unit_status,
-                delivery_id=current_delivery
-            )
-            if not send_success: logger.error(f"Failed to report status update '{unit_status}'.")
-            return send_success
-        elif mesh_interface:
-             logger.warning(f"Cannot report status '{unit_status}': Meshtastic connected but flag is false?")
-             return False
-        else:
-             logger.warning(f"Cannot report status '{unit_status}': Meshtastic interface not available.")
-             return False
+        logger.info(f"Local unit status changing from '{old_status}' to '{new_status}' (Delivery: {current_delivery})")
+        if not report: return True
+        return report_status(new_status, current_delivery)
     elif force_send:
          if mesh_interface and mesh_interface._is_connected:
-              logger.info(f"Forcing send of current status '{unit_status}'...")
-              return mesh_interface.send_status_update(status=unit_status, delivery_id=current_delivery)
+              logger.info(f"Forcing send of current status '{new_status}'...")
+              send_success = mesh_interface.send_status_update(status=new_status, delivery_id=current_delivery)
+              if send_success: _mark_reported(new_status)
+              return send_success
          else: return False # Cannot force send if not connected
     else:
-        logger.debug(f"Local unit status remains '{unit_status}'")
+        logger.debug("Local unit status remains '%s'", new_status)
         return True # No change needed, considered success
 
+def report_status(status, delivery_id):
+    """Sends a status change via Meshtastic. Call without holding state_lock (may block on retries)."""
+    if mesh_interface and mesh_interface._is_connected:
+        logger.info(f"Reporting status update '{status}'...")
+        send_success = mesh_interface.send_status_update(
+            status=status,
+            delivery_id=delivery_id
+        )
+        if send_success: _mark_reported(status)
+        else: logger.error(f"Failed to report status update '{status}'.")
+        return send_success
+    elif mesh_interface:
+         logger.warning(f"Cannot report status '{status}': Meshtastic connected but flag is false?")
+         return False
+    else:
+         logger.warning(f"Cannot report status '{status}': Meshtastic interface not available.")
+         return False
+
+def _mark_reported(status=None):
+    """Records a report the radio accepted; status=None for a plain location report."""
+    with state_lock:
+        if status: state.reported_status = status
+        state.last_report_time = time.monotonic()
+
+def _status_resend_needed():
+    """True unless dispatch already has our current status: it was the last one sent, and we've reported
+    recently enough that dispatch can't have marked us offline (UNIT_OFFLINE_TIMEOUT_SECONDS of silence)."""
+    with state_lock:
+        if state.status != state.reported_status: return True
+        return time.monotonic() - state.last_report_time > STATUS_RESEND_AFTER_SECONDS
+
 # --- Callbacks ---
 def handle_incoming_assignment(delivery_id, lat, lon, address):
     """Callback for new assignment message."""
-    global current_assignment, unit_status
     logger.info(f"Received new assignment via Meshtastic: Delivery {delivery_id} to '{address}'")
-    # Overwrite current assignment
-    current_assignment["delivery_id"] = delivery_id
-    current_assignment["latitude"] = lat
-    current_assignment["longitude"] = lon
-    current_assignment["address"] = address
-    # Status change (to 'assigned' or 'en_route') is handled by main loop / GPS loop
-    if unit_status == 'idle':
-         logger.info("Setting status to 'assigned' based on new assignment.")
-         # Need mesh_interface here to report status change
-         set_unit_status('assigned', delivery_id=delivery_id)
+    with state_lock:
+        state.assignment = Assignment(delivery_id, lat, lon, address) # Overwrite current assignment
+        if lat is not None and lon is not None: set_destination(lat, lon)
+        # Status change (to 'assigned' or 'en_route') is handled by main loop / GPS loop
+        newly_assigned = state.status == 'idle'
+        if newly_assigned: set_unit_status('assigned', delivery_id=delivery_id, report=False)
+    if newly_assigned:
+         logger.info("Set status to 'assigned' based on new assignment.")
+         report_status('assigned', delivery_id)
 
 def handle_task_complete(completed_delivery_id):
     """Callback when dispatch signals task completion."""
-    global unit_status, current_assignment
     logger.info(f"Received task complete command for delivery {completed_delivery_id}.")
-    # Check if we are arrived for *this* delivery
-    if unit_status == 'arrived_dest' and current_assignment.get("delivery_id") == completed_delivery_id:
-        logger.info("Task confirmed complete. Transitioning to 'returning' state.")
-        set_unit_status('returning') # Reports status change
+    with state_lock:
+        # Check if we are arrived for *this* delivery
+        completed = state.status == 'arrived_dest' and state.assignment.delivery_id == completed_delivery_id
+        if completed:
+            set_destination(*config.RETURN_BASE_COORDS)
+            set_unit_status('returning', report=False)
+        else: status, assigned = state.status, state.assignment.delivery_id
+    if completed:
+        logger.info("Task confirmed complete. Transitioned to 'returning' state.")
+        report_status('returning', completed_delivery_id)
     else:
-        logger.warning(f"Received task complete for {completed_delivery_id}, but current state is '{unit_status}' (Assignment: {current_assignment.get('delivery_id')}). Ignoring.")
+        logger.warning(f"Received task complete for {completed_delivery_id}, but current state is '{status}' (Assignment: {assigned}). Ignoring.")
 
 
 # --- Main Logic Threads ---
 def gps_update_loop():
     """Periodically gets GPS data, updates state, and sends updates."""
-    global last_location, unit_status, consecutive_gps_failures, mesh_interface
     logger.info("Starting GPS update loop...")
+    # On Linux the nice value is per-thread, so this only favours the GPS thread over the mesh/log threads
+    try: os.nice(GPS_THREAD_NICE_INCREMENT)
+    except (AttributeError, OSError) as e: logger.info(f"GPS thread priority unchanged ({e}).")
     gps_handler.initialize_gps() # Ensure gpsd connection attempted
+    # Loop invariants bound once: config is fixed for the life of the process
+    interval = config.GPS_UPDATE_INTERVAL_SECONDS; max_failures = config.UNIT_MAX_GPS_FAILURES
+    base_coords = config.RETURN_BASE_COORDS
+    monotonic = time.monotonic; get_location = gps_handler.get_gps_location
 
     while not stop_event.is_set():
-        start_time = time.monotonic()
+        start_time = monotonic()
         location = None
         try:
-            location = gps_handler.get_gps_location()
-            assigned_delivery_id = current_assignment.get("delivery_id") # Get current task
+            location = get_location()
 
             if location and location.get('latitude') is not None:
-                if consecutive_gps_failures > 0: logger.info("GPS fix acquired.")
-                consecutive_gps_failures = 0
-                last_location = location
-                logger.debug(f"GPS Loc: ({location['latitude']:.4f}, {location['longitude']:.4f}), Spd: {location.get('speed', 0):.1f} m/s")
+                lat = location['latitude']; lon = location['longitude']
+                # %-style: formatted only if a handler actually emits DEBUG (this runs every tick)
+                logger.debug("GPS Loc: (%.4f, %.4f), Spd: %.1f m/s", lat, lon, location.get('speed') or 0)
 
-                # Report location update via Meshtastic (if connected)
+                # --- State Logic based on GPS and Assignment ---
+                # Runs as one transition under the lock (no sends inside); changes are reported
+                # together with this tick's location: one packet, not two
+                with state_lock:
+                    if state.gps_failures > 0: logger.info("GPS fix acquired.")
+                    state.gps_failures = 0
+                    state.last_location = location
+                    assignment = state.assignment # Get current task
+                    assigned_delivery_id = assignment.delivery_id
+                    status_before = state.status
+                    if assigned_delivery_id is not None: # We have a task
+                        if state.status == 'assigned':
+                             # Move to en_route once assigned and GPS is good (or maybe if speed > threshold?)
+                             # Simple: Move immediately if assigned and GPS OK.
+                             logger.info("Assignment active, GPS OK. Setting status to 'en_route'.")
+                             set_unit_status('en_route', delivery_id=assigned_delivery_id, report=False)
+
+                        elif state.status == 'en_route':
+                             set_destination(assignment.latitude, assignment.longitude) # No-op unless the target changed
+                             if logger.isEnabledFor(logging.DEBUG):
+                                  logger.debug("Dist to Dest (%s): %.1f m", assigned_delivery_id, haversine(lat, lon))
+                             if within_arrival_proximity(location):
+                                  logger.info(f"Arrived at destination for delivery {assigned_delivery_id}. Reporting status.")
+                                  set_unit_status('arrived_dest', delivery_id=assigned_delivery_id, report=False)
+                                  # Wait here for task_complete command
+
+                        elif state.status == 'arrived_dest':
+                             # Do nothing based on location, wait for command
+                             logger.debug("Status arrived_dest, awaiting command.")
+
+                        elif state.status == 'returning':
+                             set_destination(*base_coords)
+                             if logger.isEnabledFor(logging.DEBUG):
+                                  logger.debug("Dist to Base: %.1f m", haversine(lat, lon))
+                             if within_arrival_proximity(location):
+                                  logger.info("Arrived back at base.")
+                                  set_unit_status('idle', report=False)
+                                  state.assignment = EMPTY_ASSIGNMENT # Clear completed assignment info
+                        # Other states (idle, error, offline) handled elsewhere or by commands
+
+                    # No assignment, not returning -> should be idle
+                    elif state.status not in _NO_TASK_STATUSES:
+                        logger.info(f"No active task/return. Setting status 'idle'. Current: {state.status}")
+                        set_unit_status('idle', report=False)
+                    tick_status = state.status if state.status != status_before else None
+
+                # Report location update (plus any status change above) via Meshtastic (if connected)
                 if mesh_interface and mesh_interface._is_connected:
-                    send_loc_success = mesh_interface.send_location_update(
-                        location['latitude'], location['longitude'], location['timestamp'])
-                    if not send_loc_success: logger.error("Failed to send location update.")
+                    if tick_status: logger.info(f"Reporting status update '{tick_status}' with location...")
+                    send_loc_success = mesh_interface.send_location_update(lat, lon, location['timestamp'],
+                                                                           status=tick_status, delivery_id=assigned_delivery_id)
+                    if send_loc_success: _mark_reported(tick_status)
+                    else:
+                        if tick_status: logger.error(f"Failed to report status update '{tick_status}'.")
+                        else: logger.error("Failed to send location update.")
                 elif not mesh_interface: logger.warning("No mesh interface for loc update.")
-                elif not mesh_interface._is_connected: logger.debug("Mesh not connected for loc update.")
-
-                # --- State Logic based on GPS and Assignment ---
-                if assigned_delivery_id is not None: # We have a task
-                    if unit_status == 'assigned':
-                         # Move to en_route once assigned and GPS is good (or maybe if speed > threshold?)
-                         # Simple: Move immediately if assigned and GPS OK.
-                         logger.info("Assignment active, GPS OK. Setting status to 'en_route'.")
-                         set_unit_status('en_route', delivery_id=assigned_delivery_id)
-
-                    elif unit_status == 'en_route':
-                         dest_lat = current_assignment["latitude"]; dest_lon = current_assignment["longitude"]
-                         distance_m = haversine(location['latitude'], location['longitude'], dest_lat, dest_lon)
-                         logger.debug(f"Dist to Dest ({assigned_delivery_id}): {distance_m:.1f} m")
-                         if distance_m <= config.ARRIVAL_PROXIMITY_METERS:
-                              logger.info(f"Arrived at destination for delivery {assigned_delivery_id}. Reporting status.")
-                              set_unit_status('arrived_dest', delivery_id=assigned_delivery_id)
-                              # Wait here for task_complete command
-
-                    elif unit_status == 'arrived_dest':
-                         # Do nothing based on location, wait for command
-                         logger.debug("Status arrived_dest, awaiting command.")
-
-                    elif unit_status == 'returning':
-                         base_lat = config.RETURN_BASE_COORDS[0]; base_lon = config.RETURN_BASE_COORDS[1]
-                         distance_m = haversine(location['latitude'], location['longitude'], base_lat, base_lon)
-                         logger.debug(f"Dist to Base: {distance_m:.1f} m")
-                         if distance_m <= config.ARRIVAL_PROXIMITY_METERS:
-                              logger.info("Arrived back at base.")
-                              set_unit_status('idle')
-                              # Clear completed assignment info
-                              current_assignment.update({k: None for k in current_assignment})
-                    # Other states (idle, error, offline) handled elsewhere or by commands
-
-                # No assignment, not returning -> should be idle
-                elif unit_status not in ['idle', 'returning', 'error', 'offline']:
-                    logger.info(f"No active task/return. Setting status 'idle'. Current: {unit_status}")
-                    set_unit_status('idle')
+                elif not mesh_interface._is_connected:
+                    if tick_status: logger.warning(f"Cannot report status '{tick_status}': Meshtastic not connected (resent on reconnect).")
+                    else: logger.debug("Mesh not connected for loc update.")
 
             else: # No valid GPS fix
-                consecutive_gps_failures += 1
-                if unit_status != 'error': # Only warn if not already in error
-                    logger.warning(f"Waiting for GPS fix... (Failures: {consecutive_gps_failures}/{config.UNIT_MAX_GPS_FAILURES})")
-                if consecutive_gps_failures >= config.UNIT_MAX_GPS_FAILURES and unit_status != 'error':
-                    logger.error(f"GPS fix lost for {config.UNIT_MAX_GPS_FAILURES} checks. Setting unit status to 'error'.")
-                    set_unit_status('error')
+                _count_gps_failure(max_failures, "GPS fix lost", waiting=True)
 
         except Exception as e:
             logger.error(f"Error in GPS loop: {e}", exc_info=True)
-            consecutive_gps_failures += 1 # Count errors as failures
-            if consecutive_gps_failures >= config.UNIT_MAX_GPS_FAILURES and unit_status != 'error':
-                 set_unit_status('error')
+            _count_gps_failure(max_failures, "GPS loop errors") # Count errors as failures
 
         # Interval timing
-        elapsed = time.monotonic() - start_time
-        wait_time = max(0, config.GPS_UPDATE_INTERVAL_SECONDS - elapsed)
+        elapsed = monotonic() - start_time
+        wait_time = max(0, interval - elapsed)
         # Use stop_event.wait for faster shutdown response
         if stop_event.wait(wait_time): break # Exit loop if stop event set
 
     logger.info("GPS update loop stopped.")
     gps_handler.close_gps()
 
+def _count_gps_failure(max_failures, reason, waiting=False):
+    """Counts a tick without a usable fix; moves the unit to 'error' once max_failures is reached."""
+    with state_lock:
+        state.gps_failures += 1
+        failures = state.gps_failures; status = state.status
+        to_error = failures >= max_failures and status != 'error'
+        if to_error: set_unit_status('error', report=False)
+        delivery_id = state.assignment.delivery_id
+    if waiting and status != 'error': # Only warn if not already in error
+        logger.warning(f"Waiting for GPS fix... (Failures: {failures}/{max_failures})")
+    if to_error:
+        logger.error(f"{reason} for {max_failures} checks. Setting unit status to 'error'.")
+        report_status('error', delivery_id)
+
 
 def meshtastic_connection_manager():
      """Manages Meshtastic connection and resends status on reconnect."""
-     global mesh_interface, unit_status
      logger.info("Starting Meshtastic connection manager thread...")
      initial_connect_attempted = False
+     backoff = MESH_RECONNECT_BACKOFF_INITIAL
      while not stop_event.is_set():
           if not mesh_interface:
                logger.error("Meshtastic interface not initialized yet in manager.")
@@ -233,22 +334,30 @@ def meshtastic_connection_manager():
 
           if not mesh_interface._is_connected:
                logger.info("Meshtastic disconnected. Attempting connect...")
-               if mesh_interface.connect():
+               connected = mesh_interface.connect()
+               mesh_iface_ready.set() # Success or not, the GPS thread can start reporting
+               if connected:
                     logger.info("Meshtastic connected by manager.")
                     initial_connect_attempted = True
+                    backoff = MESH_RECONNECT_BACKOFF_INITIAL
                     # On successful (re)connect, send current status
-                    set_unit_status(unit_status, force_send=True) # Force send
+                    with state_lock: status = state.status; last_location = state.last_location
+                    # A flapping link reconnects often; only resend if dispatch may not have the current status
+                    if _status_resend_needed(): set_unit_status(status, force_send=True) # Force send
+                    else: logger.info(f"Status '{status}' already reported; not resending after reconnect.")
                     if last_location: # Also resend last known location
                          logger.info("Resending last known location after reconnect.")
                          mesh_interface.send_location_update(last_location['latitude'], last_location['longitude'], last_location['timestamp'])
                else:
+                    # Jittered so units that lost the link together don't retry in lockstep
+                    delay = backoff + random.uniform(0, backoff * 0.2)
                     if not initial_connect_attempted:
-                         logger.warning("Initial Meshtastic connection failed. Will retry.")
+                         logger.warning(f"Initial Meshtastic connection failed. Will retry in {delay:.0f}s.")
                          initial_connect_attempted = True # Avoid spamming log
                     else:
-                         logger.warning("Meshtastic reconnection failed. Will retry later.")
-                    # Wait longer if connection fails
-                    stop_event.wait(30)
+                         logger.warning(f"Meshtastic reconnection failed. Will retry in {delay:.0f}s.")
+                    backoff = min(backoff * 2, MESH_RECONNECT_BACKOFF_MAX)
+                    stop_event.wait(delay)
                     continue # Skip normal wait
 
           # If connected, wait normally
@@ -282,15 +391,15 @@ def main():
     mesh_manager_thread = threading.Thread(target=meshtastic_connection_manager, name="MeshManagerThread", daemon=True)
 
     mesh_manager_thread.start() # Start mesh manager first to handle connections
-    time.sleep(1) # Give manager a moment
+    if not mesh_iface_ready.wait(timeout=10): logger.warning("First Meshtastic connect attempt still running; starting GPS anyway.")
     gps_thread.start()
 
     logger.info(f"--- Delivery Unit {DELIVERY_UNIT_ID} Running --- (Press Ctrl+C to exit)")
+    # systemd stops the unit with SIGTERM; treat it like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
     try:
-        # Keep main thread alive
-        while not stop_event.is_set():
-            # Check for main loop tasks if any (e.g., check error state, report battery?)
-            time.sleep(1)
+        # Keep main thread alive: blocks without periodic wake-ups until a signal or a thread sets stop_event
+        stop_event.wait()
 
     except KeyboardInterrupt:
         logger.info("\nCtrl+C received. Shutting down...")
@@ -307,6 +416,7 @@ def main():
         # gps_handler.close_gps() # Closed by GPS thread
 
         logger.info(f"--- Delivery Unit {DELIVERY_UNIT_ID} Shutdown Complete ---")
+        unit_log_listener.stop() # Flushes queued records
 
 if __name__ == "__main__":
     main()
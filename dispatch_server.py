@@ -7,25 +7,31 @@ import logging
 import logging.handlers # For rotating file handler
 import time
 import queue
+import orjson
 from waitress import serve
 import sys
 
 import config # Project configuration
 from akita_navigator.web.app import create_app
-from akita_navigator.meshtastic_iface import DispatchMeshtasticInterface
+from akita_navigator.meshtastic_iface import DispatchMeshtasticInterface, SheddingQueue, decode_payload, MSG_TYPE_LOCATION
 from akita_navigator.database import initialize_database, check_and_update_offline_units
+from akita_navigator import geocoder_util as geocoder
 
 # --- Logging Setup ---
+# Worker and Waitress threads only push records onto a queue; a listener thread does the
+# console/file writes (and file rollovers), so disk I/O never stalls a request or the radio callback.
 log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 root_logger = logging.getLogger() # Get root logger
 root_logger.setLevel(config.LOG_LEVEL)
+log_handlers = []
 
 # Console Handler
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setFormatter(log_formatter)
-root_logger.addHandler(console_handler)
+log_handlers.append(console_handler)
 
 # File Handler (Optional, Rotating)
+file_log_error = None
 if config.LOG_FILE:
     try:
         # Rotate log file, keep 5 backups, max 5MB each
@@ -33,9 +39,15 @@ if config.LOG_FILE:
             config.LOG_FILE, maxBytes=5*1024*1024, backupCount=5, encoding='utf-8'
         )
         file_handler.setFormatter(log_formatter)
-        root_logger.addHandler(file_handler)
+        log_handlers.append(file_handler)
     except Exception as e:
-         root_logger.error(f"Could not configure file logging to {config.LOG_FILE}: {e}")
+         file_log_error = e
+
+log_queue = queue.SimpleQueue()
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+if file_log_error: root_logger.error(f"Could not configure file logging to {config.LOG_FILE}: {file_log_error}")
 
 
 logger = logging.getLogger(__name__) # Get logger for this module
@@ -45,7 +57,12 @@ logger.info(f"Log Level set to: {logging.getLevelName(config.LOG_LEVEL)}")
 # --- Global Shared Resources ---
 stop_event = threading.Event()
 # Queue for messages received from Meshtastic to be processed by a worker
-incoming_message_queue = queue.Queue(maxsize=500) # Limit queue size
+incoming_message_queue = SheddingQueue(500) # Up to 500 location reports; ACK/status messages are never dropped
+PROCESSOR_BATCH_SIZE = 32 # Max messages the processor takes off the queue per wakeup
+NON_TARGET_DROP_LOG_EVERY = 500 # Log one summary line per this many packets dropped from outside the fleet
+QUEUE_FULL_DROP_LOG_EVERY = 50 # Same, for location reports shed from a full incoming queue
+OFFLINE_CHECK_INTERVAL_SECONDS = 60
+ACK_RESTART_DELAY_SECONDS = 10 # Gives the listener thread time to connect before pending ACKs are re-armed
 
 
 # --- Worker Threads ---
@@ -53,17 +70,22 @@ incoming_message_queue = queue.Queue(maxsize=500) # Limit queue size
 def message_processor_worker(mesh_interface):
     """Processes incoming messages from the queue."""
     logger.info("Starting incoming message processor worker...")
+    get = incoming_message_queue.get; get_nowait = incoming_message_queue.get_nowait
     while not stop_event.is_set():
         try:
-            message_data, packet = incoming_message_queue.get(block=True, timeout=1.0)
-            logger.debug(f"Dequeued message: Type={message_data.get('type')}, From={packet.get('fromId')}")
+            batch = [get(block=True, timeout=1.0)]
+            # Drain a burst with non-blocking gets instead of a timed blocking get per message
             try:
-                 # Use the internal handler that now expects dequeued messages
-                 mesh_interface._handle_incoming_message(message_data, packet)
-            except Exception as proc_e:
-                 logger.error(f"Error processing dequeued message: {proc_e}", exc_info=True)
-            finally:
-                 incoming_message_queue.task_done()
+                while len(batch) < PROCESSOR_BATCH_SIZE: batch.append(get_nowait())
+            except queue.Empty: pass
+            debug = logger.isEnabledFor(logging.DEBUG)
+            for message_data, packet in batch:
+                if debug: logger.debug(f"Dequeued message: Type={message_data.get('type')}, From={packet.get('fromId')}")
+                try:
+                     # Use the internal handler that now expects dequeued messages
+                     mesh_interface._handle_incoming_message(message_data, packet)
+                except Exception as proc_e:
+                     logger.error(f"Error processing dequeued message: {proc_e}", exc_info=True)
         except queue.Empty:
             continue # Timeout, check stop_event
         except Exception as e:
@@ -76,39 +98,55 @@ def run_meshtastic_service(mesh_interface, incoming_queue):
     """Runs Meshtastic connection logic and queues received messages."""
     logger.info("Starting Meshtastic listener thread...")
 
+    target_node_ids = mesh_interface.target_node_ids # frozenset, bound once for the callback
+    non_target_drops = 0
+    full_queue_drops = 0
+
     def queued_on_receive(packet, interface):
         """Callback wrapper to put received packets onto the queue."""
-        # Basic filtering to avoid noise / own messages
-        if packet and 'decoded' in packet and 'payload' in packet['decoded'] and 'fromId' in packet:
-             sender_node_id = packet.get('fromId')
-             my_node_id = mesh_interface._node_info.get('user',{}).get('id') if mesh_interface._node_info else None
-             if sender_node_id and my_node_id and sender_node_id == my_node_id:
-                 logger.debug("Ignored own message.")
-                 return # Ignore message from self
-
-             payload_bytes = packet['decoded']['payload']
-             try:
-                 payload_str = payload_bytes.decode('utf-8')
-                 message_data = json.loads(payload_str)
-                 # Simple validation? Check if it has a 'type'?
-                 if not isinstance(message_data, dict) or 'type' not in message_data:
-                      logger.warning(f"Received non-standard JSON payload from {sender_node_id}: {payload_str}")
-                      return
-
-                 try:
-                      incoming_queue.put_nowait((message_data, packet))
-                      logger.debug(f"Enqueued message type {message_data.get('type')} from {sender_node_id}")
-                 except queue.Full:
-                      logger.error(f"Incoming message queue FULL! Message from {sender_node_id} dropped.")
-             except (UnicodeDecodeError, json.JSONDecodeError):
-                  logger.warning(f"Received non-JSON/undecodable payload from {sender_node_id}")
-             except Exception as e:
-                  logger.error(f"Error decoding/parsing payload: {e}", exc_info=True)
-        elif packet and 'decoded' in packet and packet['decoded'].get('portnum') == 'TEXT_MESSAGE_APP':
-             # Optionally handle plain text messages if needed
-             logger.debug(f"Received plain text message (ignored): {packet['decoded'].get('text')}")
-        else:
-             logger.debug(f"Ignoring other packet type: {packet.get('decoded', {}).get('portnum')}")
+        nonlocal non_target_drops, full_queue_drops
+        if not packet: return
+        # Cheapest check first: drop traffic from nodes outside the fleet before any parsing
+        sender_node_id = packet.get('fromId')
+        if sender_node_id not in target_node_ids:
+             non_target_drops += 1
+             if non_target_drops % NON_TARGET_DROP_LOG_EVERY == 1:
+                  logger.info(f"Dropped packet from non-target node {sender_node_id} ({non_target_drops} non-target packets dropped so far).")
+             return
+        # EAFP: one try instead of membership tests on every packet; non-data packets are the rare case
+        try:
+            payload_bytes = packet['decoded']['payload']
+        except (KeyError, TypeError):
+            decoded = packet.get('decoded') or {}
+            if decoded.get('portnum') == 'TEXT_MESSAGE_APP':
+                 # Optionally handle plain text messages if needed
+                 logger.debug(f"Received plain text message (ignored): {decoded.get('text')}")
+            else:
+                 logger.debug(f"Ignoring other packet type: {decoded.get('portnum')}")
+            return
+        if sender_node_id == mesh_interface.my_node_id: # Cached on connect; no node-info dict walk per packet
+             logger.debug("Ignored own message.")
+             return # Ignore message from self
+
+        try:
+             message_data = decode_payload(payload_bytes) # Location reports skip the full JSON parse
+             # Simple validation? Check if it has a 'type'?
+             if not isinstance(message_data, dict) or 'type' not in message_data:
+                  logger.warning(f"Received non-standard JSON payload from {sender_node_id}: {payload_bytes.decode('utf-8', 'replace')}")
+                  return
+
+             # Plain location fixes are superseded by the next one, so a full queue sheds the oldest of those;
+             # ACKs and status reports (including locations carrying a status) are never dropped
+             sheddable = message_data.get('type') == MSG_TYPE_LOCATION and not message_data.get('status')
+             if incoming_queue.put((message_data, packet), sheddable=sheddable):
+                  full_queue_drops += 1
+                  if full_queue_drops % QUEUE_FULL_DROP_LOG_EVERY == 1:
+                       logger.error(f"Incoming message queue FULL! Dropped oldest location report ({full_queue_drops} dropped so far).")
+             if logger.isEnabledFor(logging.DEBUG): logger.debug(f"Enqueued message type {message_data.get('type')} from {sender_node_id}")
+        except (UnicodeDecodeError, orjson.JSONDecodeError):
+              logger.warning(f"Received non-JSON/undecodable payload from {sender_node_id}")
+        except Exception as e:
+              logger.error(f"Error decoding/parsing payload: {e}", exc_info=True)
 
 
     mesh_interface.subscribe_receive_handler(queued_on_receive)
@@ -139,13 +177,8 @@ def run_offline_checker():
                check_and_update_offline_units()
           except Exception as e:
                logger.error(f"Error in offline unit checker: {e}", exc_info=True)
-          # Wait for the next check interval (e.g., 60 seconds)
-          # Use stop_event.wait for faster shutdown response
-          interval_start = time.monotonic()
-          while time.monotonic() - interval_start < 60.0:
-                if stop_event.wait(1.0): break # Wait 1s at a time, break if stopped
-                if stop_event.is_set(): break
-          if stop_event.is_set(): break # Exit outer loop if stopped
+          # Wait for the next check interval; wait() returns True as soon as shutdown is signalled
+          if stop_event.wait(OFFLINE_CHECK_INTERVAL_SECONDS): break
 
      logger.info("Offline unit checker thread stopping.")
 
@@ -178,21 +211,15 @@ def main():
     meshtastic_thread.start()
 
     # --- Restart Pending ACK Timers ---
-    logger.info("Scheduling pending ACK timer restart...")
-    # Delay slightly to allow interface setup
-    def delayed_ack_restart():
-         logger.info("Waiting briefly before restarting ACK timers...")
-         time.sleep(10) # Adjust delay as needed for interface to stabilize
-         if not stop_event.is_set():
-              logger.info("Attempting to restart pending ACK timers...")
-              try:
-                   mesh_interface.restart_pending_ack_timers()
-              except Exception as restart_e:
-                   logger.error(f"Error restarting pending ACK timers: {restart_e}", exc_info=True)
-         else:
-              logger.info("Skipping ACK restart, shutdown initiated.")
-    restart_thread = threading.Thread(target=delayed_ack_restart, daemon=True)
-    restart_thread.start()
+    # Delay slightly to allow interface setup. Runs on the interface's shared scheduler thread
+    # (no thread of its own); close() on shutdown drops it if it hasn't fired yet.
+    logger.info(f"Scheduling pending ACK timer restart in {ACK_RESTART_DELAY_SECONDS}s...")
+    mesh_interface.schedule_pending_ack_restart(ACK_RESTART_DELAY_SECONDS)
+
+    # --- Resume Geocoding ---
+    # Deliveries created while Nominatim was slow/unreachable may still be waiting for coordinates
+    try: geocoder.resume_pending_geocodes()
+    except Exception as geo_e: logger.error(f"Error resuming background geocoding: {geo_e}", exc_info=True)
 
 
     # Create Flask App
@@ -229,10 +256,7 @@ def main():
         logger.info("Waiting for Meshtastic thread...")
         meshtastic_thread.join(timeout=5)
         logger.info("Waiting for Message Processor thread...")
-        # Give processor a moment to finish current item if queue isn't empty
-        try:
-             incoming_message_queue.join() # Wait for queue tasks to be marked done
-        except NotImplementedError: pass # Join might not be needed if using task_done correctly
+        # Give processor a moment to finish its current item (it stops on stop_event)
         msg_processor_thread.join(timeout=5)
         logger.info("Waiting for Offline checker thread...")
         offline_checker_thread.join(timeout=5)
@@ -240,4 +264,5 @@ def main():
         logger.info("--- Akita Dispatch Server Shutdown Complete ---")
 
 if __name__ == "__main__":
-    main()
+    try: main()
+    finally: log_listener.stop() # Flushes queued records